@@ -1,18 +1,32 @@
 import argparse
 import asyncio
+import json
+import sys
 from datetime import datetime
 from os.path import exists
 from pathlib import Path
 
+from loguru import logger
+
 from conf import BASE_DIR
 from uploader.douyin_uploader.main import douyin_setup, DouYinVideo
+from uploader.job_runner import JobRunner, UploadJob, load_manifest, stop_on_signals, enqueue_from_folder, JOB_DONE
 from uploader.ks_uploader.main import ks_setup, KSVideo
 from uploader.tencent_uploader.main import weixin_setup, TencentVideo
 from uploader.tk_uploader.main_chrome import tiktok_setup, TiktokVideo
+from uploader.xhs_uploader.sign_server import run_sign_server
 from utils.base_social_media import get_supported_social_media, get_cli_action, SOCIAL_MEDIA_DOUYIN, \
     SOCIAL_MEDIA_TENCENT, SOCIAL_MEDIA_TIKTOK, SOCIAL_MEDIA_KUAISHOU
+from utils.browser_daemon import run_browser_daemon, DEFAULT_HOST, DEFAULT_PORT
+from utils.browser_pool import browser_pool
 from utils.constant import TencentZoneTypes
 from utils.files_times import get_title_and_hashtags
+from utils.job_queue import JobQueue
+from utils.metrics import metrics, METRICS_FILE
+from utils.rate_limiter import get_rate_limiter
+from utils.request_filter import get_request_filter_stats
+from utils.schedule_planner import SchedulePlanner
+from utils.watchdog import get_watchdog
 
 
 def parse_schedule(schedule_raw):
@@ -23,9 +37,101 @@ def parse_schedule(schedule_raw):
     return schedule
 
 
+async def browser_daemon(argv):
+    # 常驻浏览器，之后的 upload 通过 --cdp-endpoint 直接连接，省去每次启动浏览器
+    parser = argparse.ArgumentParser(prog="cli_main.py browser-daemon",
+                                     description="Keep a Chrome running for uploads started with --cdp-endpoint.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="DevTools listen address")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="DevTools listen port")
+    args = parser.parse_args(argv)
+    await run_browser_daemon(args.host, args.port)
+
+
+async def xhs_sign_server(argv):
+    # 常驻的小红书签名服务，按 a1 保持预热页面，提供与 XHS_SERVER 相同的 /sign 接口
+    parser = argparse.ArgumentParser(prog="cli_main.py xhs-sign-server",
+                                     description="Serve XHS signatures from warm pages (POST /sign, POST /sign/batch, GET /health).")
+    parser.add_argument("--host", help="Listen address (default: host of platforms.xhs.settings.sign_server)")
+    parser.add_argument("--port", type=int, help="Listen port (default: port of platforms.xhs.settings.sign_server)")
+    args = parser.parse_args(argv)
+    await run_sign_server(args.host, args.port)
+
+
+async def batch(argv):
+    # 按清单并发上传多个平台、多个账号的视频，共用一个事件循环和浏览器池
+    parser = argparse.ArgumentParser(prog="cli_main.py batch",
+                                     description="Upload every video x platform x account row of a manifest concurrently.")
+    parser.add_argument("manifest", help="CSV/YAML/JSONL manifest with platform, account, video[, schedule, title, tags, thumbnail]")
+    parser.add_argument("--max-contexts", type=int, help="Global cap on concurrent browser contexts (batch.max_contexts)")
+    parser.add_argument("--per-platform", type=int, help="Concurrent jobs per platform (batch.per_platform)")
+    parser.add_argument("--per-account", type=int, help="Concurrent jobs per account (batch.per_account)")
+    parser.add_argument("--plan", action="store_true",
+                        help="Schedule rows without a schedule into free daily slots (schedule.* in config.yaml)")
+    parser.add_argument("--cdp-endpoint", dest="cdp_endpoint", help="Attach to a running browser (see browser-daemon)")
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    for job in jobs:
+        if not exists(job.video_file):
+            parser.error(f"Could not find the video file at {job.video_file}")
+    runner = JobRunner(args.max_contexts, args.per_platform, args.per_account)
+    if args.plan:
+        try:
+            SchedulePlanner(records=runner.records).plan_jobs(jobs)
+        except ValueError as e:
+            parser.error(str(e))
+        for job in jobs:
+            print(f"{job.schedule}  {job}")
+    async with browser_pool(cdp_endpoint=args.cdp_endpoint):
+        await runner.run(jobs)
+    for job in jobs:
+        if job.status != JOB_DONE:
+            print(f"{job.status}: {job} {job.error or ''} {' '.join(job.diagnostics)}")
+    if any(job.status != JOB_DONE for job in jobs):
+        sys.exit(1)
+
+
+async def stats(argv):
+    # 读取运行中或上一次运行写出的 metrics 快照，按平台汇总请求拦截情况
+    parser = argparse.ArgumentParser(prog="cli_main.py stats",
+                                     description="Print the request filter stats of the latest metrics snapshot.")
+    parser.add_argument("--file", default=str(METRICS_FILE), help="Metrics snapshot written by cli_main.py")
+    parser.add_argument("--json", action="store_true", help="Print the whole snapshot as JSON")
+    args = parser.parse_args(argv)
+    snapshot = metrics.load(args.file)
+    if args.json:
+        print(json.dumps(snapshot, ensure_ascii=False, indent=2))
+        return
+    filter_stats = get_request_filter_stats(snapshot)
+    if not filter_stats:
+        print(f"No blocked requests recorded in {args.file}")
+    for platform, platform_stats in filter_stats.items():
+        by_type = ", ".join(f"{kind} {count:g}" for kind, count in platform_stats["by_type"].items())
+        print(f"{platform}: {platform_stats['requests']:g} requests blocked ({by_type}), "
+              f"{platform_stats['bytes'] / 1048576:.1f} MB measured in observe mode")
+
+
+# 不属于任何平台和账号的命令，单独解析
+STANDALONE_ACTIONS = {
+    'browser-daemon': browser_daemon,
+    'xhs-sign-server': xhs_sign_server,
+    'batch': batch,
+    'stats': stats,
+}
+
+
 async def main():
+    if len(sys.argv) > 1 and sys.argv[1] in STANDALONE_ACTIONS:
+        await STANDALONE_ACTIONS[sys.argv[1]](sys.argv[2:])
+        return
+
     # 主解析器
-    parser = argparse.ArgumentParser(description="Upload video to multiple social-media.")
+    parser = argparse.ArgumentParser(description="Upload video to multiple social-media.",
+                                     epilog="Other commands: 'cli_main.py batch <manifest>' uploads a manifest "
+                                            "concurrently, 'cli_main.py browser-daemon' keeps a browser for --cdp-endpoint, "
+                                            "'cli_main.py stats' prints the request filter stats.")
+    parser.add_argument("--cdp-endpoint", dest="cdp_endpoint",
+                        help="Attach to a running browser, e.g. http://127.0.0.1:9222 (see browser-daemon)")
     parser.add_argument("platform", metavar='platform', choices=get_supported_social_media(), help="Choose social-media platform: douyin tencent tiktok kuaishou")
 
     parser.add_argument("account_name", type=str, help="Account name for the platform: xiaoA")
@@ -42,6 +148,12 @@ async def main():
             action_parser.add_argument("-pt", "--publish_type", type=int, choices=[0, 1],
                                        help="0 for immediate, 1 for scheduled", default=0)
             action_parser.add_argument('-t', '--schedule', help='Schedule UTC time in %Y-%m-%d %H:%M format')
+            action_parser.add_argument('--enqueue', action='store_true',
+                                       help='Add the video to the job queue for a running watch daemon instead')
+        elif action == 'watch':
+            action_parser.add_argument("--workers", type=int, help="Concurrent upload jobs (queue.workers)")
+            action_parser.add_argument("--poll-interval", type=float, help="Seconds between queue polls (queue.poll_interval)")
+            action_parser.add_argument("--folder", help="Also queue every finished video (with its .txt) appearing in this folder")
 
     # 解析命令行参数
     args = parser.parse_args()
@@ -55,6 +167,26 @@ async def main():
     account_file = Path(BASE_DIR / "cookies" / f"{args.platform}_{args.account_name}.json")
     account_file.parent.mkdir(exist_ok=True)
 
+    if args.action == 'upload' and args.enqueue:
+        # 只写入任务队列，由 watch 守护进程上传，不启动浏览器
+        job = UploadJob(args.platform, args.account_name, str(Path(args.video_file).resolve()),
+                        schedule=args.schedule if args.publish_type == 1 else None)
+        job_id = JobQueue().enqueue(job.platform, job.account, job.to_dict())
+        print(f"Queued job #{job_id}: {job}")
+        return
+
+    # cookie 校验和上传共用同一个浏览器池
+    async with browser_pool(cdp_endpoint=args.cdp_endpoint):
+        await run_action(args, account_file)
+
+
+def log_folder_failure(task: asyncio.Future):
+    # 监听目录的任务出错退出后不会再入队新视频，至少要在日志里看到
+    if not task.cancelled() and task.exception() is not None:
+        logger.opt(exception=task.exception()).error("[watch] folder watcher stopped, new videos are no longer queued")
+
+
+async def run_action(args, account_file):
     # 根据 action 处理不同的逻辑
     if args.action == 'login':
         print(f"Logging in with account {args.account_name} on platform {args.platform}")
@@ -77,25 +209,56 @@ async def main():
             print("Scheduling videos...")
             publish_date = parse_schedule(args.schedule)
 
+        # 与 batch / watch 共用按账号和平台的限速（upload.upload_interval、max_uploads_per_day），
+        # 令牌状态保存在记录库中，跨多次运行生效；在启动浏览器之前等待
+        await get_rate_limiter().acquire(args.platform, args.account_name)
+
+        # cookie 校验时直接用上传的启动参数，并保留校验通过的页面给上传复用
         if args.platform == SOCIAL_MEDIA_DOUYIN:
-            await douyin_setup(account_file, handle=False)
             app = DouYinVideo(title, video_file, tags, publish_date, account_file)
+            session = await douyin_setup(account_file, handle=False, launch_options=app.launch_options(),
+                                         keep_session=True)
         elif args.platform == SOCIAL_MEDIA_TIKTOK:
-            await tiktok_setup(account_file, handle=True)
             app = TiktokVideo(title, video_file, tags, publish_date, account_file)
+            session = await tiktok_setup(account_file, handle=True, launch_options=app.launch_options(),
+                                         keep_session=True)
         elif args.platform == SOCIAL_MEDIA_TENCENT:
-            await weixin_setup(account_file, handle=True)
             category = TencentZoneTypes.LIFESTYLE.value  # 标记原创需要否则不需要传
             app = TencentVideo(title, video_file, tags, publish_date, account_file, category)
+            session = await weixin_setup(account_file, handle=True, launch_options=app.launch_options(),
+                                         keep_session=True)
         elif args.platform == SOCIAL_MEDIA_KUAISHOU:
-            await ks_setup(account_file, handle=True)
             app = KSVideo(title, video_file, tags, publish_date, account_file)
+            session = await ks_setup(account_file, handle=True, launch_options=app.launch_options(),
+                                     keep_session=True)
         else:
             print("Wrong platform, please check your input")
             exit()
 
-        await app.main()
+        # 卡住的上传由 watchdog 按 deadlines.* 取消，并保存诊断信息
+        await get_watchdog().run(app.main(session=session), video_file, args.platform)
+    elif args.action == 'watch':
+        # 常驻进程：消费该账号的任务队列，浏览器在任务之间保持预热，收到 SIGINT/SIGTERM 后优雅退出
+        queue = JobQueue()
+        folder_task = None
+        if args.folder:
+            # 监听目录，视频写完且标题文件就绪后自动入队
+            folder_task = asyncio.ensure_future(enqueue_from_folder(queue, args.folder, args.platform,
+                                                                    args.account_name))
+            folder_task.add_done_callback(log_folder_failure)
+        try:
+            await JobRunner().watch(queue, args.platform, args.account_name, workers=args.workers,
+                                    poll_interval=args.poll_interval, stop=stop_on_signals())
+        finally:
+            if folder_task is not None:
+                folder_task.cancel()
+                await asyncio.gather(folder_task, return_exceptions=True)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.argv[1:2] == ['stats']:
+        # 只读取快照，不能用本进程空的 metrics 覆盖它
+        asyncio.run(main())
+    else:
+        # 运行期间定期写出 logs/metrics.json（metrics.dump_interval），退出时再写一次
+        asyncio.run(metrics.export_while(main()))
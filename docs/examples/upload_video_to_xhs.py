@@ -1,12 +1,16 @@
 import configparser
 from pathlib import Path
-from time import sleep
+
+import requests
 
 from xhs import XhsClient
 
 from conf import BASE_DIR
 from utils.files_times import generate_schedule_time_next_day, get_title_and_hashtags
-from uploader.xhs_uploader.main import sign_local, beauty_print
+from uploader.xhs_uploader.main import sign_local, sign, beauty_print, prefetch_signs, topic_sign_items
+from utils.base_social_media import SOCIAL_MEDIA_XHS
+from utils.config_manager import get_config
+from utils.rate_limiter import get_rate_limiter
 
 config = configparser.RawConfigParser()
 config.read(Path(BASE_DIR / "uploader" / "xhs_uploader" / "accounts.ini"))
@@ -21,7 +25,10 @@ if __name__ == '__main__':
     file_num = len(files)
 
     cookies = config['account1']['cookies']
-    xhs_client = XhsClient(cookies, sign=sign_local, timeout=60)
+    # sign_method "server" signs through a running `python cli_main.py xhs-sign-server` (warm pages),
+    # "local" launches a browser for every signature
+    sign_method = get_config().get("platforms.xhs.settings.sign_method", "local")
+    xhs_client = XhsClient(cookies, sign=sign if sign_method == "server" else sign_local, timeout=60)
     # auth cookie
     # Note: This cookie validation method may not be very accurate
     try:
@@ -32,6 +39,7 @@ if __name__ == '__main__':
 
     publish_datetimes = generate_schedule_time_next_day(file_num, 1, daily_times=[16])
 
+    limiter = get_rate_limiter()
     for index, file in enumerate(files):
         title, tags = get_title_and_hashtags(str(file))
         # Add to title to supplement title (xhs can fill 1000 characters, no waste)
@@ -45,6 +53,13 @@ if __name__ == '__main__':
         print(f"Hashtag: {tags}")
 
         topics = []
+        if sign_method == "server":
+            # Sign the topic lookups below in one /sign/batch round-trip instead of one /sign each
+            try:
+                prefetch_signs(topic_sign_items(tags[:3]), xhs_client.cookie_dict.get("a1", ""),
+                               xhs_client.cookie_dict.get("web_session", ""))
+            except requests.RequestException as e:
+                print(f"Sign prefetch failed, signing one by one: {e}")
         # Get hashtag
         for i in tags[:3]:
             topic_official = xhs_client.get_suggest_topic(i)
@@ -57,6 +72,8 @@ if __name__ == '__main__':
 
         hash_tags_str = ' ' + ' '.join(['#' + tag + '[topic]#' for tag in hash_tags])
 
+        # Pace uploads to avoid risk control (upload.upload_interval), only the remaining interval is waited
+        limiter.acquire_blocking(SOCIAL_MEDIA_XHS, 'account1')
         note = xhs_client.create_video_note(title=title[:20], video_path=str(file),
                                             desc=title + tags_str + hash_tags_str,
                                             topics=topics,
@@ -64,5 +81,3 @@ if __name__ == '__main__':
                                             post_time=publish_datetimes[index].strftime("%Y-%m-%d %H:%M:%S"))
 
         beauty_print(note)
-        # Force sleep 30s to avoid risk control (necessary)
-        sleep(30)
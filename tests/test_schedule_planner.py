@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import pytest
+
+from utils.schedule_planner import SchedulePlanner, parse_daily_times
+
+
+class FakeRecords(object):
+    """scheduled_slots() of a RecordStore with a fixed set of booked times"""
+
+    def __init__(self, booked):
+        self.booked = [moment.timestamp() for moment in booked]
+
+    def scheduled_slots(self, platform, account="", since=None):
+        return sorted(timestamp for timestamp in self.booked if timestamp >= (since or 0))
+
+
+def planner(daily_times, per_day=5, start_days=0, now=datetime(2026, 10, 18, 8, 0), records=None):
+    return SchedulePlanner(daily_times=daily_times, per_day=per_day, start_days=start_days, records=records,
+                           now=now)
+
+
+def test_parse_daily_times_accepts_hours_and_strings():
+    assert parse_daily_times([16, "06:30", 11.5, "16:00"]) == [6 * 60 + 30, 11 * 60 + 30, 16 * 60]
+
+
+@pytest.mark.parametrize("daily_times", [[], [24], ["24:00"], ["10:75"], [-1]])
+def test_parse_daily_times_rejects_invalid(daily_times):
+    with pytest.raises(ValueError):
+        parse_daily_times(daily_times)
+
+
+def test_slots_respect_the_daily_cap():
+    slots = planner([9, 12, 18], per_day=2).slots("douyin", "a", 4)
+    assert slots == [datetime(2026, 10, 18, 12, 0), datetime(2026, 10, 18, 18, 0),
+                     datetime(2026, 10, 19, 9, 0), datetime(2026, 10, 19, 12, 0)]
+
+
+def test_slots_respect_the_lead_time():
+    # douyin needs 120 minutes: 09:00 is too early at 08:00, 10:00 is the first slot that qualifies
+    slots = planner([9, 10]).slots("douyin", "a", 2)
+    assert slots == [datetime(2026, 10, 18, 10, 0), datetime(2026, 10, 19, 9, 0)]
+
+
+def test_slots_round_down_to_the_granularity():
+    slots = planner(["16:03", "16:04"]).slots("tiktok", "a", 2)
+    # Both round to 16:00 on tiktok's 5-minute picker and count as one slot per day
+    assert slots == [datetime(2026, 10, 18, 16, 0), datetime(2026, 10, 19, 16, 0)]
+
+
+def test_slot_before_midnight_stays_on_its_day():
+    slots = planner([23.99], per_day=2, now=datetime(2026, 10, 18, 23, 0)).slots("tiktok", "a", 2)
+    assert slots == [datetime(2026, 10, 18, 23, 55), datetime(2026, 10, 19, 23, 55)]
+
+
+def test_slots_skip_booked_times_and_count_them_against_the_cap():
+    records = FakeRecords([datetime(2026, 10, 18, 12, 0)])
+    slots = planner([12, 18, 20], per_day=2, records=records).slots("douyin", "a", 2,
+                                                                     taken=[datetime(2026, 10, 19, 12, 0)])
+    assert slots == [datetime(2026, 10, 18, 18, 0), datetime(2026, 10, 19, 18, 0)]
+
+
+def test_slots_beyond_the_horizon_raise():
+    with pytest.raises(ValueError, match="only 10 of 11"):
+        planner([12], per_day=1).slots("tiktok", "a", 11)
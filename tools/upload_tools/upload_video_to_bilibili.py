@@ -1,30 +1,28 @@
-import json
 import random
-import time
 from pathlib import Path
 
 from uploader.bilibili_uploader.main import read_cookie_json_file, extract_keys_from_json, random_emoji, \
-    BilibiliUploader
+    BilibiliUploader, BilibiliSeriesUploader, split_series
 from conf import BASE_DIR
+from utils.base_social_media import SOCIAL_MEDIA_BILIBILI
 from utils.constant import VideoZoneTypes
 from utils.files_times import generate_schedule_time_next_day, get_title_and_hashtags
+from utils.folder_watcher import FolderWatcher
+from utils.rate_limiter import get_rate_limiter
+from utils.record_store import RecordStore
 
-# 上传记录文件路径，文件名为 bilibili_upload_record.txt
+# 旧的上传记录文件（bilibili_upload_record.txt），启动时导入上传记录库
 bilibili_upload_record_file = Path(__file__).parent / "bilibili_upload_record.txt"
 
 
-def read_upload_record(record_file: Path):
-    """读取上传记录文件，返回已经上传的视频文件名列表"""
-    if record_file.exists():
-        with open(record_file, 'r', encoding='utf-8') as file:
-            return file.read().splitlines()  # 读取每一行文件名
-    return []
+def read_upload_record(record_store: RecordStore, files):
+    """返回 files 中已经上传过的视频（按内容指纹匹配，旧记录按文件名匹配）"""
+    return set(record_store.uploaded_files(SOCIAL_MEDIA_BILIBILI, files, legacy_key=lambda file: file.name))
 
 
-def write_upload_record(record_file: Path, file_name: str):
-    """将新的上传记录追加到记录文件中"""
-    with open(record_file, 'a', encoding='utf-8') as file:
-        file.write(file_name + '\n')
+def write_upload_record(record_store: RecordStore, file: Path):
+    """记录上传成功的视频"""
+    record_store.mark_file_uploaded(SOCIAL_MEDIA_BILIBILI, file)
 
 
 def get_random_title_from_file(title_file: Path) -> str:
@@ -51,8 +49,8 @@ if __name__ == '__main__':
     tid = VideoZoneTypes.SPORTS_FOOTBALL.value  # 设置分区id
     folder_path = Path(filepath)
 
-    # 获取所有视频文件并按创建时间排序
-    files = sorted(folder_path.rglob("*.mp4"), key=lambda x: x.stat().st_ctime)
+    # 获取所有已写完的视频文件，按创建时间排序（增量目录索引，只重新列出有变化的目录）
+    files = FolderWatcher(folder_path, sidecars_ready=lambda file: True).ready_files()
 
     # 从同级目录读取标题文件
     title_file_default = Path(__file__).parent / "bilibili_title.txt"
@@ -60,21 +58,29 @@ if __name__ == '__main__':
     if not title_file_default.exists() or not title_file_p.exists():
         print(f"配置文件不存在")
         exit()
-    # 读取上传记录
-    uploaded_files = read_upload_record(bilibili_upload_record_file)
+    # 读取上传记录（重命名或移动过的视频按内容识别）
+    record_store = RecordStore()
+    record_store.migrate(bilibili_upload_record_file, platform=SOCIAL_MEDIA_BILIBILI)
+    uploaded_files = read_upload_record(record_store, files)
 
     # 设置每次上传的视频数量
     upload_count = 1  # 修改为你想要上传的数量
     uploaded_today = 0
 
-    for file in files:
+    # True：cutvideo.py 切出的 <name>_<n> 片段作为一个多P稿件上传（各P并行传输，只提交一次）
+    upload_as_series = False
+    batches = list(split_series(files).values()) if upload_as_series else [[file] for file in files]
+
+    for batch in batches:
         if uploaded_today >= upload_count:
             break
 
-        # 检查视频文件是否已经上传过
-        if file.name in uploaded_files:
-            print(f"视频 {file.name} 已上传过，跳过此视频。")
+        # 检查视频文件是否已经上传过（多P稿件只上传还没传过的分P）
+        parts = [file for file in batch if file not in uploaded_files]
+        if not parts:
+            print(f"视频 {batch[0].name} 已上传过，跳过此视频。")
             continue
+        file = parts[0]
 
         # 根据文件名选择标题文件
         if file.name.endswith('p.mp4'):
@@ -90,23 +96,28 @@ if __name__ == '__main__':
         tags = ["动物总动员", "可爱", "治愈", "小奶猫", "喵星人", "安静", "解压", "猫咪", "舒缓音乐", "音乐"]
         tags_str = ','.join([tag for tag in tags])
 
-        print(f"视频文件名：{file}")
+        print(f"视频文件名：{', '.join(str(part) for part in parts)}")
         print(f"标题：{title}")
         print(f"Hashtag：{tags_str}")
 
         desc = title  # 这里设置描述与标题相同
         dtime = None  # 不定时上传
 
+        # 按 upload.upload_interval / max_uploads_per_day 限速，只等待剩余的间隔
+        get_rate_limiter().acquire_blocking(SOCIAL_MEDIA_BILIBILI)
+
         # 实例化上传器并上传
-        bili_uploader = BilibiliUploader(cookie_data, file, title, desc, tid, tags, dtime)
+        if len(parts) > 1:
+            bili_uploader = BilibiliSeriesUploader(cookie_data, parts, title, desc, tid, tags, dtime)
+        else:
+            bili_uploader = BilibiliUploader(cookie_data, file, title, desc, tid, tags, dtime)
         upload_success = bili_uploader.upload()
 
         if upload_success:
             # 上传成功后记录该视频文件名
-            write_upload_record(bilibili_upload_record_file, file.name)
-            print(f"视频 {file.name} 上传成功，已记录到上传记录。")
+            for part in parts:
+                write_upload_record(record_store, part)
+            print(f"视频 {bili_uploader.name} 上传成功，已记录到上传记录。")
             uploaded_today += 1  # 增加已上传的视频数量
         else:
-            print(f"视频 {file.name} 上传失败。")
-
-        time.sleep(30)  # 上传完成后休息 30 秒
\ No newline at end of file
+            print(f"视频 {bili_uploader.name} 上传失败。")
\ No newline at end of file
@@ -1,37 +1,38 @@
 import asyncio
-import json
 import random
 from pathlib import Path
 
 from conf import BASE_DIR
 from uploader.douyin_uploader.main import douyin_setup, DouYinVideo
+from utils.browser_pool import browser_pool
 from utils.files_times import generate_schedule_time_next_day, get_title_and_hashtags
+from utils.base_social_media import SOCIAL_MEDIA_DOUYIN
+from utils.folder_watcher import FolderWatcher
+from utils.record_store import get_record_store
+from utils.watchdog import get_watchdog, DeadlineExceeded
 
+# Legacy JSON record, imported into the record store on start
 UPLOAD_RECORD_FILE = Path(BASE_DIR) / "upload_record.json"
 TITLE_FILE_P = Path(BASE_DIR) / "douyin_title_p.txt"
 PICDONE_PATH = Path(r'Y:\sucai\picdone')
 
 
-def load_uploaded_files():
-    """Load the list of uploaded files"""
-    if UPLOAD_RECORD_FILE.exists():
-        with open(UPLOAD_RECORD_FILE, 'r') as f:
-            return json.load(f)
-    return []
+record_store = get_record_store()
+
+
+def load_uploaded_files(files):
+    """Return the subset of files already uploaded"""
+    return record_store.uploaded_files(SOCIAL_MEDIA_DOUYIN, files)
 
 
 def save_uploaded_file(file):
     """Save the uploaded filename"""
-    uploaded_files = load_uploaded_files()
-    uploaded_files.append(str(file))
-    with open(UPLOAD_RECORD_FILE, 'w') as f:
-        json.dump(uploaded_files, f)
+    record_store.mark_file_uploaded(SOCIAL_MEDIA_DOUYIN, file)
 
 
 def is_already_uploaded(file):
     """Check if the file has already been uploaded"""
-    uploaded_files = load_uploaded_files()
-    return str(file) in uploaded_files
+    return bool(load_uploaded_files([file]))
 
 
 def has_corresponding_txt(file):
@@ -58,6 +59,49 @@ def get_random_thumbnail():
     return None
 
 
+async def upload_files(eligible_files, account_file):
+    """Upload all eligible files in one event loop so they share the warm browser pool"""
+    async with browser_pool():
+        await douyin_setup(account_file, handle=False)
+
+        for index, file in enumerate(eligible_files):
+            # Remove file extension
+            file_stem = file.stem
+
+            if file_stem and file_stem[-1].lower() == 'p':  # Check the last character after removing extension
+                print(f"filename contains 'p'：{file.name}")
+                title = get_random_title_p() or "Default Title"  # Get random title from douyin_title_p.txt
+                tags = ['入眠曲', '安静的音乐', '每日吸猫', '萌宠', '失眠']
+                thumbnail_path = get_random_thumbnail()  # Get random cover from Y:\sucai\picdone
+                # Print video filename, title and hashtag
+                print(f"Upload video filename p：{file}")
+                print(f"Title p：{title}")
+                print(f"Hashtag p：{tags}")
+            else:
+                title, tags = get_title_and_hashtags(str(file))  # Normal process to get title and hashtags
+                thumbnail_path = file.with_suffix('.png')
+                # Print video filename, title and hashtag
+                print(f"Upload video filename：{file}")
+                print(f"Title：{title}")
+                print(f"Hashtag：{tags}")
+
+            # Create video upload object
+            if thumbnail_path and thumbnail_path.exists():
+                app = DouYinVideo(title, file, tags, None, account_file, thumbnail_path=thumbnail_path)
+            else:
+                app = DouYinVideo(title, file, tags, None, account_file)
+
+            # Upload video, a stuck page is cancelled by the watchdog (deadlines.* in config.yaml)
+            try:
+                await get_watchdog().run(app.main(), str(file), SOCIAL_MEDIA_DOUYIN)
+            except DeadlineExceeded as e:
+                print(f"Upload of {file.name} timed out: {e}")
+                continue
+
+            # Record after successful upload
+            save_uploaded_file(file)
+
+
 if __name__ == '__main__':
     filepath = r'Y:\sucai\douyin'
     account_file = Path(BASE_DIR / "cookies" / "douyin_uploader" / "account.json")
@@ -67,16 +111,16 @@ if __name__ == '__main__':
 
     # Get video directory
     folder_path = Path(filepath)
-    # Use rglob to recursively get all mp4 files
-    files = list(folder_path.rglob("*.mp4"))
-
-    # Filter eligible files (not uploaded and have corresponding .txt file)
-    eligible_files = [
-        file for file in files
-        if not is_already_uploaded(file) and ( file.stem[-1].lower() == 'p'  or (
-            file.stem[-1].lower() != 'p' and has_corresponding_txt(file))
-        )
-    ]
+    # Incremental catalog of the folder: only changed directories are listed again, and a video is only
+    # returned once it is fully written and has its .txt (videos ending with 'p' need none)
+    watcher = FolderWatcher(folder_path,
+                            sidecars_ready=lambda file: file.stem[-1].lower() == 'p' or has_corresponding_txt(file))
+    files = watcher.ready_files()
+
+    # Filter eligible files (not uploaded yet)
+    record_store.migrate(UPLOAD_RECORD_FILE, platform=SOCIAL_MEDIA_DOUYIN)
+    uploaded_files = set(load_uploaded_files(files))
+    eligible_files = [file for file in files if file not in uploaded_files]
     # Randomly shuffle the list of eligible files
     random.shuffle(eligible_files)
 
@@ -85,39 +129,6 @@ if __name__ == '__main__':
 
     file_num = len(eligible_files)
     # publish_datetimes = generate_schedule_time_next_day(file_num, 3, daily_times=[12])
-    cookie_setup = asyncio.run(douyin_setup(account_file, handle=False))
-
-    for index, file in enumerate(eligible_files):
-        # Remove file extension
-        file_stem = file.stem
-
-        if file_stem and file_stem[-1].lower() == 'p':  # Check the last character after removing extension
-            print(f"filename contains 'p'：{file.name}")
-            title = get_random_title_p() or "Default Title"  # Get random title from douyin_title_p.txt
-            tags = ['入眠曲', '安静的音乐', '每日吸猫', '萌宠', '失眠']
-            thumbnail_path = get_random_thumbnail()  # Get random cover from Y:\sucai\picdone
-            # Print video filename, title and hashtag
-            print(f"Upload video filename p：{file}")
-            print(f"Title p：{title}")
-            print(f"Hashtag p：{tags}")
-        else:
-            title, tags = get_title_and_hashtags(str(file))  # Normal process to get title and hashtags
-            thumbnail_path = file.with_suffix('.png')
-            # Print video filename, title and hashtag
-            print(f"Upload video filename：{file}")
-            print(f"Title：{title}")
-            print(f"Hashtag：{tags}")
-
-        # Create video upload object
-        if thumbnail_path and thumbnail_path.exists():
-            app = DouYinVideo(title, file, tags, None, account_file, thumbnail_path=thumbnail_path)
-        else:
-            app = DouYinVideo(title, file, tags, None, account_file)
-
-        # Upload video
-        asyncio.run(app.main(), debug=False)
-
-        # Record after successful upload
-        save_uploaded_file(file)
+    asyncio.run(upload_files(eligible_files, account_file), debug=False)
 
     print("Processing completed")
@@ -3,6 +3,12 @@ import random
 import psutil  # Used to check file lock status
 from moviepy.editor import VideoFileClip, AudioFileClip
 
+from utils.record_store import RecordStore
+
+# Processing records live in the shared record store; the old list.txt is imported on start
+RECORD_KIND = 'cutvideo'
+record_store = RecordStore()
+
 # Specify source video and target folder paths
 source_folder = r'/volume2/Download/sucai/sleepykitty'
 target_folder = r'/volume2/Download/sucai/douyin'
@@ -33,17 +39,14 @@ def is_file_locked(file_path):
         print(f"Error checking lock status for file {file_path}: {e}")
         return True  # Assume file is locked if exception occurs
 
-# Get processed file list
-def get_processed_files():
-    if os.path.exists(list_file_path):
-        with open(list_file_path, 'r', encoding='utf-8') as f:
-            return set(line.strip() for line in f)
-    return set()
+# Get processed files among the given paths
+def get_processed_files(file_paths):
+    record_store.migrate(list_file_path, kind=RECORD_KIND)
+    return set(record_store.processed_files(RECORD_KIND, file_paths))
 
 # Record processed file
 def record_processed_file(file_path):
-    with open(list_file_path, 'a', encoding='utf-8') as f:
-        f.write(file_path + '\n')
+    record_store.mark_file_processed(RECORD_KIND, file_path)
 
 # Get all video files in the specified folder
 def find_video_files(folder):
@@ -145,11 +148,13 @@ def process_video(video_path):
 music_files = [os.path.join(r'/volume1/homes/VideoMaterial/audiomaterial', f) for f in os.listdir(r'/volume1/homes/VideoMaterial/audiomaterial')
                if f.endswith(('.mp3', '.wav'))]
 
-# Get processed file list
-processed_files = get_processed_files()
-
 # Traverse source directory and process videos
 video_files = find_video_files(source_folder)
+
+# Get processed file list
+processed_files = get_processed_files(
+    [os.path.join(target_folder, os.path.relpath(video_path, source_folder)) for video_path in video_files])
+
 for video_path in video_files:
     relative_path = os.path.join(target_folder, os.path.relpath(video_path, source_folder))
     if relative_path in processed_files:
@@ -0,0 +1,309 @@
+"""
+Line Tuner
+Picks the Bilibili upload line by measured throughput, cached on disk with a TTL, and adapts the number
+of chunks uploaded concurrently to the throughput and errors observed while a long upload runs,
+within a chunk thread and bandwidth budget shared by every transfer in the process
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import aiohttp
+import requests
+
+from conf import BASE_DIR
+from utils.base_social_media import SOCIAL_MEDIA_BILIBILI
+from utils.config_manager import get_config
+from utils.log import bilibili_logger
+from utils.metrics import metrics
+
+PROBE_URL = "https://member.bilibili.com/preupload?r=probe"
+# Attempts per chunk, the same as biliup's own chunk loop
+CHUNK_ATTEMPTS = 10
+
+_cache_lock = threading.Lock()
+_probe_lock = threading.Lock()
+
+
+def _settings(key: str, default):
+    return get_config().get(f"platforms.bilibili.settings.{key}", default)
+
+
+class LineTuner(object):
+    """
+    Throughput of every upload line from Bilibili's probe list, cached per line query in a JSON file.
+    The lines are probed again once the cache is older than line_cache_ttl; the chunk concurrency an upload
+    settled on is stored with its line and is where the next upload on that line starts.
+    """
+
+    def __init__(self, cache_file=None, ttl: Optional[int] = None, probe_kb: Optional[int] = None):
+        self.cache_file = Path(cache_file or
+                               BASE_DIR / _settings("line_cache_file", "data/records/bilibili_lines.json"))
+        self.ttl = _settings("line_cache_ttl", 6 * 3600) if ttl is None else ttl
+        self.probe_bytes = (probe_kb or _settings("line_probe_kb", 1024)) * 1024
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries: Dict[str, Any]):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.cache_file)
+
+    def probe(self) -> Dict[str, Any]:
+        """Time an upload-sized request against every line; lines that fail the probe are left out"""
+        listing = requests.get(PROBE_URL, timeout=5).json()
+        method = 'get' if listing['probe'].get('get') else 'post'
+        payload = bytes(self.probe_bytes) if method == 'post' else None
+        entries = {}
+        for line in listing['lines']:
+            started = time.perf_counter()
+            try:
+                response = requests.request(method, f"https:{line['probe_url']}", data=payload, timeout=30)
+            except requests.RequestException as e:
+                bilibili_logger.warning(f"  [-] line {line['query']} probe failed: {e}")
+                continue
+            cost = time.perf_counter() - started
+            if response.status_code != 200:
+                continue
+            size = self.probe_bytes if payload is not None else len(response.content) or 1
+            entries[line['query']] = {"line": line, "bps": size / cost, "measured_at": time.time()}
+            metrics.set("bilibili_line_bps", round(size / cost), line=line['query'])
+        speeds = ", ".join(f"{query} {entry['bps'] / 1048576:.2f} MB/s" for query, entry in entries.items())
+        bilibili_logger.info(f"  [-] probed {len(entries)} upload line(s): {speeds}")
+        return entries
+
+    def best_line(self) -> Optional[Dict[str, Any]]:
+        """
+        The cached entry of the fastest line, probing when the cache expired. A failed probe falls back to
+        the stale cache, and to None (biliup's own AUTO probe) without one.
+        """
+        with _cache_lock:
+            entries = self._load()
+        now = time.time()
+        expired = not entries or any(now - entry["measured_at"] > self.ttl for entry in entries.values())
+        # Probing takes several requests of up to 30s each: it runs outside the cache lock, and a transfer
+        # starting while another one probes uses the cache as it is
+        if expired and _probe_lock.acquire(blocking=False):
+            try:
+                probed = self.probe()
+            except (requests.RequestException, ValueError, KeyError) as e:
+                bilibili_logger.warning(f"  [-] upload line probe failed, using cached lines: {e}")
+                probed = {}
+            finally:
+                _probe_lock.release()
+            if probed:
+                with _cache_lock:
+                    # Keep the concurrency each line settled on, it outlives the throughput figure
+                    previous = self._load()
+                    for query, entry in probed.items():
+                        if "threads" in previous.get(query, {}):
+                            entry["threads"] = previous[query]["threads"]
+                    entries = probed
+                    self._save(entries)
+        if not entries:
+            return None
+        return max(entries.values(), key=lambda entry: entry["bps"])
+
+    def report(self, line: Dict[str, Any], threads: int, bps: float):
+        """Store the concurrency an upload on `line` settled on and the throughput it got"""
+        with _cache_lock:
+            entries = self._load()
+            entry = entries.setdefault(line['query'], {"line": line, "bps": bps, "measured_at": time.time()})
+            entry["threads"] = threads
+            entry["upload_bps"] = bps
+            self._save(entries)
+
+
+class UploadBudget(object):
+    """
+    Chunk threads and bandwidth shared by all Bilibili transfers of the process, e.g. the parts of a
+    series uploading in parallel: each running transfer gets an equal share of total_threads, and every
+    chunk reserves its bytes on one bandwidth_mbps clock (0 = unlimited). Thread-safe, as every
+    transfer runs biliup's own event loop on its own thread.
+    """
+
+    def __init__(self, total_threads: Optional[int] = None, bandwidth_mbps: Optional[float] = None):
+        self.total_threads = total_threads or _settings("total_threads", 12)
+        mbps = _settings("bandwidth_mbps", 0) if bandwidth_mbps is None else bandwidth_mbps
+        self.bytes_per_second = mbps * 1000 * 1000 / 8
+        self._lock = threading.Lock()
+        self._active = 0
+        self._next_free = 0.0
+
+    def register(self):
+        with self._lock:
+            self._active += 1
+
+    def unregister(self):
+        with self._lock:
+            self._active -= 1
+
+    def share(self) -> int:
+        return max(1, self.total_threads // max(1, self._active))
+
+    def reserve(self, size: int) -> float:
+        """Seconds to wait before sending `size` bytes"""
+        if not self.bytes_per_second:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_free)
+            self._next_free = start + size / self.bytes_per_second
+            return start - now
+
+
+_budget: Optional[UploadBudget] = None
+
+
+def get_upload_budget() -> UploadBudget:
+    global _budget
+    if _budget is None:
+        _budget = UploadBudget()
+    return _budget
+
+
+class ChunkConcurrency(object):
+    """
+    Hill-climbing limit on concurrent chunk uploads: every `window` seconds the limit moves one step in the
+    current direction, and turns around when throughput dropped by more than `tolerance` against the
+    previous window. A chunk that needed a retry halves the limit instead, at most once per window.
+    The chunks actually running are also capped by the transfer's share of the UploadBudget.
+    """
+
+    def __init__(self, start: int, minimum: Optional[int] = None, maximum: Optional[int] = None,
+                 window: Optional[float] = None, tolerance: float = 0.05, budget: Optional[UploadBudget] = None,
+                 name: str = ""):
+        self.budget = budget or get_upload_budget()
+        self.name = name
+        self.minimum = minimum or _settings("min_threads", 1)
+        self.maximum = maximum or _settings("max_threads", 8)
+        self.window = window or _settings("threads_window", 15)
+        self.tolerance = tolerance
+        self.limit = max(self.minimum, min(self.maximum, start))
+        self.direction = 1
+        self.sent_bytes = 0
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._window_started = time.monotonic()
+        self._previous_bps: Optional[float] = None
+        self._started = self._window_started
+        self._last_cut = 0.0
+
+    @property
+    def average_bps(self) -> float:
+        elapsed = time.monotonic() - self._started
+        return self.sent_bytes / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def running_limit(self) -> int:
+        return min(self.limit, self.budget.share())
+
+    def on_chunk(self, size: int):
+        self.sent_bytes += size
+        self._window_bytes += size
+        self._adjust()
+
+    def on_error(self):
+        self._window_errors += 1
+        self._adjust()
+
+    def _set(self, limit: int, reason: str):
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit != self.limit:
+            bilibili_logger.info(f"  [-] chunk threads {self.limit} -> {limit} ({reason})")
+            self.limit = limit
+        metrics.set("bilibili_upload_threads", self.limit, file=self.name)
+
+    def _adjust(self):
+        now = time.monotonic()
+        elapsed = now - self._window_started
+        if self._window_errors and now - self._last_cut < self.window:
+            # Retries of chunks that were already in flight when the limit was cut last
+            self._window_errors = 0
+            return
+        if self._window_errors:
+            self._set(self.limit // 2, f"{self._window_errors} chunk retries")
+            self.direction = 1
+            self._previous_bps = None
+            self._last_cut = now
+        elif elapsed >= self.window:
+            bps = self._window_bytes / elapsed
+            if self._previous_bps is not None and bps < self._previous_bps * (1 - self.tolerance):
+                self.direction = -self.direction
+            self._previous_bps = bps
+            self._set(self.limit + self.direction, f"{bps / 1048576:.2f} MB/s")
+            # From the floor the only way to learn anything is up
+            if self.limit == self.minimum:
+                self.direction = 1
+        else:
+            return
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._window_started = now
+
+    async def upload(self, params, file, chunk_size, afunc, tasks=3):
+        """
+        Drop-in for biliup's BiliBili._upload chunk loop, calling afunc(session, chunk, params) on one
+        aiohttp session like biliup does: `maximum` workers share the file, and only the first
+        `running_limit` of them take chunks, so the limit can change while the upload runs. `tasks` is ignored.
+        """
+        params['chunk'] = -1
+        finished = asyncio.Event()
+
+        async def upload_chunk(session, index: int):
+            while not finished.is_set():
+                if index >= self.running_limit:
+                    await asyncio.sleep(0.5)
+                    continue
+                chunks_data = file.read(chunk_size)
+                if not chunks_data:
+                    finished.set()
+                    return
+                params['chunk'] += 1
+                params['size'] = len(chunks_data)
+                params['partNumber'] = params['chunk'] + 1
+                params['start'] = params['chunk'] * chunk_size
+                params['end'] = params['start'] + params['size']
+                clone = params.copy()
+                for attempt in range(CHUNK_ATTEMPTS):
+                    delay = self.budget.reserve(len(chunks_data))
+                    if delay:
+                        await asyncio.sleep(delay)
+                    try:
+                        await afunc(session, chunks_data, clone)
+                        break
+                    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                        metrics.inc("upload_chunk_failures", platform=SOCIAL_MEDIA_BILIBILI)
+                        bilibili_logger.warning(f"  [-] chunk {clone['chunk']} retry {attempt + 1}: {e}")
+                        self.on_error()
+                        if attempt + 1 == CHUNK_ATTEMPTS:
+                            raise
+                self.on_chunk(len(chunks_data))
+
+        self.budget.register()
+        try:
+            async with aiohttp.ClientSession() as session:
+                workers = [asyncio.ensure_future(upload_chunk(session, index)) for index in range(self.maximum)]
+                try:
+                    await asyncio.gather(*workers)
+                except BaseException:
+                    # One failed (or the upload was cancelled): stop the others reading and sending the file
+                    finished.set()
+                    for worker in workers:
+                        worker.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+                    raise
+        finally:
+            self.budget.unregister()
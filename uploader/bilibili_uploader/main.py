@@ -1,9 +1,34 @@
+import asyncio
+import contextvars
 import json
+import os
 import pathlib
 import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
 from biliup.plugins.bili_webup import BiliBili, Data
 
+from uploader.bilibili_uploader.line_tuner import ChunkConcurrency, LineTuner
+from utils.base_social_media import SOCIAL_MEDIA_BILIBILI
+from utils.config_manager import get_config
 from utils.log import bilibili_logger
+from utils.metrics import metrics
+from utils.upload_progress import ProgressCallback, UploadProgress
+from utils.watchdog import heartbeat
+
+STAGE_LOGIN = "login"
+STAGE_TRANSFER = "uploaded"  # same names as the checkpoint steps, so the watchdog applies their deadlines
+STAGE_SUBMIT = "published"
+# biliup methods that stream the file to one of its upload backends, each taking the open file first
+UPLOAD_BACKENDS = ("upos", "kodo", "cos", "cos_internal")
+# Clip names written by cutvideo.py: <video name>_<clip number>
+PART_NAME = re.compile(r"^(.*)_(\d+)$")
+
+_executor: Optional[ThreadPoolExecutor] = None
 
 
 def extract_keys_from_json(data):
@@ -39,11 +64,57 @@ def random_emoji():
     return random.choice(emoji_list)
 
 
+def upload_executor() -> ThreadPoolExecutor:
+    """
+    Process-wide pool for the blocking biliup transfers, bounded by platforms.bilibili.settings.upload_workers.
+    upload_file() runs its own asyncio.run(), so it can only run on a thread without an event loop.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=get_config().get("platforms.bilibili.settings.upload_workers", 2),
+                                       thread_name_prefix="bilibili-upload")
+    return _executor
+
+
+async def bilibili_setup(account_file, handle=False, launch_options=None, keep_session=False):
+    """Bilibili uploads through biliup's web API without a browser, so setup only checks the cookie file"""
+    try:
+        extract_keys_from_json(read_cookie_json_file(pathlib.Path(account_file)))
+        return True
+    except (OSError, ValueError, KeyError) as e:
+        bilibili_logger.error(f'[-] cookie file {account_file} unusable ({type(e).__name__}), '
+                              f'create it with `biliup login`')
+        return False
+
+
+class UploadCancelled(Exception):
+    """Raised inside the transfer thread once the awaiting task was cancelled"""
+
+
+class CountingReader(object):
+    """Wraps the file biliup reads its chunks from and reports every read"""
+
+    def __init__(self, file, on_read):
+        self._file = file
+        self._on_read = on_read
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._on_read(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
 class BilibiliUploader(object):
-    def __init__(self, cookie_data, file: pathlib.Path, title, desc, tid, tags, dtime):
-        self.upload_thread_num = 3
+    def __init__(self, cookie_data, file: pathlib.Path, title, desc, tid, tags, dtime,
+                 progress_callback: Optional[ProgressCallback] = None):
+        settings = get_config().get("platforms.bilibili.settings", {}) or {}
+        self.upload_thread_num = settings.get("upload_threads", 3)
         self.copyright = 1
-        self.lines = 'AUTO'
+        self.lines = settings.get("lines", 'AUTO')
+        self.adaptive_threads = settings.get("adaptive_threads", True)
         self.cookie_data = cookie_data
         self.file = file
         self.title = title
@@ -51,6 +122,20 @@ class BilibiliUploader(object):
         self.tid = tid
         self.tags = tags
         self.dtime = dtime
+        self.progress_callback = progress_callback
+        self.log_interval = get_config().get("upload.progress.log_interval", 10)
+        self.diagnostics = []
+        self.stage = None
+        self.sent_bytes = 0
+        self.total_bytes = 0
+        self._started = 0.0
+        self._last_report = 0.0
+        self._last_log = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._context: Optional[contextvars.Context] = None
+        self._cancelled = threading.Event()
+        self._progress_lock = threading.Lock()
+        self.name = file.name
         self._init_data()
 
     def _init_data(self):
@@ -62,18 +147,200 @@ class BilibiliUploader(object):
         self.data.set_tag(self.tags)
         self.data.dtime = self.dtime
 
+    def launch_options(self):
+        return {}
+
+    def _call_on_loop(self, callback, *args):
+        """Run a callback on the awaiting loop, in the awaiting task's context; directly when called synchronously"""
+        loop = self._loop
+        if loop is None:
+            callback(*args)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(callback, *args, context=self._context)
+
+    def _enter(self, stage: str):
+        self.stage = stage
+        bilibili_logger.info(f'  [-] {self.name}: {stage}')
+        self._call_on_loop(heartbeat, stage)
+
+    def _on_read(self, size: int):
+        if self._cancelled.is_set():
+            raise UploadCancelled(f'{self.name} upload cancelled')
+        with self._progress_lock:
+            self.sent_bytes += size
+        now = time.monotonic()
+        if now - self._last_report >= 1 or self.sent_bytes >= self.total_bytes:
+            self._last_report = now
+            self._call_on_loop(self._publish, self.progress())
+
+    def progress(self) -> UploadProgress:
+        elapsed = time.monotonic() - self._started
+        average = self.sent_bytes / elapsed if elapsed > 0 else 0.0
+        return UploadProgress(self.name, self.total_bytes, self.sent_bytes, 0, elapsed, average, average)
+
+    def _publish(self, progress: UploadProgress):
+        metrics.set("upload_sent_bytes", progress.sent_bytes, platform=SOCIAL_MEDIA_BILIBILI, file=progress.file_name)
+        metrics.set("upload_throughput_bps", progress.average_bps, platform=SOCIAL_MEDIA_BILIBILI,
+                    file=progress.file_name)
+        if time.monotonic() - self._last_log >= self.log_interval:
+            self._last_log = time.monotonic()
+            bilibili_logger.info(f'  [-] uploading {progress}')
+        if self.progress_callback is not None:
+            try:
+                self.progress_callback(progress)
+            except Exception as e:
+                bilibili_logger.warning(f'  [-] upload progress callback failed: {e}')
+
+    def _count_reads(self, bili):
+        """Hand biliup's backends a counting wrapper of the file, whichever line it picks"""
+        def wrap(method):
+            async def counted(file, *args, **kwargs):
+                return await method(CountingReader(file, self._on_read), *args, **kwargs)
+            return counted
+
+        for name in UPLOAD_BACKENDS:
+            method = getattr(bili, name, None)
+            if method is not None:
+                setattr(bili, name, wrap(method))
+
+    def _tune(self, bili, file: pathlib.Path):
+        """
+        With lines AUTO, preselect the fastest line from the line cache instead of biliup probing on every
+        upload, and replace biliup's fixed chunk workers with a limit tuned while the upload runs
+        """
+        tuner, line = LineTuner(), None
+        if self.lines == 'AUTO':
+            try:
+                line = tuner.best_line()
+            except OSError as e:
+                bilibili_logger.warning(f'  [-] upload line cache unusable: {e}')
+            if line is not None:
+                bili._auto_os = dict(line["line"])
+        concurrency = None
+        if self.adaptive_threads:
+            start = line.get("threads", self.upload_thread_num) if line is not None else self.upload_thread_num
+            concurrency = ChunkConcurrency(start, name=file.name)
+            bili._upload = concurrency.upload
+        return tuner, line, concurrency
+
+    def _login(self, bili):
+        bili.login_by_cookies(self.cookie_data)
+        bili.access_token = self.cookie_data.get('access_token')
+
+    def _transfer(self, bili, file: pathlib.Path) -> dict:
+        """Upload one file's chunks on a logged-in session and return its video part"""
+        self._count_reads(bili)
+        tuner, line, concurrency = self._tune(bili, file)
+        video_part = bili.upload_file(str(file), lines=self.lines,
+                                      tasks=self.upload_thread_num)  # Upload video, default line AUTO auto-select, thread count 3.
+        if line is not None and concurrency is not None and concurrency.sent_bytes:
+            try:
+                tuner.report(line["line"], concurrency.limit, concurrency.average_bps)
+            except OSError as e:
+                bilibili_logger.warning(f'  [-] upload line cache not updated: {e}')
+        metrics.inc("upload_files_total", platform=SOCIAL_MEDIA_BILIBILI)
+        return video_part
+
+    def _submit(self, bili) -> bool:
+        self._call_on_loop(self._publish, self.progress())
+        metrics.inc("upload_bytes_total", self.sent_bytes, platform=SOCIAL_MEDIA_BILIBILI)
+        self._enter(STAGE_SUBMIT)
+        ret = bili.submit()  # Submit video
+        if ret.get('code') == 0:
+            bilibili_logger.success(f'[+] {self.name} upload successful')
+            return True
+        else:
+            bilibili_logger.error(f'[-] {self.name} upload failed, error message: {ret.get("message")}')
+            return False
+
+    def _start(self, files):
+        self.sent_bytes = 0
+        self.total_bytes = sum(os.path.getsize(file) for file in files)
+        self._started = self._last_log = time.monotonic()
+
     def upload(self):
+        """Blocking upload and submit; main() runs it on the upload pool for async callers"""
         with BiliBili(self.data) as bili:
-            bili.login_by_cookies(self.cookie_data)
-            bili.access_token = self.cookie_data.get('access_token')
-            video_part = bili.upload_file(str(self.file), lines=self.lines,
-                                          tasks=self.upload_thread_num)  # Upload video, default line AUTO auto-select, thread count 3.
+            self._enter(STAGE_LOGIN)
+            self._login(bili)
+            self._enter(STAGE_TRANSFER)
+            self._start([self.file])
+            video_part = self._transfer(bili, self.file)
             video_part['title'] = self.title
             self.data.append(video_part)
-            ret = bili.submit()  # Submit video
-            if ret.get('code') == 0:
-                bilibili_logger.success(f'[+] {self.file.name} upload successful')
-                return True
-            else:
-                bilibili_logger.error(f'[-] {self.file.name} upload failed, error message: {ret.get("message")}')
-                return False
+            return self._submit(bili)
+
+    async def main(self, session=None) -> bool:
+        """
+        Upload without blocking the event loop, so Bilibili uploads run next to the browser uploaders.
+        Progress callbacks and watchdog heartbeats are delivered on the loop. A cancelled upload stops
+        at the next chunk its transfer thread reads; a submit Bilibili rejects raises RuntimeError.
+        `session` is unused, there is no browser.
+        """
+        self._loop = asyncio.get_event_loop()
+        self._context = contextvars.copy_context()
+        self._cancelled.clear()
+        try:
+            result = await self._loop.run_in_executor(upload_executor(), self.upload)
+        except asyncio.CancelledError:
+            self._cancelled.set()
+            raise
+        if not result:
+            raise RuntimeError(f'{self.name} rejected by bilibili')
+        return result
+
+
+class BilibiliSeriesUploader(BilibiliUploader):
+    """
+    One submission with several parts (P1, P2, ...), e.g. the clips cutvideo.py split a recording into.
+    The parts transfer in parallel, each on its own session with its own tuned chunk threads, all within
+    the process-wide UploadBudget; the series is submitted once, so there is one risk-control review
+    instead of one per part.
+    """
+
+    def __init__(self, cookie_data, files: List[pathlib.Path], title, desc, tid, tags, dtime,
+                 part_titles: Optional[List[str]] = None, progress_callback: Optional[ProgressCallback] = None):
+        if not files:
+            raise ValueError("a series needs at least one part")
+        self.files = [pathlib.Path(file) for file in files]
+        super().__init__(cookie_data, self.files[0], title, desc, tid, tags, dtime, progress_callback)
+        self.part_titles = part_titles or [file.stem for file in self.files]
+        self.parallel_parts = get_config().get("platforms.bilibili.settings.parallel_parts", 3)
+        if len(self.files) > 1:
+            self.name = f'{self.files[0].name} (+{len(self.files) - 1} parts)'
+
+    def _transfer_part(self, file: pathlib.Path, title: str) -> dict:
+        try:
+            with BiliBili(Data()) as bili:
+                self._login(bili)
+                video_part = self._transfer(bili, file)
+        except Exception:
+            # Stop the other parts at their next chunk, the series cannot be submitted anyway
+            self._cancelled.set()
+            raise
+        video_part['title'] = title
+        bilibili_logger.info(f'  [-] part {file.name} transferred')
+        return video_part
+
+    def upload(self):
+        with BiliBili(self.data) as bili:
+            self._enter(STAGE_LOGIN)
+            self._login(bili)
+            self._enter(STAGE_TRANSFER)
+            self._start(self.files)
+            workers = max(1, min(self.parallel_parts, len(self.files)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bilibili-part") as parts:
+                video_parts = list(parts.map(self._transfer_part, self.files, self.part_titles))
+            for video_part in video_parts:
+                self.data.append(video_part)
+            return self._submit(bili)
+
+
+def split_series(files) -> Dict[str, List[pathlib.Path]]:
+    """Group clips named like cutvideo.py's output (<name>_<n>.<ext>) into series ordered by n"""
+    series: Dict[str, List[Tuple[int, pathlib.Path]]] = {}
+    for file in map(pathlib.Path, files):
+        match = PART_NAME.match(file.stem)
+        name, number = (match.group(1), int(match.group(2))) if match else (file.stem, 0)
+        series.setdefault(str(file.parent / name), []).append((number, file))
+    return {name: [file for _, file in sorted(parts)] for name, parts in series.items()}
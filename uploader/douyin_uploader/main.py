@@ -1,48 +1,78 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 
-from playwright.async_api import Playwright, async_playwright, Page
-import os
+from playwright.async_api import async_playwright, Page
 import asyncio
 
-from conf import LOCAL_CHROME_PATH
-from utils.base_social_media import set_init_script
+from utils.base_social_media import set_init_script, get_browser_executable_path, get_browser_launch_options, \
+    SOCIAL_MEDIA_DOUYIN
+from utils.browser_pool import browser_pool, BrowserLease
+from utils.checkpoints import UploadCheckpoint, STEP_UPLOADED, STEP_FORM_FILLED, STEP_PUBLISHED, STEP_COOKIE_SAVED
+from utils.cookie_cache import offline_cookie_check, remember_cookie_check
+from utils.diagnostics import capture_on_failure
 from utils.log import douyin_logger
-
-
-async def cookie_auth(account_file):
-    async with async_playwright() as playwright:
-        browser = await playwright.chromium.launch(headless=True)
-        context = await browser.new_context(storage_state=account_file)
-        context = await set_init_script(context)
-        # 创建一个新的页面
-        page = await context.new_page()
-        # 访问指定的 URL
-        await page.goto("https://creator.douyin.com/creator-micro/content/upload")
+from utils.page_events import wait_for_first
+from utils.request_filter import images_allowed
+from utils.upload_progress import UploadProgressTracker
+
+UPLOAD_URL = "https://creator.douyin.com/creator-micro/content/upload"
+
+
+async def cookie_auth(account_file, launch_options=None, keep_session=False):
+    """
+    校验 cookie 是否有效
+    keep_session=True 时返回停留在上传页的 BrowserLease，上传可直接复用（需处于外层 browser_pool() 中）；
+    cookie 有效但没有保留会话时返回 True
+    """
+    # 先离线检查 cookie 文件，已过期直接失败，TTL 内校验过的跳过浏览器探测
+    verified = offline_cookie_check(account_file, SOCIAL_MEDIA_DOUYIN)
+    if verified is False or (verified and not keep_session):
+        return verified
+    async with browser_pool() as pool:
+        lease = await pool.lease(launch_options or get_browser_launch_options(headless=True), SOCIAL_MEDIA_DOUYIN, storage_state=account_file)
         try:
-            await page.wait_for_url("https://creator.douyin.com/creator-micro/content/upload", timeout=5000)
-        except:
-            print("[+] 等待5秒 cookie 失效")
-            await context.close()
-            await browser.close()
-            return False
-        # 2024.06.17 抖音创作者中心改版
-        if await page.get_by_text('手机号登录').count():
-            print("[+] 等待5秒 cookie 失效")
-            return False
-        else:
-            print("[+] cookie 有效")
-            return True
-
-
-async def douyin_setup(account_file, handle=False):
-    if not os.path.exists(account_file) or not await cookie_auth(account_file):
+            # 创建一个新的页面
+            page = await lease.context.new_page()
+            # 访问指定的 URL
+            await page.goto(UPLOAD_URL)
+            if verified:
+                return await lease.hand_over(page, keep_session) or True
+            try:
+                await page.wait_for_url(UPLOAD_URL, timeout=5000)
+            except:
+                print("[+] 等待5秒 cookie 失效")
+                remember_cookie_check(account_file, False)
+                await lease.release()
+                return False
+            # 2024.06.17 抖音创作者中心改版
+            if await page.get_by_text('手机号登录').count():
+                print("[+] 等待5秒 cookie 失效")
+                remember_cookie_check(account_file, False)
+                await lease.release()
+                return False
+            else:
+                print("[+] cookie 有效")
+                remember_cookie_check(account_file, True)
+                return await lease.hand_over(page, keep_session) or True
+        except Exception:
+            await lease.release()
+            raise
+
+
+async def douyin_setup(account_file, handle=False, launch_options=None, keep_session=False):
+    """
+    keep_session=True 且 cookie 有效时返回已校验的 BrowserLease，传给 DouYinVideo.main(session=...) 复用
+    launch_options 应与上传使用的启动参数一致，这样校验用的浏览器就是上传用的浏览器
+    """
+    session = await cookie_auth(account_file, launch_options, keep_session)
+    if not session:
         if not handle:
             # Todo alert message
             return False
         douyin_logger.info('[+] cookie文件不存在或已失效，即将自动打开浏览器，请扫码登录，登陆后会自动生成cookie文件')
         await douyin_cookie_gen(account_file)
-    return True
+        return True
+    return session
 
 
 async def douyin_cookie_gen(account_file):
@@ -64,7 +94,8 @@ async def douyin_cookie_gen(account_file):
 
 
 class DouYinVideo(object):
-    def __init__(self, title, file_path, tags, publish_date: datetime, account_file, thumbnail_path=None):
+    def __init__(self, title, file_path, tags, publish_date: datetime, account_file, thumbnail_path=None,
+                 progress_callback=None):
         self.title = title  # 视频标题
         self.file_path = file_path
         self.tags = tags
@@ -72,8 +103,12 @@ class DouYinVideo(object):
         self.publish_date = None
         self.account_file = account_file
         self.date_format = '%Y年%m月%d日 %H:%M'
-        self.local_executable_path = LOCAL_CHROME_PATH
+        self.local_executable_path = get_browser_executable_path()
         self.thumbnail_path = thumbnail_path
+        self.progress_callback = progress_callback  # 上传字节进度回调，参数为 UploadProgress
+        self.diagnostics = []  # 失败时保存的截图/trace 路径，随任务记录
+        self.checkpoint = None  # 已完成的上传步骤，main() 中按视频内容和账号加载
+        self.thumbnail_done = False
 
     async def set_schedule_time_douyin(self, page, publish_date):
         if publish_date is None:
@@ -99,24 +134,45 @@ class DouYinVideo(object):
         douyin_logger.info('视频出错了，重新上传中')
         await page.locator('div.progress-div [class^="upload-btn-input"]').set_input_files(self.file_path)
 
-    async def upload(self, playwright: Playwright) -> None:
-        # 使用 Chromium 浏览器启动一个浏览器实例
-        if self.local_executable_path:
-            browser = await playwright.chromium.launch(headless=False, executable_path=self.local_executable_path)
-        else:
-            browser = await playwright.chromium.launch(headless=False)
-        # 创建一个浏览器上下文，使用指定的 cookie 文件
-        context = await browser.new_context(storage_state=f"{self.account_file}")
-        context = await set_init_script(context)
-
-        # 创建一个新的页面
-        page = await context.new_page()
-        # 访问指定的 URL
-        await page.goto("https://creator.douyin.com/creator-micro/content/upload")
+    async def wait_upload_complete(self, page: Page):
+        # 由页面 DOM 事件驱动：出现“重新上传”即上传完毕，出现“上传失败”则重传后继续等待
+        done_locator = page.locator('div label+div:has-text("重新上传")').first
+        failed_locator = page.locator('div.progress-div > div:has-text("上传失败")').first
+        douyin_logger.info("  [-] 正在上传视频中...")
+        while True:
+            event = await wait_for_first({
+                'done': done_locator.wait_for(state='attached', timeout=0),
+                'failed': failed_locator.wait_for(state='attached', timeout=0),
+            })
+            if event == 'done':
+                douyin_logger.success("  [-]视频上传完毕")
+                return
+            douyin_logger.error("  [-] 发现上传出错了... 准备重试")
+            await self.handle_upload_error(page)
+            # 等失败提示消失后再继续监听，避免对同一个提示重复重传
+            event = await wait_for_first({
+                'done': done_locator.wait_for(state='attached', timeout=0),
+                'cleared': failed_locator.wait_for(state='detached', timeout=0),
+            })
+            if event == 'done':
+                douyin_logger.success("  [-]视频上传完毕")
+                return
+
+    def launch_options(self) -> dict:
+        # 启动参数来自 ConfigManager：headless、浏览器路径、低内存参数和 /dev/shm 策略
+        return get_browser_launch_options(executable_path=self.local_executable_path)
+
+    async def upload(self, page: Page) -> None:
+        # 访问指定的 URL，复用 cookie 校验会话时页面已经在上传页
+        if not page.url.startswith(UPLOAD_URL):
+            await page.goto(UPLOAD_URL)
         douyin_logger.info(f'[+]正在上传-------{self.title}.mp4')
         # 等待页面跳转到指定的 URL，没进入，则自动等待到超时
         douyin_logger.info(f'[-] 正在打开主页...')
-        await page.wait_for_url("https://creator.douyin.com/creator-micro/content/upload")
+        await page.wait_for_url(UPLOAD_URL)
+        # 监听分片上传请求，统计已发送字节、吞吐和剩余时间
+        progress = UploadProgressTracker(page, self.file_path, SOCIAL_MEDIA_DOUYIN, self.progress_callback,
+                                         douyin_logger).start()
         # 点击 "上传视频" 按钮
         await page.locator("div[class^='container'] input").set_input_files(self.file_path)
 
@@ -131,6 +187,20 @@ class DouYinVideo(object):
                 douyin_logger.info(f'  [-] 正在等待进入视频发布页面...')
                 await asyncio.sleep(0.1)
 
+        # 表单输入不可重复执行，失败不在页面上重试
+        await self.checkpoint.step(STEP_FORM_FILLED, lambda: self.fill_form(page), retries=0)
+
+        self.checkpoint.begin(STEP_UPLOADED)
+        await self.wait_upload_complete(page)
+        await progress.stop()
+        self.checkpoint.mark(STEP_UPLOADED)
+
+        # 后续步骤失败时在当前页面上重试，不重新传输视频
+        await self.checkpoint.step(STEP_PUBLISHED, lambda: self.publish(page))
+        await self.checkpoint.step(STEP_COOKIE_SAVED, lambda: self.save_cookie(page))
+        await asyncio.sleep(2)  # 这里延迟是为了方便眼睛直观的观看
+
+    async def fill_form(self, page: Page):
         # 填充标题和话题
         # 检查是否存在包含输入框的元素
         # 这里为了避免页面变化，故使用相对位置定位：作品标题父级右侧第一个元素的input子元素
@@ -168,27 +238,11 @@ class DouYinVideo(object):
         else:
             douyin_logger.info("[-] 没有设置定时发布时间，视频将立即发布。")
 
-        while True:
-            # 判断重新上传按钮是否存在，如果不存在，代表视频正在上传，则等待
-            try:
-                #  新版：定位重新上传
-                number = await page.locator('div label+div:has-text("重新上传")').count()
-                if number > 0:
-                    douyin_logger.success("  [-]视频上传完毕")
-                    break
-                else:
-                    douyin_logger.info("  [-] 正在上传视频中...")
-                    await asyncio.sleep(2)
-
-                    if await page.locator('div.progress-div > div:has-text("上传失败")').count():
-                        douyin_logger.error("  [-] 发现上传出错了... 准备重试")
-                        await self.handle_upload_error(page)
-            except:
-                douyin_logger.info("  [-] 正在上传视频中...")
-                await asyncio.sleep(2)
-
-        # 上传视频封面
-        await self.set_thumbnail(page, self.thumbnail_path)
+    async def publish(self, page: Page):
+        # 上传视频封面，重试发布时不再重复上传
+        if not self.thumbnail_done:
+            await self.set_thumbnail(page, self.thumbnail_path)
+            self.thumbnail_done = True
 
         # 更换可见元素
         # await self.set_location(page, "杭州市")
@@ -204,7 +258,8 @@ class DouYinVideo(object):
         if self.publish_date != 0:
             await self.set_schedule_time_douyin(page, self.publish_date)
 
-        # 判断视频是否发布成功
+        # 判断视频是否发布成功，超时后抛出异常，由 checkpoint 重试
+        deadline = self.checkpoint.attempt_deadline()
         while True:
             # 判断视频是否发布成功
             try:
@@ -215,28 +270,28 @@ class DouYinVideo(object):
                                         timeout=3000)  # 如果自动跳转到作品页面，则代表发布成功
                 douyin_logger.success("  [-]视频发布成功")
                 break
-            except:
+            except Exception as e:
+                self.checkpoint.raise_if_expired(deadline, e)
                 douyin_logger.info("  [-] 视频正在发布中...")
-                await page.screenshot(full_page=True)
                 await asyncio.sleep(0.5)
 
-        await context.storage_state(path=self.account_file)  # 保存cookie
+    async def save_cookie(self, page: Page):
+        await page.context.storage_state(path=self.account_file)  # 保存cookie
+        remember_cookie_check(self.account_file, True)
         douyin_logger.success('  [-]cookie更新完毕！')
-        await asyncio.sleep(2)  # 这里延迟是为了方便眼睛直观的观看
-        # 关闭浏览器上下文和浏览器实例
-        await context.close()
-        await browser.close()
 
     async def set_thumbnail(self, page: Page, thumbnail_path: str):
         if thumbnail_path:
-            await page.click('text="选择封面"')
-            await page.wait_for_selector("div.semi-modal-content:visible")
-            await page.click('text="上传封面"')
-            # 定位到上传区域并点击
-            await page.locator("div[class^='semi-upload upload'] >> input.semi-upload-hidden-input").set_input_files(
-                thumbnail_path)
-            await page.wait_for_timeout(2000)  # 等待2秒
-            await page.locator("div[class^='uploadCrop'] button:has-text('完成')").click()
+            # 裁剪封面的弹窗要显示图片，期间不拦截图片请求
+            with images_allowed(page.context):
+                await page.click('text="选择封面"')
+                await page.wait_for_selector("div.semi-modal-content:visible")
+                await page.click('text="上传封面"')
+                # 定位到上传区域并点击
+                await page.locator("div[class^='semi-upload upload'] >> input.semi-upload-hidden-input").set_input_files(
+                    thumbnail_path)
+                await page.wait_for_timeout(2000)  # 等待2秒
+                await page.locator("div[class^='uploadCrop'] button:has-text('完成')").click()
 
     async def set_location(self, page: Page, location: str = "杭州市"):
         # todo supoort location later
@@ -249,8 +304,26 @@ class DouYinVideo(object):
         await page.wait_for_selector('div[role="listbox"] [role="option"]', timeout=5000)
         await page.locator('div[role="listbox"] [role="option"]').first.click()
 
-    async def main(self):
-        async with async_playwright() as playwright:
-            await self.upload(playwright)
+    async def main(self, session=None):
+        # 上次运行已发布的视频不再发布（进程在发布后、记录前退出的情况）
+        self.checkpoint = await UploadCheckpoint.create(SOCIAL_MEDIA_DOUYIN, self.account_file, self.file_path,
+                                                        douyin_logger)
+        if await self.checkpoint.resume_published(session if isinstance(session, BrowserLease) else None):
+            return
+        # 复用 douyin_setup(keep_session=True) 返回的已校验会话，省去一次浏览器启动和页面加载
+        if isinstance(session, BrowserLease):
+            try:
+                async with capture_on_failure(session.page, SOCIAL_MEDIA_DOUYIN, self.file_path, self.diagnostics):
+                    await self.upload(session.page)
+            finally:
+                await session.release()
+            return
+        # 从浏览器池租用上下文，结束后由池负责关闭上下文并回收浏览器
+        launch_options = self.launch_options()
+        async with browser_pool() as pool, \
+                pool.new_context(launch_options, SOCIAL_MEDIA_DOUYIN, storage_state=f"{self.account_file}") as context:
+            page = await context.new_page()
+            async with capture_on_failure(page, SOCIAL_MEDIA_DOUYIN, self.file_path, self.diagnostics):
+                await self.upload(page)
 
 
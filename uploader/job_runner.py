@@ -0,0 +1,336 @@
+"""
+Job Runner
+Runs video x platform x account upload jobs concurrently on one event loop, bounded by
+per-account, per-platform and global browser-context limits, from a manifest or the durable job queue
+"""
+
+import asyncio
+import csv
+import functools
+import json
+import signal
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import yaml
+from loguru import logger
+
+from conf import BASE_DIR
+from uploader.bilibili_uploader.main import bilibili_setup, BilibiliUploader, extract_keys_from_json, \
+    read_cookie_json_file
+from uploader.douyin_uploader.main import douyin_setup, DouYinVideo
+from uploader.ks_uploader.main import ks_setup, KSVideo
+from uploader.tencent_uploader.main import weixin_setup, TencentVideo
+from uploader.tk_uploader.main_chrome import tiktok_setup, TiktokVideo
+from utils.base_social_media import get_supported_social_media, SOCIAL_MEDIA_DOUYIN, SOCIAL_MEDIA_TENCENT, \
+    SOCIAL_MEDIA_TIKTOK, SOCIAL_MEDIA_KUAISHOU, SOCIAL_MEDIA_BILIBILI
+from utils.browser_pool import browser_pool
+from utils.config_manager import get_config
+from utils.constant import TencentZoneTypes
+from utils.files_times import get_title_and_hashtags
+from utils.folder_watcher import FolderWatcher
+from utils.job_queue import JobQueue, STATUS_PENDING, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED, STATUS_SKIPPED
+from utils.metrics import metrics
+from utils.rate_limiter import RateLimiter, get_rate_limiter
+from utils.record_store import RecordStore, get_record_store
+from utils.watchdog import get_watchdog
+
+JOB_PENDING = STATUS_PENDING
+JOB_RUNNING = STATUS_RUNNING
+JOB_DONE = STATUS_DONE
+JOB_FAILED = STATUS_FAILED
+JOB_SKIPPED = STATUS_SKIPPED
+# Bilibili uploads through biliup's web API on the upload thread pool, without a browser context
+BATCH_PLATFORMS = get_supported_social_media() + [SOCIAL_MEDIA_BILIBILI]
+
+
+def account_file_for(platform: str, account: str) -> Path:
+    """Same cookie file naming as `cli_main.py <platform> <account> login`"""
+    return Path(BASE_DIR / "cookies" / f"{platform}_{account}.json")
+
+
+class UploadJob(object):
+    """One video to publish on one platform account"""
+
+    def __init__(self, platform: str, account: str, video_file: str, schedule: Optional[str] = None,
+                 title: Optional[str] = None, tags=None, thumbnail: Optional[str] = None,
+                 job_id: Optional[str] = None):
+        if platform not in BATCH_PLATFORMS:
+            raise ValueError(f"unsupported platform: {platform}")
+        self.platform = platform
+        self.account = account
+        self.video_file = str(video_file)
+        self.schedule = schedule or None
+        self.title = title or None
+        if isinstance(tags, str):
+            tags = [tag.strip() for tag in tags.replace("#", " ").replace(",", " ").split() if tag.strip()]
+        self.tags = tags or None
+        self.thumbnail = thumbnail or None
+        self.job_id = job_id or f"{platform}:{account}:{Path(video_file).name}"
+        self.status = JOB_PENDING
+        self.error: Optional[str] = None
+        self.diagnostics: List[str] = []
+
+    @classmethod
+    def from_dict(cls, row: Dict[str, Any]) -> "UploadJob":
+        return cls(platform=row["platform"], account=row["account"], video_file=row.get("video") or row["video_file"],
+                   schedule=row.get("schedule"), title=row.get("title"), tags=row.get("tags"),
+                   thumbnail=row.get("thumbnail"), job_id=row.get("id") or row.get("job_id"))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.job_id, "platform": self.platform, "account": self.account, "video": self.video_file,
+                "schedule": self.schedule, "title": self.title, "tags": self.tags, "thumbnail": self.thumbnail}
+
+    @property
+    def account_file(self) -> Path:
+        return account_file_for(self.platform, self.account)
+
+    @property
+    def publish_date(self):
+        # 0 means publish immediately, the convention of every uploader
+        return datetime.strptime(self.schedule, '%Y-%m-%d %H:%M') if self.schedule else 0
+
+    def __str__(self):
+        return self.job_id
+
+
+def load_manifest(manifest_file) -> List[UploadJob]:
+    """
+    Read jobs from a CSV (header row), YAML (list, or a mapping with a `jobs` list) or JSONL manifest.
+    Columns: platform, account, video, and optionally schedule ('%Y-%m-%d %H:%M'), title, tags, thumbnail, id.
+    """
+    manifest_file = Path(manifest_file)
+    suffix = manifest_file.suffix.lower()
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        if suffix == ".csv":
+            rows = list(csv.DictReader(f))
+        elif suffix in (".yaml", ".yml"):
+            data = yaml.safe_load(f) or []
+            rows = data.get("jobs", []) if isinstance(data, dict) else data
+        elif suffix in (".jsonl", ".ndjson"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            raise ValueError(f"unsupported manifest format: {manifest_file.name} (csv, yaml or jsonl)")
+    return [UploadJob.from_dict(row) for row in rows]
+
+
+def create_uploader(job: UploadJob):
+    """Build the platform's Video object and return it with the matching setup function"""
+    if job.title is not None:
+        title, tags = job.title, job.tags or []
+    else:
+        title, tags = get_title_and_hashtags(job.video_file)
+        tags = job.tags or tags
+    account_file = job.account_file
+    if job.platform == SOCIAL_MEDIA_DOUYIN:
+        return douyin_setup, DouYinVideo(title, job.video_file, tags, job.publish_date, account_file, job.thumbnail)
+    if job.platform == SOCIAL_MEDIA_TIKTOK:
+        return tiktok_setup, TiktokVideo(title, job.video_file, tags, job.publish_date, account_file, job.thumbnail)
+    if job.platform == SOCIAL_MEDIA_TENCENT:
+        category = TencentZoneTypes.LIFESTYLE.value
+        return weixin_setup, TencentVideo(title, job.video_file, tags, job.publish_date, account_file, category)
+    if job.platform == SOCIAL_MEDIA_KUAISHOU:
+        return ks_setup, KSVideo(title, job.video_file, tags, job.publish_date, account_file)
+    if job.platform == SOCIAL_MEDIA_BILIBILI:
+        cookie_data = extract_keys_from_json(read_cookie_json_file(account_file)) if account_file.exists() else {}
+        tid = get_config().get("platforms.bilibili.settings.default_tid", 21)
+        dtime = int(job.publish_date.timestamp()) if job.schedule else 0
+        return bilibili_setup, BilibiliUploader(cookie_data, Path(job.video_file), title, title, tid, tags, dtime)
+    raise ValueError(f"unsupported platform: {job.platform}")
+
+
+class JobRunner(object):
+    """
+    Runs upload jobs concurrently. A job first waits for its account's rate limit tokens, then holds its
+    account slot, its platform slot and one of the global browser-context slots (always acquired in this
+    order) for its cookie check and upload.
+    """
+
+    def __init__(self, max_contexts: Optional[int] = None, per_platform: Optional[int] = None,
+                 per_account: Optional[int] = None, records: Optional[RecordStore] = None,
+                 limiter: Optional[RateLimiter] = None):
+        config = get_config()
+        self.records = records or get_record_store()
+        self.limiter = limiter or get_rate_limiter()
+        self.max_contexts = max_contexts or config.get("batch.max_contexts", 4)
+        self.per_platform = per_platform or config.get("batch.per_platform", 2)
+        self.per_account = per_account or config.get("batch.per_account", 1)
+        self.platform_limits: Dict[str, int] = config.get("batch.platform_limits", {}) or {}
+        self._contexts = asyncio.Semaphore(self.max_contexts)
+        self._platforms: Dict[str, asyncio.Semaphore] = {}
+        self._accounts: Dict[str, asyncio.Semaphore] = {}
+
+    def _platform_slot(self, platform: str) -> asyncio.Semaphore:
+        if platform not in self._platforms:
+            self._platforms[platform] = asyncio.Semaphore(self.platform_limits.get(platform, self.per_platform))
+        return self._platforms[platform]
+
+    def _context_slot(self, job: UploadJob) -> asyncio.Semaphore:
+        # A private semaphore never blocks: browserless jobs are bounded by their platform slot only
+        return asyncio.Semaphore(1) if job.platform == SOCIAL_MEDIA_BILIBILI else self._contexts
+
+    def _account_slot(self, job: UploadJob) -> asyncio.Semaphore:
+        key = f"{job.platform}:{job.account}"
+        if key not in self._accounts:
+            self._accounts[key] = asyncio.Semaphore(self.per_account)
+        return self._accounts[key]
+
+    async def upload(self, job: UploadJob) -> bool:
+        """Cookie check and upload of one job on the shared browser pool, without interactive login"""
+        setup, app = create_uploader(job)
+        try:
+            session = await setup(str(job.account_file), handle=False, launch_options=app.launch_options(),
+                                  keep_session=True)
+            if not session:
+                job.status = JOB_SKIPPED
+                job.error = "cookie missing or expired, run login first"
+                return False
+            # Deadlines are enforced by the watchdog: an expired upload is cancelled, its diagnostics
+            # captured and its lease released, and the job fails with DeadlineExceeded (retried from the queue)
+            await get_watchdog().run(app.main(session=session), str(job), job.platform)
+        finally:
+            job.diagnostics.extend(app.diagnostics)
+        return True
+
+    @staticmethod
+    async def _off_loop(func, *args):
+        """Record store calls that fingerprint the video read the file, keep them off the event loop"""
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args))
+
+    async def run_job(self, job: UploadJob) -> UploadJob:
+        if await self._off_loop(self.records.uploaded_files, job.platform, [job.video_file], job.account):
+            job.status = JOB_SKIPPED
+            job.error = "already uploaded"
+            logger.info(f"[job] {job} skipped: {job.error}")
+            metrics.inc("upload_jobs_total", platform=job.platform, status=job.status)
+            return job
+        # Rate limited jobs wait here without holding a slot, so other accounts keep uploading
+        await self.limiter.acquire(job.platform, job.account)
+        async with self._account_slot(job), self._platform_slot(job.platform), self._context_slot(job):
+            job.status = JOB_RUNNING
+            logger.info(f"[job] {job} started")
+            try:
+                if await self.upload(job):
+                    job.status = JOB_DONE
+                    await self._off_loop(self.records.mark_file_uploaded, job.platform, job.video_file, job.account)
+                    if job.schedule:
+                        await self._off_loop(self.records.mark_scheduled, job.platform, job.publish_date.timestamp(),
+                                             job.account, job.video_file)
+                    logger.success(f"[job] {job} done")
+                else:
+                    logger.warning(f"[job] {job} skipped: {job.error}")
+            except Exception as e:
+                job.status = JOB_FAILED
+                job.error = f"{type(e).__name__}: {e}"
+                logger.error(f"[job] {job} failed: {job.error}")
+        metrics.inc("upload_jobs_total", platform=job.platform, status=job.status)
+        return job
+
+    async def run(self, jobs: List[UploadJob]) -> List[UploadJob]:
+        """Run all jobs on one browser pool and return them with their final status"""
+        async with browser_pool():
+            await asyncio.gather(*(self.run_job(job) for job in jobs))
+        summary = {}
+        for job in jobs:
+            summary[job.status] = summary.get(job.status, 0) + 1
+        logger.info(f"[job] batch finished: {summary}")
+        return jobs
+
+    async def _run_queued(self, queue: JobQueue, record: Dict[str, Any]):
+        job = None
+        label = f"#{record['id']}"
+        try:
+            job = UploadJob.from_dict(record["payload"])
+            label = f"#{record['id']} {job}"
+            await self.run_job(job)
+        except asyncio.CancelledError:
+            # Interrupted by shutdown, the job is resumed by the next watcher
+            queue.release(record["id"])
+            logger.warning(f"[watch] job {label} interrupted, back to pending")
+            raise
+        except Exception as e:
+            # A bad payload, or the record store / rate limiter failing before the upload ran: the row must not
+            # stay running until the next watcher recovers it
+            error = f"{type(e).__name__}: {e}"
+            logger.error(f"[watch] job {label} failed: {error}")
+            status = queue.finish(record["id"], JOB_FAILED, error, job.diagnostics if job else None)
+        else:
+            status = queue.finish(record["id"], job.status, job.error, job.diagnostics)
+        if status == JOB_PENDING:
+            logger.info(f"[watch] job {label} will be retried (attempt {record['attempts']})")
+
+    async def watch(self, queue: JobQueue, platform: Optional[str] = None, account: Optional[str] = None,
+                    workers: Optional[int] = None, poll_interval: Optional[float] = None,
+                    stop: Optional[asyncio.Event] = None):
+        """
+        Consume the queue until `stop` is set, keeping one browser pool warm for every job.
+        On stop no new job is claimed, running jobs get queue.shutdown_timeout seconds to finish and the rest
+        are put back to pending. Run one watcher per scope: its startup recovers the scope's running jobs.
+        """
+        config = get_config()
+        workers = workers or config.get("queue.workers", 2)
+        poll_interval = poll_interval or config.get("queue.poll_interval", 5)
+        shutdown_timeout = config.get("queue.shutdown_timeout", 300)
+        stop = stop or asyncio.Event()
+
+        recovered = queue.recover(platform, account)
+        if recovered:
+            logger.info(f"[watch] resumed {recovered} interrupted job(s)")
+        logger.info(f"[watch] watching {platform or 'all platforms'}/{account or 'all accounts'} "
+                    f"with {workers} worker(s), queue {queue.stats(platform, account)}")
+
+        running = set()
+        stopping = asyncio.ensure_future(stop.wait())
+        async with browser_pool():
+            try:
+                while not stop.is_set():
+                    while len(running) < workers:
+                        record = queue.claim(platform, account)
+                        if record is None:
+                            break
+                        delay = await self.limiter.delay(record["platform"], record["account"])
+                        if delay > poll_interval:
+                            # Park a rate limited job in the queue instead of idling a worker on it
+                            queue.defer(record["id"], delay)
+                            logger.info(f"[watch] job #{record['id']} rate limited, deferred {delay:.0f}s")
+                            continue
+                        running.add(asyncio.ensure_future(self._run_queued(queue, record)))
+                    # Wake up when a worker frees up, on the next poll or on stop
+                    await asyncio.wait(running | {stopping}, timeout=poll_interval,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    for task in [task for task in running if task.done()]:
+                        running.discard(task)
+                        if not task.cancelled() and task.exception() is not None:
+                            # queue.finish itself failed, e.g. the queue database stayed locked
+                            logger.opt(exception=task.exception()).error("[watch] job task failed")
+            finally:
+                stopping.cancel()
+                if running:
+                    logger.info(f"[watch] stopping, waiting up to {shutdown_timeout}s for {len(running)} job(s)")
+                    _, pending = await asyncio.wait(running, timeout=shutdown_timeout)
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*running, return_exceptions=True)
+        logger.info(f"[watch] stopped, queue {queue.stats(platform, account)}")
+
+
+async def enqueue_from_folder(queue: JobQueue, folder, platform: str, account: str):
+    """Queue every video that becomes ready under `folder` (fully written, sidecars present) exactly once"""
+    async for video in FolderWatcher(folder).watch():
+        job = UploadJob(platform, account, str(video))
+        job_id = queue.enqueue(platform, account, job.to_dict())
+        logger.info(f"[watch] queued job #{job_id} {job} from {folder}")
+
+
+def stop_on_signals() -> asyncio.Event:
+    """Event set by SIGINT/SIGTERM so a daemon can shut down gracefully"""
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows event loops have no signal handlers, Ctrl+C still raises KeyboardInterrupt there
+            pass
+    return stop
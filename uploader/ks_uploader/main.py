@@ -1,42 +1,70 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 
-from playwright.async_api import Playwright, async_playwright
-import os
+from playwright.async_api import async_playwright, Page
 import asyncio
 
-from utils.base_social_media import set_init_script
+from utils.base_social_media import set_init_script, get_browser_launch_options, SOCIAL_MEDIA_KUAISHOU
+from utils.browser_pool import browser_pool, BrowserLease
+from utils.checkpoints import UploadCheckpoint, STEP_UPLOADED, STEP_FORM_FILLED, STEP_PUBLISHED, STEP_COOKIE_SAVED
+from utils.cookie_cache import offline_cookie_check, remember_cookie_check
 from utils.files_times import get_absolute_path
+from utils.diagnostics import capture_on_failure
 from utils.log import kuaishou_logger
-
-
-async def cookie_auth(account_file):
-    async with async_playwright() as playwright:
-        browser = await playwright.chromium.launch(headless=True)
-        context = await browser.new_context(storage_state=account_file)
-        context = await set_init_script(context)
-        # Create a new page
-        page = await context.new_page()
-        # Visit the specified URL
-        await page.goto("https://cp.kuaishou.com/article/publish/video")
+from utils.upload_progress import UploadProgressTracker
+
+UPLOAD_URL = "https://cp.kuaishou.com/article/publish/video"
+
+
+async def cookie_auth(account_file, launch_options=None, keep_session=False):
+    """
+    Check whether the cookie is still valid.
+    With keep_session=True a BrowserLease parked on the upload page is returned for the upload to reuse
+    (requires an enclosing browser_pool() scope); a valid cookie without a kept lease returns True.
+    """
+    # Check the cookie file offline first: expired files fail fast, files verified within the ttl skip the probe
+    verified = offline_cookie_check(account_file, SOCIAL_MEDIA_KUAISHOU)
+    if verified is False or (verified and not keep_session):
+        return verified
+    async with browser_pool() as pool:
+        lease = await pool.lease(launch_options or get_browser_launch_options(headless=True), SOCIAL_MEDIA_KUAISHOU, storage_state=account_file)
         try:
-            await page.wait_for_selector("div.names div.container div.name:text('机构服务')", timeout=5000)  # Wait 5 seconds
-
-            kuaishou_logger.info("[+] Waiting 5 seconds, cookie expired")
-            return False
-        except:
-            kuaishou_logger.success("[+] Cookie valid")
-            return True
-
+            # Create a new page
+            page = await lease.context.new_page()
+            # Visit the specified URL
+            await page.goto(UPLOAD_URL)
+            if verified:
+                return await lease.hand_over(page, keep_session) or True
+            try:
+                await page.wait_for_selector("div.names div.container div.name:text('机构服务')", timeout=5000)  # Wait 5 seconds
 
-async def ks_setup(account_file, handle=False):
+                kuaishou_logger.info("[+] Waiting 5 seconds, cookie expired")
+                remember_cookie_check(account_file, False)
+                await lease.release()
+                return False
+            except:
+                kuaishou_logger.success("[+] Cookie valid")
+                remember_cookie_check(account_file, True)
+                return await lease.hand_over(page, keep_session) or True
+        except Exception:
+            await lease.release()
+            raise
+
+
+async def ks_setup(account_file, handle=False, launch_options=None, keep_session=False):
+    """
+    With keep_session=True and a valid cookie, returns the validated BrowserLease to pass to KSVideo.main(session=...).
+    launch_options should match the upload launch options so the checking browser is the uploading one.
+    """
     account_file = get_absolute_path(account_file, "ks_uploader")
-    if not os.path.exists(account_file) or not await cookie_auth(account_file):
+    session = await cookie_auth(account_file, launch_options, keep_session)
+    if not session:
         if not handle:
             return False
         kuaishou_logger.info('[+] Cookie file does not exist or has expired, browser will open automatically, please scan QR code to login, cookie file will be generated automatically after login')
         await get_ks_cookie(account_file)
-    return True
+        return True
+    return session
 
 
 async def get_ks_cookie(account_file):
@@ -61,36 +89,56 @@ async def get_ks_cookie(account_file):
 
 
 class KSVideo(object):
-    def __init__(self, title, file_path, tags, publish_date: datetime, account_file):
+    def __init__(self, title, file_path, tags, publish_date: datetime, account_file, progress_callback=None):
         self.title = title  # Video title
         self.file_path = file_path
         self.tags = tags
         self.publish_date = publish_date
         self.account_file = account_file
         self.date_format = '%Y-%m-%d %H:%M'
+        self.progress_callback = progress_callback  # Called with an UploadProgress as chunks are sent
+        self.diagnostics = []  # Screenshot/trace paths saved when the upload failed, kept with the job
+        self.checkpoint = None  # Upload steps already reached, loaded per video and account in main()
 
     async def handle_upload_error(self, page):
         kuaishou_logger.error("Video error occurred, re-uploading")
         await page.locator('div.progress-div [class^="upload-btn-input"]').set_input_files(self.file_path)
 
-    async def upload(self, playwright: Playwright) -> None:
-        # Launch a browser instance using Chromium browser
-        browser = await playwright.chromium.launch(headless=False)
-        # Create a browser context using the specified cookie file
-        context = await browser.new_context(storage_state=f"{self.account_file}")
-        context = await set_init_script(context)
+    def launch_options(self) -> dict:
+        # Launch Playwright's Chromium with headless/args/low-memory settings from ConfigManager
+        return get_browser_launch_options()
 
-        # Create a new page
-        page = await context.new_page()
-        # Visit the specified URL
-        await page.goto("https://cp.kuaishou.com/article/publish/video")
+    async def upload(self, page: Page) -> None:
+        # Visit the specified URL, a reused cookie check session is already on the upload page
+        if not page.url.startswith(UPLOAD_URL):
+            await page.goto(UPLOAD_URL)
         kuaishou_logger.info('Uploading-------{}.mp4'.format(self.title))
         # Wait for page to navigate to specified URL, if not entered, automatically wait until timeout
         kuaishou_logger.info('Opening main page...')
-        await page.wait_for_url("https://cp.kuaishou.com/article/publish/video")
+        await page.wait_for_url(UPLOAD_URL)
+        # Track the chunk requests for bytes sent, throughput and ETA
+        progress = UploadProgressTracker(page, self.file_path, SOCIAL_MEDIA_KUAISHOU, self.progress_callback,
+                                         kuaishou_logger).start()
         # Click "Upload Video" button
         await page.locator("div.vVExjn9O3UQ- input").set_input_files(self.file_path)
 
+        # Typing into the form is not repeatable, so that step is not retried on the page
+        await self.checkpoint.step(STEP_FORM_FILLED, lambda: self.fill_form(page), retries=0)
+
+        # Resolved by the page as soon as "上传成功" is rendered, no polling from here
+        self.checkpoint.begin(STEP_UPLOADED)
+        kuaishou_logger.info("Uploading video...")
+        await page.locator('div > span:text("上传成功")').first.wait_for(state='attached', timeout=0)
+        kuaishou_logger.success("Video upload completed")
+        await progress.stop()
+        self.checkpoint.mark(STEP_UPLOADED)
+
+        # Later steps are retried on this page, without transferring the video again
+        await self.checkpoint.step(STEP_PUBLISHED, lambda: self.publish(page))
+        await self.checkpoint.step(STEP_COOKIE_SAVED, lambda: self.save_cookie(page))
+        await asyncio.sleep(2)  # This delay is for easy visual observation
+
+    async def fill_form(self, page: Page):
         await asyncio.sleep(2)
 
         if not await page.get_by_text("封面编辑").count():
@@ -121,24 +169,13 @@ class KSVideo(object):
             await asyncio.sleep(2)
             await page.locator('div.FZcv90s7kFs- > div').nth(0).click()
 
-        while True:
-            try:
-                number = await page.locator('div > span:text("上传成功")').count()
-                if number > 0:
-                    kuaishou_logger.success("Video upload completed")
-                    break
-                else:
-                    kuaishou_logger.info("Uploading video...")
-                    await asyncio.sleep(2)
-            except:
-                kuaishou_logger.info("Uploading video...")
-                await asyncio.sleep(2)
-
+    async def publish(self, page: Page):
         # Scheduled task
         if self.publish_date != 0:
             await self.set_schedule_time(page, self.publish_date)
 
-        # Check if video was published successfully
+        # Check if video was published successfully, raising once the attempt overran so the step is retried
+        deadline = self.checkpoint.attempt_deadline()
         while True:
             # Check if video was published successfully
             try:
@@ -155,21 +192,37 @@ class KSVideo(object):
                                         timeout=1500)
                 kuaishou_logger.success("Video published successfully")
                 break
-            except:
+            except Exception as e:
+                self.checkpoint.raise_if_expired(deadline, e)
                 kuaishou_logger.info("Publishing video...")
-                await page.screenshot(full_page=True)
                 await asyncio.sleep(0.5)
 
-        await context.storage_state(path=self.account_file)  # Save cookie
+    async def save_cookie(self, page: Page):
+        await page.context.storage_state(path=self.account_file)  # Save cookie
+        remember_cookie_check(self.account_file, True)
         kuaishou_logger.info('Cookie update completed!')
-        await asyncio.sleep(2)  # This delay is for easy visual observation
-        # Close browser context and browser instance
-        await context.close()
-        await browser.close()
 
-    async def main(self):
-        async with async_playwright() as playwright:
-            await self.upload(playwright)
+    async def main(self, session=None):
+        # A video an earlier run already published is not published again (the run died before recording it)
+        self.checkpoint = await UploadCheckpoint.create(SOCIAL_MEDIA_KUAISHOU, self.account_file, self.file_path,
+                                                        kuaishou_logger)
+        if await self.checkpoint.resume_published(session if isinstance(session, BrowserLease) else None):
+            return
+        # Reuse the validated session returned by ks_setup(keep_session=True), saving a browser launch and a page load
+        if isinstance(session, BrowserLease):
+            try:
+                async with capture_on_failure(session.page, SOCIAL_MEDIA_KUAISHOU, self.file_path, self.diagnostics):
+                    await self.upload(session.page)
+            finally:
+                await session.release()
+            return
+        # Lease a context from the browser pool, the pool closes it and recycles the browser afterwards
+        launch_options = self.launch_options()
+        async with browser_pool() as pool, \
+                pool.new_context(launch_options, SOCIAL_MEDIA_KUAISHOU, storage_state=f"{self.account_file}") as context:
+            page = await context.new_page()
+            async with capture_on_failure(page, SOCIAL_MEDIA_KUAISHOU, self.file_path, self.diagnostics):
+                await self.upload(page)
 
     async def set_schedule_time(self, page, publish_date):
         kuaishou_logger.info("click schedule")
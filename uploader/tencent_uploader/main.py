@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 
-from playwright.async_api import Playwright, async_playwright
-import os
+from playwright.async_api import async_playwright, Page
 import asyncio
 
-from conf import LOCAL_CHROME_PATH
-from utils.base_social_media import set_init_script
+from utils.base_social_media import set_init_script, get_browser_executable_path, get_browser_launch_options, \
+    SOCIAL_MEDIA_TENCENT
+from utils.browser_pool import browser_pool, BrowserLease
+from utils.checkpoints import UploadCheckpoint, STEP_UPLOADED, STEP_FORM_FILLED, STEP_PUBLISHED, STEP_COOKIE_SAVED
+from utils.cookie_cache import offline_cookie_check, remember_cookie_check
 from utils.files_times import get_absolute_path
+from utils.diagnostics import capture_on_failure
 from utils.log import tencent_logger
+from utils.page_events import wait_for_first
+from utils.upload_progress import UploadProgressTracker
+
+UPLOAD_URL = "https://channels.weixin.qq.com/platform/post/create"
 
 
 def format_str_for_short_title(origin_title: str) -> str:
@@ -31,22 +38,38 @@ def format_str_for_short_title(origin_title: str) -> str:
     return formatted_string
 
 
-async def cookie_auth(account_file):
-    async with async_playwright() as playwright:
-        browser = await playwright.chromium.launch(headless=True)
-        context = await browser.new_context(storage_state=account_file)
-        context = await set_init_script(context)
-        # Create a new page
-        page = await context.new_page()
-        # Visit the specified URL
-        await page.goto("https://channels.weixin.qq.com/platform/post/create")
+async def cookie_auth(account_file, launch_options=None, keep_session=False):
+    """
+    Check whether the cookie is still valid.
+    With keep_session=True a BrowserLease parked on the post page is returned for the upload to reuse
+    (requires an enclosing browser_pool() scope); a valid cookie without a kept lease returns True.
+    """
+    # Check the cookie file offline first: expired files fail fast, files verified within the ttl skip the probe
+    verified = offline_cookie_check(account_file, SOCIAL_MEDIA_TENCENT)
+    if verified is False or (verified and not keep_session):
+        return verified
+    async with browser_pool() as pool:
+        lease = await pool.lease(launch_options or get_browser_launch_options(headless=True), SOCIAL_MEDIA_TENCENT, storage_state=account_file)
         try:
-            await page.wait_for_selector('div.title-name:has-text("微信小店")', timeout=5000)  # Wait 5 seconds
-            tencent_logger.error("[+] Wait 5 seconds, cookie expired")
-            return False
-        except:
-            tencent_logger.success("[+] Cookie is valid")
-            return True
+            # Create a new page
+            page = await lease.context.new_page()
+            # Visit the specified URL
+            await page.goto(UPLOAD_URL)
+            if verified:
+                return await lease.hand_over(page, keep_session) or True
+            try:
+                await page.wait_for_selector('div.title-name:has-text("微信小店")', timeout=5000)  # Wait 5 seconds
+                tencent_logger.error("[+] Wait 5 seconds, cookie expired")
+                remember_cookie_check(account_file, False)
+                await lease.release()
+                return False
+            except:
+                tencent_logger.success("[+] Cookie is valid")
+                remember_cookie_check(account_file, True)
+                return await lease.hand_over(page, keep_session) or True
+        except Exception:
+            await lease.release()
+            raise
 
 
 async def get_tencent_cookie(account_file):
@@ -70,26 +93,36 @@ async def get_tencent_cookie(account_file):
         await context.storage_state(path=account_file)
 
 
-async def weixin_setup(account_file, handle=False):
+async def weixin_setup(account_file, handle=False, launch_options=None, keep_session=False):
+    """
+    With keep_session=True and a valid cookie, returns the validated BrowserLease to pass to TencentVideo.main(session=...).
+    launch_options should match the upload launch options so the checking browser is the uploading one.
+    """
     account_file = get_absolute_path(account_file, "tencent_uploader")
-    if not os.path.exists(account_file) or not await cookie_auth(account_file):
+    session = await cookie_auth(account_file, launch_options, keep_session)
+    if not session:
         if not handle:
             # Todo alert message
             return False
         tencent_logger.info('[+] Cookie file does not exist or has expired, browser will open automatically, please scan code to login, cookie file will be generated automatically after login')
         await get_tencent_cookie(account_file)
-    return True
+        return True
+    return session
 
 
 class TencentVideo(object):
-    def __init__(self, title, file_path, tags, publish_date: datetime, account_file, category=None):
+    def __init__(self, title, file_path, tags, publish_date: datetime, account_file, category=None,
+                 progress_callback=None):
         self.title = title  # Video title
         self.file_path = file_path
         self.tags = tags
         self.publish_date = publish_date
         self.account_file = account_file
         self.category = category
-        self.local_executable_path = LOCAL_CHROME_PATH
+        self.local_executable_path = get_browser_executable_path()
+        self.progress_callback = progress_callback  # Called with an UploadProgress as chunks are sent
+        self.diagnostics = []  # Screenshot/trace paths saved when the upload failed, kept with the job
+        self.checkpoint = None  # Upload steps already reached, loaded per video and account in main()
 
     async def set_schedule_time_tencent(self, page, publish_date):
         label_element = page.locator("label").filter(has_text="定时").nth(1)
@@ -133,23 +166,37 @@ class TencentVideo(object):
         file_input = page.locator('input[type="file"]')
         await file_input.set_input_files(self.file_path)
 
-    async def upload(self, playwright: Playwright) -> None:
+    def launch_options(self) -> dict:
         # Use Chromium (here using system browser, using chromium will cause h264 error
-        browser = await playwright.chromium.launch(headless=False, executable_path=self.local_executable_path)
-        # Create a browser context using the specified cookie file
-        context = await browser.new_context(storage_state=f"{self.account_file}")
-        context = await set_init_script(context)
+        # Headless/args/low-memory settings come from ConfigManager
+        return get_browser_launch_options(executable_path=self.local_executable_path)
 
-        # Create a new page
-        page = await context.new_page()
-        # Visit the specified URL
-        await page.goto("https://channels.weixin.qq.com/platform/post/create")
+    async def upload(self, page: Page) -> None:
+        # Visit the specified URL, a reused cookie check session is already on the post page
+        if not page.url.startswith(UPLOAD_URL):
+            await page.goto(UPLOAD_URL)
         tencent_logger.info(f'[+]Uploading-------{self.title}.mp4')
         # Wait for page to navigate to specified URL, if not entered, automatically wait until timeout
-        await page.wait_for_url("https://channels.weixin.qq.com/platform/post/create")
+        await page.wait_for_url(UPLOAD_URL)
         # await page.wait_for_selector('input[type="file"]', timeout=10000)
         file_input = page.locator('input[type="file"]')
+        # Track the chunk requests for bytes sent, throughput and ETA
+        progress = UploadProgressTracker(page, self.file_path, SOCIAL_MEDIA_TENCENT, self.progress_callback,
+                                         tencent_logger).start()
         await file_input.set_input_files(self.file_path)
+        # Typing into the form is not repeatable, so that step is not retried on the page
+        await self.checkpoint.step(STEP_FORM_FILLED, lambda: self.fill_form(page), retries=0)
+        # Detect upload status
+        self.checkpoint.begin(STEP_UPLOADED)
+        await self.detect_upload_status(page)
+        await progress.stop()
+        self.checkpoint.mark(STEP_UPLOADED)
+        # Later steps are retried on this page, without transferring the video again
+        await self.checkpoint.step(STEP_PUBLISHED, lambda: self.publish(page))
+        await self.checkpoint.step(STEP_COOKIE_SAVED, lambda: self.save_cookie(page))
+        await asyncio.sleep(2)  # Delay here for easy visual observation
+
+    async def fill_form(self, page: Page):
         # Fill title and topics
         await self.add_title_tags(page)
         # Add products
@@ -158,8 +205,8 @@ class TencentVideo(object):
         await self.add_collection(page)
         # Original selection
         await self.add_original(page)
-        # Detect upload status
-        await self.detect_upload_status(page)
+
+    async def publish(self, page: Page):
         if self.publish_date != 0:
             await self.set_schedule_time_tencent(page, self.publish_date)
         # Add short title
@@ -167,12 +214,10 @@ class TencentVideo(object):
 
         await self.click_publish(page)
 
-        await context.storage_state(path=f"{self.account_file}")  # Save cookie
+    async def save_cookie(self, page: Page):
+        await page.context.storage_state(path=f"{self.account_file}")  # Save cookie
+        remember_cookie_check(self.account_file, True)
         tencent_logger.success('  [-]Cookie update completed!')
-        await asyncio.sleep(2)  # Delay here for easy visual observation
-        # Close browser context and browser instance
-        await context.close()
-        await browser.close()
 
     async def add_short_title(self, page):
         short_title_element = page.get_by_text("短标题", exact=True).locator("..").locator(
@@ -183,6 +228,8 @@ class TencentVideo(object):
             await short_title_element.fill(short_title)
 
     async def click_publish(self, page):
+        # Raises once the attempt overran, so the publish step is retried
+        deadline = self.checkpoint.attempt_deadline()
         while True:
             try:
                 publish_buttion = page.locator('div.form-btns button:has-text("发表")')
@@ -197,28 +244,34 @@ class TencentVideo(object):
                     tencent_logger.success("  [-]Video published successfully")
                     break
                 else:
+                    self.checkpoint.raise_if_expired(deadline, e)
                     tencent_logger.exception(f"  [-] Exception: {e}")
 
     async def detect_upload_status(self, page):
+        # Driven by DOM events: the publish button losing its disabled class means the upload completed,
+        # an error message means the upload failed and is retried
+        enabled_publish = page.locator('div.form-btns button:has-text("发表"):not(.weui-desktop-btn_disabled)').first
+        upload_error = page.locator('div.status-msg.error').first
+        tencent_logger.info("  [-]  Video is uploading...")
         while True:
-            # Match delete button, represent video upload completed, if not exist, represent video is uploading, wait
-            try:
-                # Match delete button, represent video upload completed
-                if "weui-desktop-btn_disabled" not in await page.get_by_role("button", name="发表").get_attribute(
-                        'class'):
-                    tencent_logger.info("  [-]Video upload completed")
-                    break
-                else:
-                    tencent_logger.info("  [-]  Video is uploading...")
-                    await asyncio.sleep(2)
-                    # Video error
-                    if await page.locator('div.status-msg.error').count() and await page.locator(
-                            'div.media-status-content div.tag-inner:has-text("删除")').count():
-                        tencent_logger.error("  [-]  Found upload error...prepare to retry")
-                        await self.handle_upload_error(page)
-            except:
-                tencent_logger.info("  [-]  Video is uploading...")
-                await asyncio.sleep(2)
+            event = await wait_for_first({
+                'done': enabled_publish.wait_for(state='attached', timeout=0),
+                'failed': upload_error.wait_for(state='attached', timeout=0),
+            })
+            if event == 'done':
+                tencent_logger.info("  [-]Video upload completed")
+                return
+            if await page.locator('div.media-status-content div.tag-inner:has-text("删除")').count():
+                tencent_logger.error("  [-]  Found upload error...prepare to retry")
+                await self.handle_upload_error(page)
+            # Keep listening once the error message is gone, so one message never triggers two retries
+            event = await wait_for_first({
+                'done': enabled_publish.wait_for(state='attached', timeout=0),
+                'cleared': upload_error.wait_for(state='detached', timeout=0),
+            })
+            if event == 'done':
+                tencent_logger.info("  [-]Video upload completed")
+                return
 
     async def add_title_tags(self, page):
         await page.locator("div.input-editor").click()
@@ -260,6 +313,24 @@ class TencentVideo(object):
             if await page.locator('button:has-text("声明原创"):visible').count():
                 await page.locator('button:has-text("声明原创"):visible').click()
 
-    async def main(self):
-        async with async_playwright() as playwright:
-            await self.upload(playwright)
+    async def main(self, session=None):
+        # A video an earlier run already published is not published again (the run died before recording it)
+        self.checkpoint = await UploadCheckpoint.create(SOCIAL_MEDIA_TENCENT, self.account_file, self.file_path,
+                                                        tencent_logger)
+        if await self.checkpoint.resume_published(session if isinstance(session, BrowserLease) else None):
+            return
+        # Reuse the validated session returned by weixin_setup(keep_session=True), saving a browser launch and a page load
+        if isinstance(session, BrowserLease):
+            try:
+                async with capture_on_failure(session.page, SOCIAL_MEDIA_TENCENT, self.file_path, self.diagnostics):
+                    await self.upload(session.page)
+            finally:
+                await session.release()
+            return
+        # Lease a context from the browser pool, the pool closes it and recycles the browser afterwards
+        launch_options = self.launch_options()
+        async with browser_pool() as pool, \
+                pool.new_context(launch_options, SOCIAL_MEDIA_TENCENT, storage_state=f"{self.account_file}") as context:
+            page = await context.new_page()
+            async with capture_on_failure(page, SOCIAL_MEDIA_TENCENT, self.file_path, self.diagnostics):
+                await self.upload(page)
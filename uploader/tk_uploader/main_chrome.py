@@ -1,52 +1,118 @@
 # -*- coding: utf-8 -*-
+import json
 import re
 from datetime import datetime
+from pathlib import Path
 
-from playwright.async_api import Playwright, async_playwright
-import os
+from playwright.async_api import async_playwright, Page
 import asyncio
 
-from conf import LOCAL_CHROME_PATH
 from uploader.tk_uploader.tk_config import Tk_Locator
-from utils.base_social_media import set_init_script
+from utils.base_social_media import set_init_script, get_browser_executable_path, get_browser_launch_options, \
+    SOCIAL_MEDIA_TIKTOK
+from utils.browser_pool import browser_pool, BrowserLease
+from utils.checkpoints import UploadCheckpoint, STEP_UPLOADED, STEP_FORM_FILLED, STEP_PUBLISHED, STEP_COOKIE_SAVED
+from utils.cookie_cache import offline_cookie_check, remember_cookie_check
 from utils.files_times import get_absolute_path
+from utils.diagnostics import capture_on_failure
 from utils.log import tiktok_logger
-
-
-async def cookie_auth(account_file):
-    async with async_playwright() as playwright:
-        browser = await playwright.chromium.launch(headless=True)
-        context = await browser.new_context(storage_state=account_file)
-        context = await set_init_script(context)
-        # Create a new page
-        page = await context.new_page()
-        # Visit the specified URL
-        await page.goto("https://www.tiktok.com/tiktokstudio/upload?lang=en")
-        await page.wait_for_load_state('networkidle')
+from utils.page_events import wait_for_first
+from utils.request_filter import images_allowed
+from utils.upload_progress import UploadProgressTracker
+
+UPLOAD_URL = "https://www.tiktok.com/tiktokstudio/upload?lang=en"
+# fix the UI language when the context is created instead of switching it through the site menu on every upload
+LOCALE_OPTIONS = {
+    "locale": "en-US",
+    "extra_http_headers": {"Accept-Language": "en-US,en;q=0.9"},
+}
+# accounts whose studio already showed the English UI, kept next to the cookie files
+LANGUAGE_FLAG_FILE = ".english_accounts.json"
+
+
+def _language_flags(account_file) -> Path:
+    return Path(account_file).parent / LANGUAGE_FLAG_FILE
+
+
+def is_english_account(account_file) -> bool:
+    try:
+        with open(_language_flags(account_file), 'r', encoding='utf-8') as f:
+            return Path(account_file).name in json.load(f)
+    except (OSError, ValueError):
+        return False
+
+
+def set_english_account(account_file, english=True):
+    flags_file = _language_flags(account_file)
+    try:
+        with open(flags_file, 'r', encoding='utf-8') as f:
+            accounts = set(json.load(f))
+    except (OSError, ValueError):
+        accounts = set()
+    if english:
+        accounts.add(Path(account_file).name)
+    else:
+        accounts.discard(Path(account_file).name)
+    with open(flags_file, 'w', encoding='utf-8') as f:
+        json.dump(sorted(accounts), f)
+
+
+async def cookie_auth(account_file, launch_options=None, keep_session=False):
+    """
+    check whether the cookie is still valid.
+    with keep_session=True a BrowserLease parked on the upload page is returned for the upload to reuse
+    (requires an enclosing browser_pool() scope); a valid cookie without a kept lease returns True.
+    """
+    # check the cookie file offline first: expired files fail fast, files verified within the ttl skip the probe
+    verified = offline_cookie_check(account_file, SOCIAL_MEDIA_TIKTOK)
+    if verified is False or (verified and not keep_session):
+        return verified
+    async with browser_pool() as pool:
+        lease = await pool.lease(launch_options or get_browser_launch_options(headless=True), SOCIAL_MEDIA_TIKTOK,
+                                 storage_state=account_file, **LOCALE_OPTIONS)
         try:
-            # Select all select elements
-            select_elements = await page.query_selector_all('select')
-            for element in select_elements:
-                class_name = await element.get_attribute('class')
-                # Use regex to match class names with specific pattern
-                if re.match(r'tiktok-.*-SelectFormContainer.*', class_name):
-                    tiktok_logger.error("[+] cookie expired")
-                    return False
-            tiktok_logger.success("[+] cookie valid")
-            return True
-        except:
-            tiktok_logger.success("[+] cookie valid")
-            return True
-
-
-async def tiktok_setup(account_file, handle=False):
+            # Create a new page
+            page = await lease.context.new_page()
+            # Visit the specified URL
+            await page.goto(UPLOAD_URL)
+            if verified:
+                return await lease.hand_over(page, keep_session) or True
+            await page.wait_for_load_state('networkidle')
+            try:
+                # Select all select elements
+                select_elements = await page.query_selector_all('select')
+                for element in select_elements:
+                    class_name = await element.get_attribute('class')
+                    # Use regex to match class names with specific pattern
+                    if re.match(r'tiktok-.*-SelectFormContainer.*', class_name):
+                        tiktok_logger.error("[+] cookie expired")
+                        remember_cookie_check(account_file, False)
+                        await lease.release()
+                        return False
+                tiktok_logger.success("[+] cookie valid")
+            except:
+                tiktok_logger.success("[+] cookie valid")
+            remember_cookie_check(account_file, True)
+            return await lease.hand_over(page, keep_session) or True
+        except Exception:
+            await lease.release()
+            raise
+
+
+async def tiktok_setup(account_file, handle=False, launch_options=None, keep_session=False):
+    """
+    with keep_session=True and a valid cookie, returns the validated BrowserLease to pass to TiktokVideo.main(session=...).
+    launch_options should match the upload launch options so the checking browser is the uploading one.
+    """
     account_file = get_absolute_path(account_file, "tk_uploader")
-    if not os.path.exists(account_file) or not await cookie_auth(account_file):
+    session = await cookie_auth(account_file, launch_options, keep_session)
+    if not session:
         if not handle:
             return False
         tiktok_logger.info('[+] cookie file is not existed or expired. Now open the browser auto. Please login with your way(gmail phone, whatever, the cookie file will generated after login')
         await get_tiktok_cookie(account_file)
-    return True
+        return True
+    return session
 
 
 async def get_tiktok_cookie(account_file):
@@ -59,8 +125,8 @@ async def get_tiktok_cookie(account_file):
         }
         # Make sure to run headed.
         browser = await playwright.chromium.launch(**options)
-        # Setup context however you like.
-        context = await browser.new_context()  # Pass any options
+        # Setup context however you like. an English locale makes the site store English as the account language
+        context = await browser.new_context(**LOCALE_OPTIONS)
         context = await set_init_script(context)
         # Pause the page, and start recording manually.
         page = await context.new_page()
@@ -71,15 +137,20 @@ async def get_tiktok_cookie(account_file):
 
 
 class TiktokVideo(object):
-    def __init__(self, title, file_path, tags, publish_date, account_file, thumbnail_path=None):
+    def __init__(self, title, file_path, tags, publish_date, account_file, thumbnail_path=None,
+                 progress_callback=None):
         self.title = title
         self.file_path = file_path
         self.tags = tags
         self.publish_date = publish_date
         self.thumbnail_path = thumbnail_path
         self.account_file = account_file
-        self.local_executable_path = LOCAL_CHROME_PATH
+        self.local_executable_path = get_browser_executable_path()
         self.locator_base = None
+        self.progress_callback = progress_callback  # called with an UploadProgress as chunks are sent
+        self.diagnostics = []  # screenshot/trace paths saved when the upload failed, kept with the job
+        self.checkpoint = None  # upload steps already reached, loaded per video and account in main()
+        self.thumbnail_done = False
 
     async def set_schedule_time(self, page, publish_date):
         schedule_input_element = self.locator_base.get_by_label('Schedule')
@@ -147,18 +218,15 @@ class TiktokVideo(object):
         file_chooser = await fc_info.value
         await file_chooser.set_files(self.file_path)
 
-    async def upload(self, playwright: Playwright) -> None:
-        browser = await playwright.chromium.launch(headless=False, executable_path=self.local_executable_path)
-        context = await browser.new_context(storage_state=f"{self.account_file}")
-        context = await set_init_script(context)
-        page = await context.new_page()
-
-        # change language to eng first
-        await self.change_language(page)
-        await page.goto("https://www.tiktok.com/tiktokstudio/upload")
-        tiktok_logger.info(f'[+]Uploading-------{self.title}.mp4')
+    def launch_options(self) -> dict:
+        # headless/args/low-memory settings come from ConfigManager
+        return get_browser_launch_options(executable_path=self.local_executable_path)
 
-        await page.wait_for_url("https://www.tiktok.com/tiktokstudio/upload", timeout=10000)
+    async def open_upload_page(self, page: Page):
+        # a reused cookie check session is already on the upload page
+        if not page.url.startswith("https://www.tiktok.com/tiktokstudio/upload"):
+            await page.goto(UPLOAD_URL)
+        await page.wait_for_url("https://www.tiktok.com/tiktokstudio/upload**", timeout=10000)
 
         try:
             await page.wait_for_selector('iframe[data-tt="Upload_index_iframe"], div.upload-container', timeout=10000)
@@ -168,33 +236,67 @@ class TiktokVideo(object):
 
         await self.choose_base_locator(page)
 
+    async def upload(self, page: Page) -> None:
+        await self.open_upload_page(page)
+        tiktok_logger.info(f'[+]Uploading-------{self.title}.mp4')
+
         upload_button = self.locator_base.locator(
             'button:has-text("Select video"):visible')
-        await upload_button.wait_for(state='visible')  # Ensure button is visible
+        if not is_english_account(self.account_file):
+            # the English locale is normally enough, the language menu is only a fallback for accounts
+            # whose saved language overrides it; the result is cached so later uploads skip this check
+            try:
+                await upload_button.wait_for(state='visible', timeout=15000)
+            except Exception:
+                tiktok_logger.info("  [-] studio is not in English, switching the account language")
+                await self.change_language(page)
+                await page.goto(UPLOAD_URL)
+                await self.open_upload_page(page)
+                upload_button = self.locator_base.locator('button:has-text("Select video"):visible')
+                await upload_button.wait_for(state='visible')
+            set_english_account(self.account_file)
+        try:
+            await upload_button.wait_for(state='visible')  # Ensure button is visible
+        except Exception:
+            # the account language changed since it was cached, check it again on the next upload
+            set_english_account(self.account_file, False)
+            raise
 
         async with page.expect_file_chooser() as fc_info:
             await upload_button.click()
         file_chooser = await fc_info.value
+        # track the chunk requests for bytes sent, throughput and ETA
+        progress = UploadProgressTracker(page, self.file_path, SOCIAL_MEDIA_TIKTOK, self.progress_callback,
+                                         tiktok_logger).start()
         await file_chooser.set_files(self.file_path)
 
-        await self.add_title_tags(page)
+        # typing into the editor is not repeatable, so that step is not retried on the page
+        await self.checkpoint.step(STEP_FORM_FILLED, lambda: self.add_title_tags(page), retries=0)
         # detect upload status
+        self.checkpoint.begin(STEP_UPLOADED)
         await self.detect_upload_status(page)
-        if self.thumbnail_path:
+        await progress.stop()
+        self.checkpoint.mark(STEP_UPLOADED)
+        # later steps are retried on this page, without transferring the video again
+        await self.checkpoint.step(STEP_PUBLISHED, lambda: self.publish(page))
+        await self.checkpoint.step(STEP_COOKIE_SAVED, lambda: self.save_cookie(page))
+        await asyncio.sleep(2)  # close delay for look the video status
+
+    async def publish(self, page: Page):
+        if self.thumbnail_path and not self.thumbnail_done:
             tiktok_logger.info(f'[+] Uploading thumbnail file {self.title}.png')
             await self.upload_thumbnails(page)
+            self.thumbnail_done = True
 
         if self.publish_date != 0:
             await self.set_schedule_time(page, self.publish_date)
 
         await self.click_publish(page)
 
-        await context.storage_state(path=f"{self.account_file}")  # save cookie
+    async def save_cookie(self, page: Page):
+        await page.context.storage_state(path=f"{self.account_file}")  # save cookie
+        remember_cookie_check(self.account_file, True)
         tiktok_logger.info('  [-] update cookie！')
-        await asyncio.sleep(2)  # close delay for look the video status
-        # close all
-        await context.close()
-        await browser.close()
 
     async def add_title_tags(self, page):
 
@@ -230,15 +332,17 @@ class TiktokVideo(object):
             await page.keyboard.press("End")
 
     async def upload_thumbnails(self, page):
-        await self.locator_base.locator(".cover-selector-image-container").click()
-        await self.locator_base.locator(".cover-edit-container >> text=Upload cover").click()
-        async with page.expect_file_chooser() as fc_info:
-            await self.locator_base.locator(".upload-image-upload-area").click()
-            file_chooser = await fc_info.value
-            await file_chooser.set_files(self.thumbnail_path)
-        await self.locator_base.locator('div.cover-edit-panel:not(.hide-panel)').get_by_role(
-            "button", name="Confirm").click()
-        await page.wait_for_timeout(3000)  # wait 3s, fix it later
+        # the cover editor renders the cover and video frames as images, let them load meanwhile
+        with images_allowed(page.context):
+            await self.locator_base.locator(".cover-selector-image-container").click()
+            await self.locator_base.locator(".cover-edit-container >> text=Upload cover").click()
+            async with page.expect_file_chooser() as fc_info:
+                await self.locator_base.locator(".upload-image-upload-area").click()
+                file_chooser = await fc_info.value
+                await file_chooser.set_files(self.thumbnail_path)
+            await self.locator_base.locator('div.cover-edit-panel:not(.hide-panel)').get_by_role(
+                "button", name="Confirm").click()
+            await page.wait_for_timeout(3000)  # wait 3s, fix it later
 
     async def change_language(self, page):
         # set the language to english
@@ -252,6 +356,8 @@ class TiktokVideo(object):
 
     async def click_publish(self, page):
         success_flag_div = 'div.common-modal-confirm-modal'
+        # raises once the attempt overran, so the publish step is retried
+        deadline = self.checkpoint.attempt_deadline()
         while True:
             try:
                 publish_button = self.locator_base.locator('div.button-group button').nth(0)
@@ -266,29 +372,35 @@ class TiktokVideo(object):
                     tiktok_logger.success("  [-]video published success")
                     break
                 else:
+                    self.checkpoint.raise_if_expired(deadline, e)
                     tiktok_logger.exception(f"  [-] Exception: {e}")
                     tiktok_logger.info("  [-] video publishing")
-                    await page.screenshot(full_page=True)
                     await asyncio.sleep(0.5)
 
     async def detect_upload_status(self, page):
+        # driven by DOM events: the Post button losing its disabled attribute means the upload finished,
+        # the "Select file" button coming back means the upload failed and is retried
+        enabled_post = self.locator_base.locator('div.button-group > button:not([disabled]) >> text=Post').first
+        select_file = self.locator_base.locator('button[aria-label="Select file"]').first
+        tiktok_logger.info("  [-] video uploading...")
         while True:
-            try:
-                # if await self.locator_base.locator('div.btn-post > button').get_attribute("disabled") is None:
-                if await self.locator_base.locator(
-                        'div.button-group > button >> text=Post').get_attribute("disabled") is None:
-                    tiktok_logger.info("  [-]video uploaded.")
-                    break
-                else:
-                    tiktok_logger.info("  [-] video uploading...")
-                    await asyncio.sleep(2)
-                    if await self.locator_base.locator(
-                            'button[aria-label="Select file"]').count():
-                        tiktok_logger.info("  [-] found some error while uploading now retry...")
-                        await self.handle_upload_error(page)
-            except:
-                tiktok_logger.info("  [-] video uploading...")
-                await asyncio.sleep(2)
+            event = await wait_for_first({
+                'done': enabled_post.wait_for(state='attached', timeout=0),
+                'failed': select_file.wait_for(state='attached', timeout=0),
+            })
+            if event == 'done':
+                tiktok_logger.info("  [-]video uploaded.")
+                return
+            tiktok_logger.info("  [-] found some error while uploading now retry...")
+            await self.handle_upload_error(page)
+            # keep listening once the retry button is gone, so one error never triggers two retries
+            event = await wait_for_first({
+                'done': enabled_post.wait_for(state='attached', timeout=0),
+                'cleared': select_file.wait_for(state='detached', timeout=0),
+            })
+            if event == 'done':
+                tiktok_logger.info("  [-]video uploaded.")
+                return
 
     async def choose_base_locator(self, page):
         # await page.wait_for_selector('div.upload-container')
@@ -297,6 +409,25 @@ class TiktokVideo(object):
         else:
             self.locator_base = page.locator(Tk_Locator.default) 
 
-    async def main(self):
-        async with async_playwright() as playwright:
-            await self.upload(playwright)
+    async def main(self, session=None):
+        # a video an earlier run already published is not published again (the run died before recording it)
+        self.checkpoint = await UploadCheckpoint.create(SOCIAL_MEDIA_TIKTOK, self.account_file, self.file_path,
+                                                        tiktok_logger)
+        if await self.checkpoint.resume_published(session if isinstance(session, BrowserLease) else None):
+            return
+        # reuse the validated session returned by tiktok_setup(keep_session=True), saving a browser launch
+        if isinstance(session, BrowserLease):
+            try:
+                async with capture_on_failure(session.page, SOCIAL_MEDIA_TIKTOK, self.file_path, self.diagnostics):
+                    await self.upload(session.page)
+            finally:
+                await session.release()
+            return
+        # lease a context from the browser pool, the pool closes it and recycles the browser afterwards
+        launch_options = self.launch_options()
+        async with browser_pool() as pool, \
+                pool.new_context(launch_options, SOCIAL_MEDIA_TIKTOK, storage_state=f"{self.account_file}",
+                                 **LOCALE_OPTIONS) as context:
+            page = await context.new_page()
+            async with capture_on_failure(page, SOCIAL_MEDIA_TIKTOK, self.file_path, self.diagnostics):
+                await self.upload(page)
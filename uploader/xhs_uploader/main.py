@@ -1,12 +1,18 @@
 import configparser
 import json
 import pathlib
+import threading
+import time
 from time import sleep
+from typing import Dict, List, Optional, Tuple
 
 import requests
 from playwright.sync_api import sync_playwright
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from conf import BASE_DIR, XHS_SERVER
+from utils.config_manager import get_config
 
 config = configparser.RawConfigParser()
 config.read('accounts.ini')
@@ -43,10 +49,57 @@ def sign_local(uri, data=None, a1="", web_session=""):
     raise Exception("Tried so many times but still can't get signature successfully, giving up")
 
 
+_session: Optional[requests.Session] = None
+_lock = threading.Lock()
+# Signatures fetched ahead by prefetch_signs(), used once by sign()
+_prefetched: Dict[Tuple[str, str, str], Tuple[float, Dict[str, str]]] = {}
+
+
+def _settings(key: str, default):
+    return get_config().get(f"platforms.xhs.settings.{key}", default)
+
+
+def sign_server_url() -> str:
+    return (_settings("sign_server", None) or XHS_SERVER).rstrip("/")
+
+
+def sign_session() -> requests.Session:
+    """
+    Keep-alive connection pool to the sign server, shared by every XhsClient in the process.
+    Connection errors and 502/503/504 are retried up to sign_retries times with backoff.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            retry = Retry(total=_settings("sign_retries", 3), backoff_factor=0.3,
+                          status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET", "POST"]),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_settings("sign_pool_size", 8), max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def _sign_timeout():
+    return _settings("sign_connect_timeout", 3), _settings("sign_timeout", 30)
+
+
+def _prefetch_key(uri, data, a1) -> Tuple[str, str, str]:
+    return uri, json.dumps(data, sort_keys=True, ensure_ascii=False), a1
+
+
 def sign(uri, data=None, a1="", web_session=""):
     # Fill in your own flask signature service port address
-    res = requests.post(f"{XHS_SERVER}/sign",
-                        json={"uri": uri, "data": data, "a1": a1, "web_session": web_session})
+    with _lock:
+        prefetched = _prefetched.pop(_prefetch_key(uri, data, a1), None)
+    if prefetched is not None and time.time() - prefetched[0] < _settings("sign_cache_ttl", 60):
+        return prefetched[1]
+    res = sign_session().post(f"{sign_server_url()}/sign",
+                              json={"uri": uri, "data": data, "a1": a1, "web_session": web_session},
+                              timeout=_sign_timeout())
+    res.raise_for_status()
     signs = res.json()
     return {
         "x-s": signs["x-s"],
@@ -54,5 +107,45 @@ def sign(uri, data=None, a1="", web_session=""):
     }
 
 
+def sign_batch(items: List[Tuple[str, Optional[dict]]], a1="", web_session="") -> List[Optional[Dict[str, str]]]:
+    """
+    Sign many (uri, data) requests in one round-trip to the sign server's /sign/batch.
+    Returns the x-s/x-t headers per item in order, None for items the server failed to sign.
+    """
+    res = sign_session().post(f"{sign_server_url()}/sign/batch",
+                              json={"items": [{"uri": uri, "data": data} for uri, data in items],
+                                    "a1": a1, "web_session": web_session},
+                              timeout=_sign_timeout())
+    res.raise_for_status()
+    return [signs if "x-s" in signs else None for signs in res.json()["signs"]]
+
+
+def prefetch_signs(items: List[Tuple[str, Optional[dict]]], a1="", web_session="") -> int:
+    """
+    Sign requests that are about to be made with sign_batch(), so the following sign() calls for exactly
+    these (uri, data, a1) are answered without a round-trip. Entries expire after sign_cache_ttl seconds,
+    as the platform rejects old x-t timestamps. Returns the number of signatures prefetched.
+    """
+    results = sign_batch(items, a1, web_session)
+    now = time.time()
+    ttl = _settings("sign_cache_ttl", 60)
+    signed = 0
+    with _lock:
+        for key in [key for key, (fetched_at, _) in _prefetched.items() if now - fetched_at >= ttl]:
+            del _prefetched[key]
+        for (uri, data), signs in zip(items, results):
+            if signs is not None:
+                _prefetched[_prefetch_key(uri, data, a1)] = (now, signs)
+                signed += 1
+    return signed
+
+
+def topic_sign_items(keywords: List[str]) -> List[Tuple[str, dict]]:
+    """(uri, data) that XhsClient.get_suggest_topic() signs for each keyword, to pass to prefetch_signs()"""
+    return [("/web_api/sns/v1/search/topic",
+             {"keyword": keyword, "suggest_topic_request": {"title": "", "desc": ""},
+              "page": {"page_size": 20, "page": 1}}) for keyword in keywords]
+
+
 def beauty_print(data: dict):
     print(json.dumps(data, ensure_ascii=False, indent=2))
@@ -0,0 +1,344 @@
+"""
+XHS Sign Server
+A long-lived signing service for the xhs client: one Chromium, a warm xiaohongshu.com page per a1 cookie,
+so a signature is a single window._webmsxyw evaluation instead of a browser launch and page load.
+Serves the same POST /sign contract as XHS_SERVER, plus POST /sign/batch and GET /health
+"""
+
+import asyncio
+import json
+import signal
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from loguru import logger
+from playwright.async_api import async_playwright, BrowserContext, Page
+
+from conf import BASE_DIR, XHS_SERVER
+from utils.base_social_media import get_browser_executable_path, get_browser_launch_options
+from utils.config_manager import get_config
+from utils.metrics import metrics
+
+XHS_HOME = "https://www.xiaohongshu.com"
+STEALTH_JS = BASE_DIR / "utils" / "stealth.min.js"
+SIGN_JS = "([url, data]) => window._webmsxyw(url, data)"
+READY_JS = "typeof window._webmsxyw === 'function'"
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}
+
+
+class SignError(Exception):
+    """No signature after every retry on a fresh page"""
+
+
+def sign_server_address():
+    """Host and port of platforms.xhs.settings.sign_server, falling back to conf.XHS_SERVER"""
+    address = urlsplit(get_config().get("platforms.xhs.settings.sign_server") or XHS_SERVER)
+    return address.hostname or "127.0.0.1", address.port or 11901
+
+
+class SignPage(object):
+    """A page of xiaohongshu.com loaded with one a1 cookie, in its own browser context"""
+
+    def __init__(self, a1: str, context: BrowserContext, page: Page):
+        self.a1 = a1
+        self.context = context
+        self.page = page
+        self.created = self.last_used = time.monotonic()
+        self.signs = 0
+        self.lock = asyncio.Lock()
+
+    def stale(self, now: float, ttl: float, max_signs: int, idle_timeout: float) -> Optional[str]:
+        """Why the page should be recycled without probing it, None while it is fresh"""
+        if self.page.is_closed():
+            return "closed"
+        if ttl and now - self.created > ttl:
+            return "ttl"
+        if max_signs and self.signs >= max_signs:
+            return "max_signs"
+        if idle_timeout and now - self.last_used > idle_timeout:
+            return "idle"
+        return None
+
+
+class XhsSignService(object):
+    """
+    Warm pages are kept per a1 value, at most max_pages of them (least recently used evicted). A page is
+    recycled when a signature fails on it, when it is older than page_ttl, has signed max_signs_per_page
+    times or sat idle for idle_timeout, and when the periodic health check finds _webmsxyw gone.
+    Settings come from platforms.xhs.settings.sign_service in config.yaml.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        settings = settings if settings is not None else \
+            get_config().get("platforms.xhs.settings.sign_service", {}) or {}
+        self.max_pages = settings.get("max_pages", 4)
+        self.page_ttl = settings.get("page_ttl", 3600)
+        self.max_signs = settings.get("max_signs_per_page", 1000)
+        self.idle_timeout = settings.get("idle_timeout", 1800)
+        self.health_interval = settings.get("health_interval", 60)
+        self.ready_timeout = settings.get("ready_timeout", 15)
+        self.retries = settings.get("retries", 2)
+        self.max_batch = settings.get("max_batch", 100)
+        self._playwright = None
+        self._browser = None
+        self._pages: "OrderedDict[str, SignPage]" = OrderedDict()
+        # Per a1, only while its page is kept or a caller is in _page() for it
+        self._opening: Dict[str, asyncio.Lock] = {}
+        self._opening_users: Dict[str, int] = {}
+        self._launch_lock = asyncio.Lock()
+        self._health_task: Optional[asyncio.Future] = None
+
+    async def start(self):
+        self._playwright = await async_playwright().start()
+        await self._ensure_browser()
+        self._health_task = asyncio.ensure_future(self._health_loop())
+        return self
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+        for entry in list(self._pages.values()):
+            await self._recycle(entry, "shutdown")
+        if self._browser is not None and self._browser.is_connected():
+            await self._browser.close()
+        if self._playwright is not None:
+            await self._playwright.stop()
+
+    async def _ensure_browser(self):
+        async with self._launch_lock:
+            if self._browser is not None and self._browser.is_connected():
+                return
+            if self._browser is not None:
+                logger.warning("[xhs-sign] browser disconnected, relaunching")
+                self._pages.clear()
+                self._opening = {a1: lock for a1, lock in self._opening.items() if a1 in self._opening_users}
+            options = get_browser_launch_options(executable_path=get_browser_executable_path(), headless=True)
+            self._browser = await self._playwright.chromium.launch(**options)
+            logger.info(f"[xhs-sign] Chromium {self._browser.version} started")
+
+    async def _open(self, a1: str) -> SignPage:
+        await self._ensure_browser()
+        started = time.monotonic()
+        context = await self._browser.new_context()
+        try:
+            await context.add_init_script(path=STEALTH_JS)
+            page = await context.new_page()
+            await page.goto(XHS_HOME)
+            if a1:
+                await context.add_cookies([{'name': 'a1', 'value': a1, 'domain': ".xiaohongshu.com", 'path': "/"}])
+                await page.reload()
+            # Signing right after the cookie is set fails until the page scripts are back; wait for them
+            # instead of sleeping a fixed time
+            await page.wait_for_function(READY_JS, timeout=self.ready_timeout * 1000)
+        except Exception:
+            await context.close()
+            raise
+        metrics.inc("xhs_sign_pages_opened_total")
+        logger.info(f"[xhs-sign] warm page ready in {time.monotonic() - started:.1f}s")
+        return SignPage(a1, context, page)
+
+    async def _page(self, a1: str) -> SignPage:
+        lock = self._opening.setdefault(a1, asyncio.Lock())
+        self._opening_users[a1] = self._opening_users.get(a1, 0) + 1
+        try:
+            async with lock:
+                entry = self._pages.get(a1)
+                if entry is None or entry.page.is_closed():
+                    entry = await self._open(a1)
+                    self._pages[a1] = entry
+                self._pages.move_to_end(a1)
+                await self._evict(keep=entry)
+                metrics.set("xhs_sign_pages", len(self._pages))
+                return entry
+        finally:
+            self._opening_users[a1] -= 1
+            if not self._opening_users[a1]:
+                del self._opening_users[a1]
+                if a1 not in self._pages:
+                    self._opening.pop(a1, None)
+
+    async def _evict(self, keep: SignPage):
+        """Recycle least recently used pages down to max_pages; a page signing right now stays until a later call"""
+        while len(self._pages) > self.max_pages:
+            idle = [entry for entry in self._pages.values() if entry is not keep and not entry.lock.locked()]
+            if not idle:
+                return
+            await self._recycle(idle[0], "evicted")
+
+    async def _recycle(self, entry: SignPage, reason: str):
+        if self._pages.get(entry.a1) is entry:
+            del self._pages[entry.a1]
+            if entry.a1 not in self._opening_users:
+                self._opening.pop(entry.a1, None)
+        metrics.inc("xhs_sign_pages_recycled_total", reason=reason)
+        metrics.set("xhs_sign_pages", len(self._pages))
+        try:
+            await entry.context.close()
+        except Exception:
+            pass
+
+    async def sign(self, uri: str, data=None, a1: str = "", web_session: str = "") -> Dict[str, str]:
+        """Headers for one signed request, retried on a fresh page when the warm page fails"""
+        error = None
+        for attempt in range(self.retries + 1):
+            started = time.monotonic()
+            entry = None
+            try:
+                entry = await self._page(a1)
+                async with entry.lock:
+                    encrypt_params = await entry.page.evaluate(SIGN_JS, [uri, data])
+            except Exception as e:
+                error = e
+                metrics.inc("xhs_sign_failures_total")
+                logger.warning(f"[xhs-sign] sign failed ({attempt + 1}/{self.retries + 1}): {e}")
+                # Only the page that failed: another caller may already have replaced it with a fresh one
+                if entry is not None:
+                    await self._recycle(entry, "failed")
+                continue
+            entry.signs += 1
+            entry.last_used = time.monotonic()
+            metrics.inc("xhs_sign_total")
+            metrics.inc("xhs_sign_seconds_total", entry.last_used - started)
+            return {"x-s": encrypt_params["X-s"], "x-t": str(encrypt_params["X-t"])}
+        raise SignError(f"no signature after {self.retries + 1} attempts: {error}")
+
+    async def sign_many(self, items: List[Tuple[str, Any]], a1: str = "", web_session: str = "") -> List[Dict]:
+        """Sign every (uri, data) on the warm page of a1; a failed item gets an error instead of headers"""
+        signs = []
+        for uri, data in items:
+            try:
+                signs.append(await self.sign(uri, data, a1, web_session))
+            except SignError as e:
+                signs.append({"error": str(e)})
+        metrics.inc("xhs_sign_batches_total")
+        return signs
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            now = time.monotonic()
+            for entry in list(self._pages.values()):
+                reason = entry.stale(now, self.page_ttl, self.max_signs, self.idle_timeout)
+                if reason is None and not entry.lock.locked():
+                    try:
+                        if not await entry.page.evaluate(READY_JS):
+                            reason = "unhealthy"
+                    except Exception:
+                        reason = "unhealthy"
+                if reason is not None:
+                    logger.info(f"[xhs-sign] recycling page ({reason}) after {entry.signs} signatures")
+                    await self._recycle(entry, reason)
+
+    def health(self) -> Dict[str, Any]:
+        connected = self._browser is not None and self._browser.is_connected()
+        return {"status": "ok" if connected else "down", "pages": len(self._pages),
+                "signs": sum(entry.signs for entry in self._pages.values())}
+
+
+class SignServer(object):
+    """
+    Minimal HTTP/1.1 front of the service on asyncio streams, keeping client connections alive.
+    POST /sign/batch takes {"items": [{"uri", "data"}, ...], "a1", "web_session"} and answers
+    {"signs": [...]} in item order, so bulk callers sign many requests in one round-trip.
+    """
+
+    def __init__(self, service: XhsSignService):
+        self.service = service
+        self._writers = set()
+
+    def close_connections(self):
+        """Close idle keep-alive connections, so shutdown does not wait for the clients to hang up"""
+        for writer in list(self._writers):
+            writer.close()
+
+    async def route(self, method: str, path: str, body: bytes):
+        if path in ("/", "/health") and method == "GET":
+            health = self.service.health()
+            return (200 if health["status"] == "ok" else 503), health
+        if path == "/sign" and method == "POST":
+            try:
+                params = json.loads(body or b"{}")
+                uri = params["uri"]
+            except (ValueError, KeyError, TypeError):
+                return 400, {"error": "expected a JSON body with uri, data, a1, web_session"}
+            try:
+                return 200, await self.service.sign(uri, params.get("data"), params.get("a1") or "",
+                                                    params.get("web_session") or "")
+            except SignError as e:
+                return 503, {"error": str(e)}
+        if path == "/sign/batch" and method == "POST":
+            try:
+                params = json.loads(body or b"{}")
+                items = [(item["uri"], item.get("data")) for item in params["items"]]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return 400, {"error": "expected a JSON body with items [{uri, data}], a1, web_session"}
+            if len(items) > self.service.max_batch:
+                return 400, {"error": f"at most {self.service.max_batch} items per batch"}
+            return 200, {"signs": await self.service.sign_many(items, params.get("a1") or "",
+                                                               params.get("web_session") or "")}
+        return 404, {"error": f"no route {method} {path}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                status, payload = await self.route(method, target.split("?", 1)[0], body)
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                head = (f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                        f"Content-Type: application/json\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+                writer.write(head.encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+async def run_sign_server(host: Optional[str] = None, port: Optional[int] = None):
+    """Serve /sign until SIGINT/SIGTERM"""
+    default_host, default_port = sign_server_address()
+    host, port = host or default_host, port or default_port
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows event loops have no signal handlers, Ctrl+C still raises KeyboardInterrupt there
+            pass
+
+    service = await XhsSignService().start()
+    sign_server = SignServer(service)
+    server = await asyncio.start_server(sign_server.handle, host, port)
+    logger.success(f"[xhs-sign] signing on http://{host}:{port}/sign")
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        sign_server.close_connections()
+        await server.wait_closed()
+        await service.close()
+        logger.info("[xhs-sign] stopped")
@@ -1,13 +1,17 @@
+import os
+import platform as sys_platform
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional
 
-from conf import BASE_DIR
+from conf import BASE_DIR, LOCAL_CHROME_PATH
+from utils.config_manager import get_config, get_config_value
 
 SOCIAL_MEDIA_DOUYIN = "douyin"
 SOCIAL_MEDIA_TENCENT = "tencent"
 SOCIAL_MEDIA_TIKTOK = "tiktok"
 SOCIAL_MEDIA_BILIBILI = "bilibili"
 SOCIAL_MEDIA_KUAISHOU = "kuaishou"
+SOCIAL_MEDIA_XHS = "xhs"
 
 
 def get_supported_social_media() -> List[str]:
@@ -18,7 +22,83 @@ def get_cli_action() -> List[str]:
     return ["upload", "login", "watch"]
 
 
-async def set_init_script(context):
+# Flags that trim Chromium's footprint so more upload workers fit on one server
+LOW_MEMORY_ARGS = [
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--no-first-run",
+    "--mute-audio",
+    "--disable-site-isolation-trials",
+    "--renderer-process-limit=2",
+    "--disable-features=Translate,MediaRouter,OptimizationHints",
+]
+
+
+def _as_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def get_browser_executable_path() -> Optional[str]:
+    """System browser from ConfigManager, then conf.LOCAL_CHROME_PATH; None falls back to Playwright's Chromium"""
+    for path in (get_config().get_browser_path(), LOCAL_CHROME_PATH):
+        if path and os.path.exists(path):
+            return path
+    return None
+
+
+def use_dev_shm() -> bool:
+    """
+    browser.dev_shm policy: "shared" always uses /dev/shm, "disabled" never does,
+    "auto" only when /dev/shm is large enough for every browser sharing it (docker defaults to 64MB)
+    """
+    policy = get_config().get("browser.dev_shm", "auto")
+    if policy in ("shared", "disabled"):
+        return policy == "shared"
+    if sys_platform.system().lower() != "linux":
+        return True
+    try:
+        stat = os.statvfs("/dev/shm")
+    except OSError:
+        return False
+    return stat.f_blocks * stat.f_frsize >= get_config().get("browser.dev_shm_min_mb", 512) * 1024 * 1024
+
+
+def get_browser_launch_options(executable_path: Optional[str] = None, headless: Optional[bool] = None) -> Dict[str, Any]:
+    """Build Playwright launch options from ConfigManager (headless, slow_mo, args, low-memory and /dev/shm policy)"""
+    config = get_config()
+    if headless is None:
+        headless = _as_bool(get_config_value("browser.headless", False)) or \
+                   _as_bool(config.get("development.headless", False))
+    options: Dict[str, Any] = {"headless": headless}
+
+    args = list(config.get_browser_args())
+    if _as_bool(config.get("browser.low_memory", False)):
+        args += LOW_MEMORY_ARGS
+    args = [arg for arg in args if arg != "--disable-dev-shm-usage"]
+    if not use_dev_shm():
+        args.append("--disable-dev-shm-usage")
+    if args:
+        options["args"] = list(dict.fromkeys(args))
+
+    slow_mo = config.get("development.slow_mo", 0)
+    if slow_mo:
+        options["slow_mo"] = slow_mo
+    if executable_path:
+        options["executable_path"] = executable_path
+    return options
+
+
+async def set_init_script(context, platform: str = None):
     stealth_js_path = Path(BASE_DIR / "utils/stealth.min.js")
     await context.add_init_script(path=stealth_js_path)
+    # 登录页需要加载二维码等图片，只有指定了平台的上传/校验上下文才拦截重资源
+    if platform:
+        from utils.request_filter import apply_request_filter
+        await apply_request_filter(context, platform)
     return context
@@ -0,0 +1,43 @@
+"""
+Browser Daemon
+A long-lived Chrome exposing the DevTools protocol, so short CLI invocations attach to it
+with connect_over_cdp instead of launching a browser each time
+"""
+
+import asyncio
+import signal
+
+from loguru import logger
+from playwright.async_api import async_playwright
+
+from utils.base_social_media import get_browser_executable_path, get_browser_launch_options
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9222
+
+
+async def run_browser_daemon(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    """Launch Chrome with a remote debugging port and keep it running until SIGINT/SIGTERM or the browser exits"""
+    launch_options = get_browser_launch_options(executable_path=get_browser_executable_path())
+    launch_options["args"] = launch_options.get("args", []) + [
+        f"--remote-debugging-address={host}",
+        f"--remote-debugging-port={port}",
+    ]
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows event loops have no signal handlers, Ctrl+C still raises KeyboardInterrupt there
+            pass
+
+    async with async_playwright() as playwright:
+        browser = await playwright.chromium.launch(**launch_options)
+        browser.on("disconnected", lambda _: stop.set())
+        logger.success(f"[browser-daemon] Chrome {browser.version} listening on http://{host}:{port}")
+        logger.info(f"[browser-daemon] run uploads with --cdp-endpoint http://{host}:{port}")
+        await stop.wait()
+        if browser.is_connected():
+            await browser.close()
+        logger.info("[browser-daemon] stopped")
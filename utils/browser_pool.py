@@ -0,0 +1,312 @@
+"""
+Browser Pool
+Process-wide pool of warm Playwright browsers that leases a fresh BrowserContext per upload job
+"""
+
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page
+
+from utils.base_social_media import set_init_script
+from utils.browser_profiles import profiles_enabled, profile_dir, cap_profile, gc_profiles, storage_state_cookies, \
+    persistent_context_options
+from utils.config_manager import get_config, get_config_value
+from utils.request_filter import apply_request_filter
+
+
+class PooledBrowser(object):
+    """A launched browser and its lease bookkeeping"""
+
+    def __init__(self, key: str, browser: Optional[Browser] = None):
+        self.key = key
+        # None while the slot's browser is launching, see ready
+        self.browser = browser
+        self.ready = asyncio.Event()
+        if browser is not None:
+            self.ready.set()
+        self.jobs = 0
+        self.leases = 0
+        self.retired = False
+
+    @property
+    def healthy(self) -> bool:
+        return not self.retired and (self.browser is None or self.browser.is_connected())
+
+
+class BrowserLease(object):
+    """A leased context, optionally with an already loaded page, that must be released back to the pool"""
+
+    def __init__(self, pool: "BrowserPool", slot: Optional[PooledBrowser], context: BrowserContext,
+                 profile_lock: Optional[asyncio.Lock] = None):
+        self.pool = pool
+        # slot is None for a persistent profile context, which owns its browser process
+        self.slot = slot
+        self.context = context
+        self.profile_lock = profile_lock
+        self.page: Optional[Page] = None
+        self.released = False
+
+    async def hand_over(self, page: Page, keep_session: bool) -> Optional["BrowserLease"]:
+        """
+        Keep the lease open with `page` loaded so the caller can continue on it and return it, or release it
+        and return None. The lease can only outlive the current scope when an enclosing browser_pool() keeps
+        the pool open.
+        """
+        if keep_session and self.pool.depth > 1:
+            self.page = page
+            return self
+        await self.release()
+        return None
+
+    async def release(self):
+        await self.pool.release(self)
+
+
+class BrowserPool:
+    """
+    Keeps up to `size` browsers warm per launch configuration and recycles them after `max_jobs` leases.
+    With a CDP endpoint (browser.cdp_endpoint) the pool attaches to a running browser daemon instead of launching.
+    """
+
+    def __init__(self, size: Optional[int] = None, max_jobs: Optional[int] = None,
+                 cdp_endpoint: Optional[str] = None):
+        config = get_config()
+        self.size = size or config.get("browser.pool.size", 2)
+        self.max_jobs = max_jobs or config.get("browser.pool.max_jobs_per_browser", 20)
+        self.cdp_endpoint = cdp_endpoint or get_config_value("browser.cdp_endpoint", None)
+        self.loop = asyncio.get_event_loop()
+        self._playwright_manager = None
+        self._playwright = None
+        self._browsers: Dict[str, List[PooledBrowser]] = {}
+        self._lock = asyncio.Lock()
+        # A user-data-dir can only be opened by one browser at a time
+        self._profile_locks: Dict[str, asyncio.Lock] = {}
+        # Number of nested browser_pool() scopes currently using this pool
+        self.depth = 0
+
+    @staticmethod
+    def _options_key(launch_options: Dict[str, Any]) -> str:
+        return json.dumps(launch_options, sort_keys=True, default=str)
+
+    async def _start(self):
+        if self._playwright is None:
+            self._playwright_manager = async_playwright()
+            self._playwright = await self._playwright_manager.start()
+
+    async def _launch(self, launch_options: Dict[str, Any]) -> Browser:
+        if self.cdp_endpoint:
+            # Closing a browser attached over CDP only disconnects, the daemon keeps running
+            try:
+                browser = await self._playwright.chromium.connect_over_cdp(self.cdp_endpoint)
+                logger.info(f"[browser-pool] attached to browser at {self.cdp_endpoint}")
+                return browser
+            except Exception as e:
+                logger.warning(f"[browser-pool] cannot attach to {self.cdp_endpoint}, launching locally: {e}")
+        logger.info(f"[browser-pool] launching browser: {launch_options}")
+        return await self._playwright.chromium.launch(**launch_options)
+
+    @staticmethod
+    async def _close_browser(slot: PooledBrowser):
+        if slot.browser is None:
+            # Still launching, the launching lease closes it
+            return
+        try:
+            await slot.browser.close()
+        except Exception as e:
+            logger.warning(f"[browser-pool] failed to close browser: {e}")
+
+    async def _acquire(self, launch_options: Dict[str, Any]) -> PooledBrowser:
+        """
+        Pick or reserve a slot under the pool lock; a new browser is launched outside of it, so leases on the
+        other browsers are not held up by a launch. Leases given the slot meanwhile wait until it is ready.
+        """
+        key = self._options_key(launch_options)
+        launch = False
+        async with self._lock:
+            await self._start()
+            slots = self._browsers.setdefault(key, [])
+            # Health check: drop idle browsers that crashed or were retired
+            for slot in [s for s in slots if not s.healthy and s.leases == 0]:
+                slots.remove(slot)
+                await self._close_browser(slot)
+
+            candidates = [s for s in slots if s.healthy]
+            idle = [s for s in candidates if s.leases == 0]
+            if idle:
+                slot = idle[0]
+            elif len(candidates) < self.size:
+                slot = PooledBrowser(key)
+                slots.append(slot)
+                launch = True
+            else:
+                slot = min(candidates, key=lambda s: (s.leases, s.jobs))
+
+            slot.leases += 1
+            slot.jobs += 1
+            if slot.jobs >= self.max_jobs:
+                # No new leases; closed once the running ones are released
+                slot.retired = True
+
+        if launch:
+            try:
+                browser = await self._launch(launch_options)
+            except BaseException:
+                async with self._lock:
+                    slot.retired = True
+                    if slot in slots:
+                        slots.remove(slot)
+                slot.ready.set()
+                raise
+            slot.browser = browser
+            slot.ready.set()
+            async with self._lock:
+                closed = slot not in self._browsers.get(key, [])
+            if closed:
+                await self._close_browser(slot)
+                raise RuntimeError("browser pool closed while a browser was launching")
+            return slot
+
+        await slot.ready.wait()
+        if slot.browser is None:
+            # The launch this lease waited for failed: try again, possibly launching itself
+            async with self._lock:
+                slot.leases -= 1
+            return await self._acquire(launch_options)
+        return slot
+
+    async def _release(self, slot: PooledBrowser):
+        async with self._lock:
+            slot.leases -= 1
+            if slot.leases > 0 or slot.healthy:
+                return
+            slots = self._browsers.get(slot.key, [])
+            if slot in slots:
+                slots.remove(slot)
+            logger.info(f"[browser-pool] recycling browser after {slot.jobs} jobs")
+            await self._close_browser(slot)
+
+    async def _lease_profile(self, launch_options: Dict[str, Any], platform: str, **context_options) -> BrowserLease:
+        """
+        Open the account's persistent profile, with the cookies of its storage_state file.
+        Route interception disables Chromium's HTTP cache, so the request filter only observes here.
+        """
+        account_file = context_options["storage_state"]
+        user_data_dir = profile_dir(account_file)
+        lock = self._profile_locks.setdefault(str(user_data_dir), asyncio.Lock())
+        await lock.acquire()
+        try:
+            async with self._lock:
+                await self._start()
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, cap_profile, user_data_dir)
+            user_data_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f"[browser-pool] opening profile {user_data_dir}")
+            context = await self._playwright.chromium.launch_persistent_context(
+                **persistent_context_options(launch_options, context_options, user_data_dir))
+            try:
+                await context.add_cookies(storage_state_cookies(account_file))
+                context = await set_init_script(context)
+                await apply_request_filter(context, platform, mode="observe")
+            except Exception:
+                await context.close()
+                raise
+        except Exception:
+            lock.release()
+            raise
+        return BrowserLease(self, None, context, lock)
+
+    async def lease(self, launch_options: Optional[Dict[str, Any]] = None, platform: Optional[str] = None,
+                    **context_options) -> BrowserLease:
+        """Lease a fresh BrowserContext on a warm browser, the caller must release it"""
+        if platform and isinstance(context_options.get("storage_state"), (str, Path)) and profiles_enabled() \
+                and not self.cdp_endpoint:
+            return await self._lease_profile(launch_options or {}, platform, **context_options)
+        slot = await self._acquire(launch_options or {})
+        try:
+            context = await slot.browser.new_context(**context_options)
+            context = await set_init_script(context, platform)
+        except Exception:
+            await self._release(slot)
+            raise
+        return BrowserLease(self, slot, context)
+
+    async def release(self, lease: BrowserLease):
+        if lease.released:
+            return
+        lease.released = True
+        try:
+            await lease.context.close()
+        except Exception as e:
+            logger.warning(f"[browser-pool] failed to close context, retiring browser: {e}")
+            if lease.slot is not None:
+                lease.slot.retired = True
+        if lease.slot is not None:
+            await self._release(lease.slot)
+        if lease.profile_lock is not None:
+            lease.profile_lock.release()
+
+    @asynccontextmanager
+    async def new_context(self, launch_options: Optional[Dict[str, Any]] = None, platform: Optional[str] = None,
+                          **context_options):
+        """Lease a fresh BrowserContext on a warm browser, closing the context when done"""
+        lease = await self.lease(launch_options, platform, **context_options)
+        try:
+            yield lease.context
+        finally:
+            await self.release(lease)
+
+    async def close(self):
+        async with self._lock:
+            for slots in self._browsers.values():
+                for slot in slots:
+                    await self._close_browser(slot)
+            self._browsers = {}
+            if self._profile_locks:
+                await asyncio.get_event_loop().run_in_executor(None, gc_profiles)
+            if self._playwright_manager is not None:
+                await self._playwright_manager.__aexit__(None, None, None)
+                self._playwright_manager = None
+                self._playwright = None
+
+
+_active_pool: Optional[BrowserPool] = None
+
+
+def get_browser_pool() -> Optional[BrowserPool]:
+    """Get the pool opened on the running event loop, if any"""
+    if _active_pool is not None and _active_pool.loop is asyncio.get_event_loop():
+        return _active_pool
+    return None
+
+
+@asynccontextmanager
+async def browser_pool(**pool_options):
+    """
+    Reuse the pool already open on this event loop, or open one that is closed on exit.
+    Wrap a whole batch in `async with browser_pool():` so every upload inside it shares warm browsers.
+    `pool_options` (size, max_jobs, cdp_endpoint) only apply when a new pool is opened.
+    """
+    global _active_pool
+    pool = get_browser_pool()
+    if pool is not None:
+        pool.depth += 1
+        try:
+            yield pool
+        finally:
+            pool.depth -= 1
+        return
+
+    pool = BrowserPool(**pool_options)
+    pool.depth = 1
+    _active_pool = pool
+    try:
+        yield pool
+    finally:
+        if _active_pool is pool:
+            _active_pool = None
+        await pool.close()
@@ -0,0 +1,100 @@
+"""
+Browser Profiles
+Persistent per-account user-data-dirs kept next to the cookie files, so the creator portals'
+JS/CSS bundles stay in Chromium's HTTP disk cache between runs
+"""
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from conf import BASE_DIR
+from utils.base_social_media import _as_bool
+from utils.config_manager import get_config, get_config_value
+
+COOKIES_DIR = Path(BASE_DIR / "cookies")
+# Cache directories inside a profile that are safe to drop while the profile is closed
+CACHE_DIRS = ["Cache", "Code Cache", "GPUCache", "Service Worker/CacheStorage", "Service Worker/ScriptCache"]
+
+
+def profiles_enabled() -> bool:
+    return _as_bool(get_config_value("browser.profiles.enabled", False))
+
+
+def profile_dir(account_file) -> Path:
+    """
+    cookies/douyin_uploader/account.json -> cookies/douyin_uploader/profiles/account,
+    cookies/douyin_account.json (cli_main.py) -> cookies/profiles/douyin_account
+    """
+    account_file = Path(account_file)
+    return account_file.parent / "profiles" / account_file.stem
+
+
+def profile_in_use(path: Path) -> bool:
+    # Chromium keeps a SingletonLock symlink in the user-data-dir while it runs
+    return os.path.lexists(path / "SingletonLock")
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def disk_cache_args() -> List[str]:
+    return [f"--disk-cache-size={get_config().get('browser.profiles.disk_cache_mb', 200) * 1048576}"]
+
+
+def cap_profile(path: Path):
+    """Drop the cache directories of a closed profile that grew beyond browser.profiles.max_mb"""
+    max_bytes = get_config().get("browser.profiles.max_mb", 500) * 1048576
+    if not path.exists() or profile_in_use(path) or dir_size(path) <= max_bytes:
+        return
+    for cache_root in [path] + [p for p in path.iterdir() if p.is_dir()]:
+        for name in CACHE_DIRS:
+            shutil.rmtree(cache_root / name, ignore_errors=True)
+    logger.info(f"[profiles] {path} exceeded the size cap, caches cleared ({dir_size(path) // 1048576} MB left)")
+
+
+def gc_profiles(root: Path = COOKIES_DIR):
+    """Remove closed profiles that have not been used for browser.profiles.gc_days"""
+    max_age = get_config().get("browser.profiles.gc_days", 30) * 86400
+    now = time.time()
+    # Both layouts of profile_dir(): the upload tools' cookies/<platform>_uploader/ and cli_main.py's cookies/
+    for path in list(root.glob("profiles/*")) + list(root.glob("*/profiles/*")):
+        if not path.is_dir() or profile_in_use(path):
+            continue
+        if now - path.stat().st_mtime > max_age:
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info(f"[profiles] removed unused profile {path}")
+
+
+def storage_state_cookies(account_file) -> List[Dict[str, Any]]:
+    """Cookies of a storage_state file; the file stays the source of truth for the login session"""
+    try:
+        with open(account_file, 'r', encoding='utf-8') as f:
+            return json.load(f).get("cookies", [])
+    except (OSError, ValueError) as e:
+        logger.warning(f"[profiles] failed to read cookies from {account_file}: {e}")
+        return []
+
+
+def persistent_context_options(launch_options: Dict[str, Any], context_options: Dict[str, Any],
+                               user_data_dir: Optional[Path] = None) -> Dict[str, Any]:
+    """Merge launch and context options for launch_persistent_context, adding the disk cache cap"""
+    options = dict(launch_options)
+    options.update({k: v for k, v in context_options.items() if k != "storage_state"})
+    options["args"] = list(options.get("args", [])) + disk_cache_args()
+    if user_data_dir is not None:
+        options["user_data_dir"] = str(user_data_dir)
+    return options
@@ -0,0 +1,114 @@
+"""
+Checkpoints
+Upload steps reached per video and account, persisted in the record store. A video whose previous run
+got as far as publishing is never published again, and a failing step is retried on the still-open page
+instead of restarting the whole flow with its file transfer
+"""
+
+import asyncio
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from loguru import logger
+
+from utils.config_manager import get_config
+from utils.metrics import metrics
+from utils.record_store import RecordStore, get_record_store
+from utils.watchdog import heartbeat
+
+STEP_UPLOADED = "uploaded"
+STEP_FORM_FILLED = "form_filled"
+STEP_PUBLISHED = "published"
+STEP_COOKIE_SAVED = "cookie_saved"
+# Steps that stay done after the page is gone; the others only count within the current run
+DURABLE_STEPS = (STEP_PUBLISHED, STEP_COOKIE_SAVED)
+
+
+class UploadCheckpoint(object):
+    """Steps of one video upload on one account"""
+
+    def __init__(self, platform: str, account_file, file_path, log=logger, records: Optional[RecordStore] = None,
+                 key: Optional[str] = None):
+        config = get_config()
+        self.platform = platform
+        self.account_file = str(account_file)
+        self.records = records or get_record_store()
+        self.key = key or self.records.file_key(file_path)
+        self.log = log
+        self.step_retries = config.get("checkpoints.step_retries", 2)
+        self.retry_delay = config.get("checkpoints.retry_delay", 3)
+        self.attempt_timeout = config.get("checkpoints.attempt_timeout", 120)
+        persisted = self.records.checkpoint_steps(platform, self.account_file, self.key)
+        self._done = {step for step in persisted if step in DURABLE_STEPS}
+
+    @classmethod
+    async def create(cls, platform: str, account_file, file_path, log=logger,
+                     records: Optional[RecordStore] = None) -> "UploadCheckpoint":
+        """
+        Constructor for async uploaders: the file's content fingerprint reads the video (all of it when an
+        identical copy exists), so it is computed in the default executor instead of on the event loop
+        """
+        records = records or get_record_store()
+        key = await asyncio.get_event_loop().run_in_executor(None, records.file_key, file_path)
+        return cls(platform, account_file, file_path, log, records, key)
+
+    def done(self, step: str) -> bool:
+        return step in self._done
+
+    def begin(self, step: str):
+        """Enter a step that is not run through step(), so the watchdog applies its deadline"""
+        heartbeat(step)
+
+    def mark(self, step: str):
+        self._done.add(step)
+        self.records.mark_checkpoint(self.platform, self.account_file, self.key, step)
+
+    def attempt_deadline(self) -> float:
+        """Deadline of one attempt of a step that polls the page, e.g. clicking publish until it is confirmed"""
+        return time.monotonic() + self.attempt_timeout
+
+    def raise_if_expired(self, deadline: float, error: Exception):
+        """Fail the attempt once its deadline passed, so step() retries it or gives up"""
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"not confirmed within {self.attempt_timeout}s, last error: {error}") from error
+
+    async def step(self, step: str, action: Callable[[], Awaitable], retries: Optional[int] = None):
+        """
+        Run `action` unless the step is already done, retrying it on the same page up to `retries` times.
+        Steps that are not safe to repeat (typing into the form) pass retries=0.
+        """
+        if self.done(step):
+            self.log.info(f"  [-] step {step} already done, skipped")
+            return
+        heartbeat(step)
+        retries = self.step_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                await action()
+                break
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                metrics.inc("upload_step_retries_total", platform=self.platform, step=step)
+                self.log.warning(f"  [-] step {step} failed ({type(e).__name__}: {e}), "
+                                 f"retrying on the same page ({attempt + 1}/{retries})")
+                await asyncio.sleep(self.retry_delay)
+        self.mark(step)
+
+    async def resume_published(self, session=None) -> bool:
+        """
+        True when an earlier run already published this video. Its cookie save is finished on the
+        reused session if that run died before it; the session is released either way.
+        """
+        if not self.done(STEP_PUBLISHED):
+            return False
+        self.log.info(f"  [-] {Path(self.account_file).stem}: already published in an earlier run, skipped")
+        if session is not None:
+            try:
+                if not self.done(STEP_COOKIE_SAVED):
+                    await session.context.storage_state(path=self.account_file)
+                    self.mark(STEP_COOKIE_SAVED)
+            finally:
+                await session.release()
+        return True
@@ -48,7 +48,40 @@ class ConfigManager:
                 "chrome_path": "C:/Program Files/Google/Chrome/Application/chrome.exe",
                 "chrome_path_mac": "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome",
                 "chrome_path_linux": "/usr/bin/google-chrome",
-                "args": ["--no-sandbox", "--disable-dev-shm-usage"]
+                "args": ["--no-sandbox", "--disable-dev-shm-usage"],
+                "headless": False,
+                "low_memory": False,
+                "dev_shm": "auto",
+                "dev_shm_min_mb": 512,
+                "cdp_endpoint": None,
+                "pool": {
+                    "size": 2,
+                    "max_jobs_per_browser": 20
+                },
+                "profiles": {
+                    "enabled": False,
+                    "disk_cache_mb": 200,
+                    "max_mb": 500,
+                    "gc_days": 30
+                }
+            },
+            "request_filter": {
+                "enabled": True,
+                "mode": "block",
+                "block_types": ["image", "font", "media"]
+            },
+            "metrics": {
+                "dump_interval": 30
+            },
+            "cookie": {
+                "validity_ttl": 3600,
+                "max_age_days": 30
+            },
+            "diagnostics": {
+                "enabled": True,
+                "trace": False,
+                "max_entries": 50,
+                "max_mb": 200
             },
             "video": {
                 "video_dir": "videos",
@@ -60,13 +93,109 @@ class ConfigManager:
                 "default_publish_type": 0,
                 "default_daily_times": [6, 11, 14, 16, 22],
                 "max_uploads_per_day": 5,
-                "upload_interval": 30
+                "upload_interval": 30,
+                "rate_limits": {},
+                "progress": {
+                    "min_chunk_kb": 64,
+                    "log_interval": 10,
+                    "stall_timeout": 60
+                }
+            },
+            "batch": {
+                "max_contexts": 4,
+                "per_platform": 2,
+                "per_account": 1,
+                "platform_limits": {}
+            },
+            "folder_watch": {
+                "mode": "auto",
+                "settle_seconds": 30,
+                "poll_interval": 60,
+                "rescan_interval": 300,
+                "sidecars": [".txt"]
+            },
+            "queue": {
+                "db_file": "data/records/job_queue.db",
+                "workers": 2,
+                "poll_interval": 5,
+                "max_attempts": 3,
+                "retry_delay": 300,
+                "shutdown_timeout": 300
+            },
+            "records": {
+                "db_file": "data/records/records.db"
+            },
+            "schedule": {
+                "daily_times": None,
+                "per_day": None,
+                "start_days": 1,
+                "rules": {}
+            },
+            "checkpoints": {
+                "step_retries": 2,
+                "retry_delay": 3,
+                "attempt_timeout": 120
+            },
+            "deadlines": {
+                "job": 7200,
+                "check_interval": 5,
+                "steps": {
+                    "open": 600,
+                    "form_filled": 300,
+                    "uploaded": 5400,
+                    "published": 600,
+                    "cookie_saved": 60
+                }
+            },
+            "fingerprint": {
+                "block_kb": 64,
+                "samples": 16,
+                "use_duration": True
             },
             "platforms": {
                 "douyin": {"enabled": True},
                 "tencent": {"enabled": True},
-                "bilibili": {"enabled": True},
-                "xhs": {"enabled": True},
+                "bilibili": {
+                    "enabled": True,
+                    "settings": {
+                        "default_tid": 21,
+                        "upload_workers": 2,
+                        "lines": "AUTO",
+                        "line_cache_file": "data/records/bilibili_lines.json",
+                        "line_cache_ttl": 21600,
+                        "line_probe_kb": 1024,
+                        "upload_threads": 3,
+                        "adaptive_threads": True,
+                        "min_threads": 1,
+                        "max_threads": 8,
+                        "threads_window": 15,
+                        "parallel_parts": 3,
+                        "total_threads": 12,
+                        "bandwidth_mbps": 0
+                    }
+                },
+                "xhs": {
+                    "enabled": True,
+                    "settings": {
+                        "sign_server": "http://127.0.0.1:11901",
+                        "sign_method": "local",
+                        "sign_connect_timeout": 3,
+                        "sign_timeout": 30,
+                        "sign_retries": 3,
+                        "sign_pool_size": 8,
+                        "sign_cache_ttl": 60,
+                        "sign_service": {
+                            "max_pages": 4,
+                            "page_ttl": 3600,
+                            "max_signs_per_page": 1000,
+                            "idle_timeout": 1800,
+                            "health_interval": 60,
+                            "ready_timeout": 15,
+                            "retries": 2,
+                            "max_batch": 100
+                        }
+                    }
+                },
                 "tiktok": {"enabled": True},
                 "kuaishou": {"enabled": True}
             }
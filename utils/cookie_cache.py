@@ -0,0 +1,117 @@
+"""
+Cookie Cache
+Offline checks of storage_state files plus a TTL cache of browser-verified results,
+so expired cookie files fail fast and recently verified ones skip the browser probe
+"""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from conf import BASE_DIR
+from utils.base_social_media import SOCIAL_MEDIA_DOUYIN, SOCIAL_MEDIA_TENCENT, SOCIAL_MEDIA_TIKTOK, \
+    SOCIAL_MEDIA_KUAISHOU
+from utils.config_manager import get_config
+
+# A storage_state is rejected offline when none of these session cookies is present and unexpired
+SESSION_COOKIES = {
+    SOCIAL_MEDIA_DOUYIN: ["sessionid", "sessionid_ss", "sid_tt"],
+    SOCIAL_MEDIA_TIKTOK: ["sessionid", "sessionid_ss", "sid_tt"],
+    SOCIAL_MEDIA_TENCENT: ["sessionid", "wxuin"],
+    SOCIAL_MEDIA_KUAISHOU: ["kuaishou.web.cp.api_st", "userId"],
+}
+
+CACHE_FILE = Path(BASE_DIR / "cookies" / ".cookie_cache.json")
+
+
+def file_hash(account_file) -> str:
+    with open(account_file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def precheck_storage_state(account_file, platform: str) -> bool:
+    """Check the storage_state JSON itself; False means the file is unusable without opening a browser"""
+    try:
+        with open(account_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"[cookie] {account_file} unreadable: {e}")
+        return False
+
+    required = SESSION_COOKIES.get(platform)
+    if not required:
+        return True
+    now = time.time()
+    for cookie in state.get("cookies", []):
+        if cookie.get("name") not in required:
+            continue
+        expires = cookie.get("expires", -1)
+        # -1 marks a browser-session cookie without an expiry date
+        if expires is None or expires < 0 or expires > now:
+            return True
+    logger.warning(f"[cookie] {account_file} has no live session cookie for {platform}")
+    return False
+
+
+class CookieValidityCache:
+    """Last browser-verified result per storage_state file, keyed by file hash"""
+
+    def __init__(self, cache_file: Path = CACHE_FILE, ttl: Optional[int] = None):
+        self.cache_file = Path(cache_file)
+        self.ttl = ttl if ttl is not None else get_config().get("cookie.validity_ttl", 3600)
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries: Dict[str, Any]):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def get(self, account_file) -> Optional[bool]:
+        entry = self._load().get(file_hash(account_file))
+        if entry and time.time() - entry["checked_at"] < self.ttl:
+            return entry["valid"]
+        return None
+
+    def set(self, account_file, valid: bool):
+        now = time.time()
+        entries = {key: entry for key, entry in self._load().items() if now - entry["checked_at"] < self.ttl}
+        entries[file_hash(account_file)] = {"valid": valid, "checked_at": now}
+        self._save(entries)
+
+
+def offline_cookie_check(account_file, platform: str) -> Optional[bool]:
+    """
+    Decide cookie validity without a browser when possible.
+    Returns False for missing/expired files, True for a recently verified file, None when a browser probe is needed.
+    """
+    if not os.path.exists(account_file) or not precheck_storage_state(account_file, platform):
+        return False
+    # Files that have not been rewritten for a long time are always re-verified in the browser
+    max_age = get_config().get("cookie.max_age_days", 30) * 86400
+    if time.time() - os.path.getmtime(account_file) > max_age:
+        return None
+    valid = CookieValidityCache().get(account_file)
+    if valid is not None:
+        logger.info(f"[cookie] {Path(account_file).name} verified within ttl: {'valid' if valid else 'expired'}")
+    return valid
+
+
+def remember_cookie_check(account_file, valid: bool):
+    """Record a browser-verified result for the current content of the file"""
+    try:
+        CookieValidityCache().set(account_file, valid)
+    except OSError as e:
+        logger.warning(f"[cookie] failed to update validity cache: {e}")
@@ -0,0 +1,151 @@
+"""
+Diagnostics
+Failure-only capture of screenshots, page HTML and optional Playwright traces,
+written off the event loop into a size-capped ring buffer under logs/diagnostics
+"""
+
+import asyncio
+import json
+import shutil
+import time
+import traceback
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from loguru import logger
+from playwright.async_api import BrowserContext, Page
+
+from conf import BASE_DIR
+from utils.config_manager import get_config
+from utils.watchdog import current_step
+
+DIAGNOSTICS_DIR = Path(BASE_DIR / "logs" / "diagnostics")
+
+
+def _safe_name(value: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in value)[:60]
+
+
+def _write_files(entry_dir: Path, files: Dict[str, bytes]):
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    for name, data in files.items():
+        (entry_dir / name).write_bytes(data)
+
+
+def prune_diagnostics(root: Path = DIAGNOSTICS_DIR, max_entries: Optional[int] = None,
+                      max_mb: Optional[int] = None):
+    """Drop the oldest capture directories until both the entry and the size cap are met"""
+    config = get_config()
+    max_entries = max_entries if max_entries is not None else config.get("diagnostics.max_entries", 50)
+    max_bytes = (max_mb if max_mb is not None else config.get("diagnostics.max_mb", 200)) * 1048576
+    if not root.exists():
+        return
+    entries = sorted((p for p in root.iterdir() if p.is_dir()), key=lambda p: p.name)
+    sizes = {p: sum(f.stat().st_size for f in p.rglob("*") if f.is_file()) for p in entries}
+    total = sum(sizes.values())
+    while entries and (len(entries) > max_entries or total > max_bytes):
+        oldest = entries.pop(0)
+        total -= sizes[oldest]
+        shutil.rmtree(oldest, ignore_errors=True)
+
+
+class DiagnosticsRecorder(object):
+    """
+    Collects artifacts for one upload job. Nothing is rendered or written while the job goes well:
+    screenshots are taken in capture() only, and a trace (diagnostics.trace) is only saved when the job failed.
+    """
+
+    def __init__(self, platform: str, name: str):
+        config = get_config()
+        self.platform = platform
+        self.name = Path(name).stem
+        self.enabled = config.get("diagnostics.enabled", True)
+        self.trace = self.enabled and config.get("diagnostics.trace", False)
+        self.artifacts: List[str] = []
+        self._tracing = False
+
+    def _entry_dir(self, step: str) -> Path:
+        stamp = time.strftime("%Y%m%d-%H%M%S") + f"-{int(time.time() * 1000) % 1000:03d}"
+        return DIAGNOSTICS_DIR / f"{stamp}_{self.platform}_{_safe_name(self.name)}_{_safe_name(step)}"
+
+    async def _write(self, entry_dir: Path, files: Dict[str, bytes]):
+        # Disk writes and pruning run in the default executor so the event loop keeps serving other jobs
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, _write_files, entry_dir, files)
+        await loop.run_in_executor(None, prune_diagnostics)
+
+    async def start(self, context: BrowserContext):
+        if not self.trace:
+            return
+        try:
+            await context.tracing.start(screenshots=True, snapshots=True)
+            self._tracing = True
+        except Exception as e:
+            logger.warning(f"[diagnostics] failed to start tracing: {e}")
+
+    async def capture(self, page: Page, step: str, error: Optional[BaseException] = None) -> Optional[str]:
+        """Save a screenshot, the page HTML and the error of a failed step; never raises"""
+        if not self.enabled:
+            return None
+        entry_dir = self._entry_dir(step)
+        meta = {
+            "platform": self.platform,
+            "name": self.name,
+            "step": step,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "error": "".join(traceback.format_exception(type(error), error, error.__traceback__)) if error else None,
+        }
+        files = {}
+        try:
+            meta["url"] = page.url
+            files["screenshot.png"] = await page.screenshot(full_page=True)
+            files["page.html"] = (await page.content()).encode("utf-8")
+        except Exception as e:
+            meta["capture_error"] = str(e)
+        files["error.json"] = json.dumps(meta, ensure_ascii=False, indent=2).encode("utf-8")
+        try:
+            await self._write(entry_dir, files)
+        except OSError as e:
+            logger.warning(f"[diagnostics] failed to write {entry_dir}: {e}")
+            return None
+        self.artifacts.append(str(entry_dir))
+        logger.warning(f"[diagnostics] {self.platform} {step} failed, saved to {entry_dir}")
+        return str(entry_dir)
+
+    async def finish(self, context: BrowserContext, failed: bool):
+        if not self._tracing:
+            return
+        self._tracing = False
+        try:
+            if failed:
+                trace_file = self._entry_dir("trace") / "trace.zip"
+                await asyncio.get_event_loop().run_in_executor(None, _write_files, trace_file.parent, {})
+                await context.tracing.stop(path=trace_file)
+                self.artifacts.append(str(trace_file))
+                await asyncio.get_event_loop().run_in_executor(None, prune_diagnostics)
+            else:
+                await context.tracing.stop()
+        except Exception as e:
+            logger.warning(f"[diagnostics] failed to stop tracing: {e}")
+
+
+@asynccontextmanager
+async def capture_on_failure(page: Page, platform: str, name: str, artifacts: Optional[List[str]] = None):
+    """
+    Run an upload step on `page` and capture diagnostics only if it raises or is cancelled (timeouts).
+    Saved artifact paths are appended to `artifacts`, usually the uploader's job record.
+    """
+    recorder = DiagnosticsRecorder(platform, name)
+    await recorder.start(page.context)
+    failed = True
+    try:
+        yield recorder
+        failed = False
+    except (Exception, asyncio.CancelledError) as e:
+        await recorder.capture(page, current_step() or "upload", e)
+        raise
+    finally:
+        await recorder.finish(page.context, failed)
+        if artifacts is not None:
+            artifacts.extend(recorder.artifacts)
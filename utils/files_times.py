@@ -54,6 +54,8 @@ def get_title_and_hashtags(filename):
 def generate_schedule_time_next_day(total_videos, videos_per_day, daily_times=None, timestamps=False, start_days=0):
     """
     Generate a schedule for video uploads, starting from the next day.
+    For many accounts or platforms use utils.schedule_planner.SchedulePlanner, which also respects
+    platform lead times and the slots already booked.
 
     Args:
     - total_videos: Total number of videos to be uploaded.
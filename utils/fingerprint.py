@@ -0,0 +1,181 @@
+"""
+Fingerprint
+Content identity of large video files without reading them whole: the file size, a fixed number of
+blocks sampled across the file through mmap and the MP4 container duration. Fingerprints are cached
+by (device, inode, size, mtime), so a renamed or moved file is recognised without reading it again
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+
+from conf import BASE_DIR
+from utils.config_manager import get_config
+from utils.sqlite_db import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    sampled TEXT NOT NULL,
+    content_key TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (device, inode)
+);
+CREATE INDEX IF NOT EXISTS idx_fingerprints_sampled ON fingerprints (sampled);
+"""
+
+FINGERPRINT_VERSION = "fp1"
+# MP4 boxes whose children are searched for the movie header
+CONTAINER_BOXES = (b"moov",)
+
+
+def _boxes(buffer, start: int, end: int):
+    """Yield (type, payload start, box end) of the ISO BMFF boxes in buffer[start:end]"""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack(">I4s", buffer[offset:offset + 8])
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack(">Q", buffer[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def mp4_duration_ms(buffer) -> Optional[int]:
+    """Duration from the mvhd box of an MP4/MOV, None for other containers or damaged files"""
+    for box_type, start, end in _boxes(buffer, 0, len(buffer)):
+        if box_type not in CONTAINER_BOXES:
+            continue
+        for child_type, child_start, child_end in _boxes(buffer, start, end):
+            if child_type != b"mvhd":
+                continue
+            version = buffer[child_start]
+            if version == 1 and child_start + 32 <= child_end:
+                timescale, duration = struct.unpack(">IQ", buffer[child_start + 20:child_start + 32])
+            elif child_start + 20 <= child_end:
+                timescale, duration = struct.unpack(">II", buffer[child_start + 12:child_start + 20])
+            else:
+                return None
+            return int(duration * 1000 / timescale) if timescale else None
+    return None
+
+
+def sampled_fingerprint(file, block_size: int, samples: int, use_duration: bool = True) -> str:
+    """Hash of the size, `samples` evenly spaced blocks (first and last included) and the duration"""
+    size = os.path.getsize(file)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(size).encode())
+    if size:
+        with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if size <= block_size * samples:
+                digest.update(buffer[:])
+            else:
+                step = (size - block_size) / (samples - 1)
+                for index in range(samples):
+                    offset = int(index * step)
+                    digest.update(buffer[offset:offset + block_size])
+            duration = mp4_duration_ms(buffer) if use_duration else None
+            if duration is not None:
+                digest.update(f":{duration}".encode())
+    return f"{FINGERPRINT_VERSION}:{size}:{digest.hexdigest()}"
+
+
+def full_hash(file, chunk_size: int = 1024 * 1024) -> str:
+    """Hash of the whole file, only computed to tell apart files whose sampled fingerprints collide"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return f"full:{digest.hexdigest()}"
+
+
+class Fingerprinter(object):
+    """
+    Maps a file to its content key. A file unchanged since its last fingerprint is a single cache lookup.
+    When another live file has the same sampled fingerprint both are hashed in full: identical copies share
+    the key, a genuine collision gets the full hash as its own key.
+    """
+
+    def __init__(self, db_file=None):
+        config = get_config()
+        self.db_file = Path(db_file or BASE_DIR / config.get("records.db_file", "data/records/records.db"))
+        self.block_size = config.get("fingerprint.block_kb", 64) * 1024
+        self.samples = max(2, config.get("fingerprint.samples", 16))
+        self.use_duration = config.get("fingerprint.use_duration", True)
+        self._conn = connect(self.db_file, SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def _unchanged(row, stat: os.stat_result) -> bool:
+        return row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns
+
+    def _resolve_collision(self, file: Path, sampled: str, stat: os.stat_result) -> str:
+        with self._lock:
+            others = self._conn.execute(
+                "SELECT * FROM fingerprints WHERE sampled = ? AND NOT (device = ? AND inode = ?)",
+                (sampled, stat.st_dev, stat.st_ino)).fetchall()
+        if not others:
+            return sampled
+        own_hash = None
+        for other in others:
+            try:
+                other_stat = os.stat(other["path"])
+            except OSError:
+                # Moved or deleted since: this file is taken to be the same content
+                return other["content_key"]
+            if (other_stat.st_dev, other_stat.st_ino) != (other["device"], other["inode"]) \
+                    or not self._unchanged(other, other_stat):
+                return other["content_key"]
+            own_hash = own_hash or full_hash(file)
+            if full_hash(other["path"]) == own_hash:
+                return other["content_key"]
+        logger.warning(f"[fingerprint] sampled fingerprint collision for {file}, keyed by its full hash")
+        return own_hash
+
+    def content_key(self, file) -> str:
+        file = Path(file)
+        stat = file.stat()
+        if not stat.st_ino:
+            # Some network filesystems report no file ids, nothing to cache by
+            sampled = sampled_fingerprint(file, self.block_size, self.samples, self.use_duration)
+            return self._resolve_collision(file, sampled, stat)
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM fingerprints WHERE device = ? AND inode = ?",
+                                     (stat.st_dev, stat.st_ino)).fetchone()
+        if row is not None and self._unchanged(row, stat):
+            if row["path"] != str(file):
+                with self._lock:
+                    self._conn.execute(
+                        "UPDATE fingerprints SET path = ?, updated_at = ? WHERE device = ? AND inode = ?",
+                        (str(file), time.time(), stat.st_dev, stat.st_ino))
+            return row["content_key"]
+
+        sampled = sampled_fingerprint(file, self.block_size, self.samples, self.use_duration)
+        key = self._resolve_collision(file, sampled, stat)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fingerprints (device, inode, size, mtime_ns, path, sampled, content_key, "
+                "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, str(file), sampled, key, time.time()))
+        return key
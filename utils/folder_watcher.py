@@ -0,0 +1,395 @@
+"""
+Folder Watcher
+Incremental catalog of the videos under a folder: inotify (close_write / moved_to) where available,
+otherwise a scandir walk that skips listing directories whose mtime did not change. Network mounts are
+scanned, as inotify never reports files written there by other hosts
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from conf import BASE_DIR
+from utils.config_manager import get_config
+
+CATALOG_DIR = Path(BASE_DIR / "data" / "records")
+
+STATE_PENDING = "pending"        # seen, possibly still being written or waiting for its sidecar files
+STATE_READY = "ready"            # fully written and sidecars present
+STATE_EMITTED = "emitted"        # ready and already handed to watch() consumers
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+# Filesystem types (/proc/self/mounts) whose remote writes inotify does not see
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "lustre",
+                       "fuse.sshfs", "fuse.rclone", "fuse.s3fs", "davfs", "fuse.davfs2"}
+
+
+class Inotify(object):
+    """Minimal non-blocking inotify binding through ctypes"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths: Dict[int, str] = {}
+
+    @staticmethod
+    def available() -> bool:
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            return hasattr(ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6"), "inotify_init1")
+        except OSError:
+            return False
+
+    def add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch {path}: {os.strerror(errno)}")
+        self.paths[wd] = path
+
+    def read_events(self):
+        """Yield (mask, full path) of the queued events without blocking"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            directory = self.paths.get(wd)
+            if mask & IN_Q_OVERFLOW or directory is None:
+                yield mask, None
+                continue
+            yield mask, os.path.join(directory, os.fsdecode(name)) if name else directory
+
+    def close(self):
+        os.close(self.fd)
+
+
+def filesystem_type(path) -> Optional[str]:
+    """Type of the filesystem `path` is mounted on, from /proc/self/mounts; None when unknown"""
+    path = os.path.realpath(str(path))
+    best, fs_type = "", None
+    try:
+        with open("/proc/self/mounts", 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces and tabs in mount points are octal escapes (\040)
+                mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1])
+                inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+                if inside and len(mount_point) >= len(best):
+                    best, fs_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return fs_type
+
+
+def default_sidecars_ready(video: Path) -> bool:
+    """Sidecar files listed in folder_watch.sidecars (default .txt) must exist next to the video"""
+    return all(video.with_suffix(suffix).exists() for suffix in get_config().get("folder_watch.sidecars", [".txt"]))
+
+
+class FolderWatcher(object):
+    """
+    Keeps a persisted catalog of the videos under `root`. A video becomes ready when it is fully written
+    (close_write/moved_to with inotify, size and mtime unchanged for folder_watch.settle_seconds when scanning)
+    and `sidecars_ready(video)` is true.
+    """
+
+    def __init__(self, root, suffixes=(".mp4",), sidecars_ready: Callable[[Path], bool] = default_sidecars_ready,
+                 catalog_file=None):
+        config = get_config()
+        self.root = Path(root)
+        self.suffixes = tuple(s.lower() for s in suffixes)
+        self.sidecars_ready = sidecars_ready
+        self.settle_seconds = config.get("folder_watch.settle_seconds", 30)
+        self.poll_interval = config.get("folder_watch.poll_interval", 60)
+        self.mode = config.get("folder_watch.mode", "auto")
+        self.rescan_interval = config.get("folder_watch.rescan_interval", 300)
+        root_key = hashlib.sha1(str(self.root.resolve()).encode("utf-8")).hexdigest()[:12]
+        self.catalog_file = Path(catalog_file or CATALOG_DIR / f"folder_catalog_{root_key}.json")
+        self.dirs: Dict[str, Dict[str, Any]] = {}
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self._load()
+
+    # ---- catalog ----
+    def _load(self):
+        try:
+            with open(self.catalog_file, 'r', encoding='utf-8') as f:
+                catalog = json.load(f)
+            self.dirs, self.files = catalog.get("dirs", {}), catalog.get("files", {})
+        except (OSError, ValueError):
+            self.dirs, self.files = {}, {}
+
+    def save(self):
+        self.catalog_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.catalog_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"root": str(self.root), "dirs": self.dirs, "files": self.files}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.catalog_file)
+
+    def _is_video(self, name: str) -> bool:
+        return name.lower().endswith(self.suffixes)
+
+    def _track(self, path: str, stat: os.stat_result, written: bool = False):
+        entry = self.files.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime, "ctime": stat.st_ctime, "state": STATE_PENDING}
+            self.files[path] = entry
+        if written and entry["state"] == STATE_PENDING:
+            entry["written"] = True
+        self._check_ready(path)
+
+    def _check_ready(self, path: str):
+        entry = self.files[path]
+        if entry["state"] != STATE_PENDING:
+            return
+        # Without a close_write event a file counts as written once it stopped changing for settle_seconds
+        settled = entry.get("written") or time.time() - entry["mtime"] >= self.settle_seconds
+        if settled and self.sidecars_ready(Path(path)):
+            entry["state"] = STATE_READY
+
+    def _forget(self, path: str):
+        self.files.pop(path, None)
+        prefix = path + os.sep
+        if path in self.dirs:
+            for key in [k for k in self.dirs if k == path or k.startswith(prefix)]:
+                del self.dirs[key]
+            for key in [k for k in self.files if k.startswith(prefix)]:
+                del self.files[key]
+
+    # ---- scanning ----
+    def scan(self):
+        """Incremental walk: only directories whose mtime changed are listed again, known files are re-checked"""
+        stack = [str(self.root)]
+        seen_dirs = set()
+        while stack:
+            directory = stack.pop()
+            seen_dirs.add(directory)
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                self._forget(directory)
+                continue
+            cached = self.dirs.get(directory)
+            if cached is None or cached["mtime"] != mtime:
+                subdirs, videos = [], []
+                try:
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.path)
+                            elif self._is_video(entry.name):
+                                videos.append(entry.path)
+                except OSError as e:
+                    logger.warning(f"[folder-watch] cannot list {directory}: {e}")
+                    continue
+                listed = set(videos)
+                for gone in [p for p in self.files if os.path.dirname(p) == directory and p not in listed]:
+                    self._forget(gone)
+                cached = {"mtime": mtime, "subdirs": subdirs, "videos": videos}
+                self.dirs[directory] = cached
+            stack.extend(cached["subdirs"])
+            for video in cached["videos"]:
+                entry = self.files.get(video)
+                if entry is not None and entry["state"] != STATE_PENDING:
+                    continue
+                # Only videos that are not ready yet need a stat: growing files and missing sidecars
+                try:
+                    self._track(video, os.stat(video))
+                except OSError:
+                    self._forget(video)
+        for gone in [d for d in self.dirs if d not in seen_dirs]:
+            del self.dirs[gone]
+
+    def _recheck_sidecars(self, path: str) -> bool:
+        """
+        The catalog of a folder is shared by every consumer, and a video marked ready under another consumer's
+        sidecars_ready (e.g. no .txt needed) goes back to pending until this consumer's sidecars are there
+        """
+        if self.sidecars_ready(Path(path)):
+            return True
+        self.files[path]["state"] = STATE_PENDING
+        return False
+
+    def ready_files(self) -> List[Path]:
+        """Scan incrementally and return every ready video, oldest first (by ctime from the catalog)"""
+        self.scan()
+        ready = [(entry["ctime"], path) for path, entry in self.files.items()
+                 if entry["state"] != STATE_PENDING and self._recheck_sidecars(path)]
+        self.save()
+        return [Path(path) for _, path in sorted(ready)]
+
+    def _take_ready(self) -> List[Path]:
+        paths = [path for path, entry in self.files.items()
+                 if entry["state"] == STATE_READY and self._recheck_sidecars(path)]
+        for path in paths:
+            self.files[path]["state"] = STATE_EMITTED
+        return [Path(path) for path in sorted(paths, key=lambda p: self.files[p]["ctime"])]
+
+    # ---- watching ----
+    def _use_inotify(self) -> bool:
+        if self.mode == "scan":
+            return False
+        if not Inotify.available():
+            if self.mode == "inotify":
+                logger.warning("[folder-watch] inotify is not available here, scanning instead")
+            return False
+        if self.mode == "auto":
+            fs_type = filesystem_type(self.root)
+            if fs_type in NETWORK_FILESYSTEMS:
+                logger.info(f"[folder-watch] {self.root} is on {fs_type}, inotify misses writes from other hosts, "
+                            f"scanning instead")
+                return False
+        return True
+
+    def _add_watch(self, inotify: Inotify, directory: str) -> bool:
+        try:
+            inotify.add_watch(directory)
+            return True
+        except OSError as e:
+            if os.path.isdir(directory):
+                # e.g. the inotify watch limit; the periodic rescan still finds the videos in it
+                logger.warning(f"[folder-watch] cannot watch {directory}: {e}")
+            else:
+                # Deleted since it was listed, like an editor's temporary export folder
+                self._forget(directory)
+            return False
+
+    def _watch_tree(self, inotify: Inotify):
+        for directory in list(self.dirs):
+            self._add_watch(inotify, directory)
+
+    def _handle_event(self, inotify: Inotify, mask: int, path: str):
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if not self._add_watch(inotify, path) and not os.path.isdir(path):
+                    return
+                self.dirs.pop(os.path.dirname(path), None)
+                self.scan()
+                self._watch_tree(inotify)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._forget(path)
+            return
+        if mask & IN_DELETE_SELF:
+            self._forget(path)
+            return
+        name = os.path.basename(path)
+        if self._is_video(name):
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self._forget(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                try:
+                    self._track(path, os.stat(path), written=True)
+                except OSError:
+                    self._forget(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            # A sidecar (.txt/.png) arrived, the videos with the same stem may be complete now
+            stem = os.path.splitext(path)[0]
+            for suffix in self.suffixes:
+                for video in (stem + suffix, stem + suffix.upper()):
+                    if video in self.files:
+                        self._check_ready(video)
+
+    async def watch(self) -> AsyncIterator[Path]:
+        """Yield each video once it is ready, forever; restarts continue from the persisted catalog"""
+        inotify = None
+        if self._use_inotify():
+            try:
+                inotify = Inotify()
+                # Watches are added before the catch-up scan so no write finished in between is missed
+                inotify.add_watch(str(self.root))
+                self.scan()
+                self._watch_tree(inotify)
+            except OSError as e:
+                logger.warning(f"[folder-watch] inotify unavailable ({e}), scanning every {self.poll_interval}s")
+                if inotify is not None:
+                    inotify.close()
+                inotify = None
+        if inotify is None:
+            self.scan()
+        logger.info(f"[folder-watch] watching {self.root} with {'inotify' if inotify else 'scandir'}, "
+                    f"{len(self.files)} video(s) in catalog")
+
+        loop = asyncio.get_event_loop()
+        last_scan = time.monotonic()
+        wakeup = asyncio.Event()
+        if inotify is not None:
+            loop.add_reader(inotify.fd, wakeup.set)
+        try:
+            while True:
+                self.save()
+                for path in self._take_ready():
+                    yield path
+                self.save()
+                # Scanning mode polls; inotify mode also wakes up periodically to settle pending files
+                timeout = self.poll_interval if inotify is None else min(self.poll_interval, self.settle_seconds)
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                if inotify is None:
+                    self.scan()
+                    continue
+                for mask, path in inotify.read_events():
+                    if path is None:
+                        # Queue overflow or unknown watch, fall back to a full incremental scan
+                        self.scan()
+                        self._watch_tree(inotify)
+                        last_scan = time.monotonic()
+                        continue
+                    self._handle_event(inotify, mask, path)
+                if self.rescan_interval and time.monotonic() - last_scan >= self.rescan_interval:
+                    # Safety net for whatever produced no event, e.g. a mount the auto check did not recognise
+                    self.scan()
+                    self._watch_tree(inotify)
+                    last_scan = time.monotonic()
+                for path, entry in list(self.files.items()):
+                    if entry["state"] == STATE_PENDING:
+                        try:
+                            self._track(path, os.stat(path))
+                        except OSError:
+                            self._forget(path)
+        finally:
+            if inotify is not None:
+                loop.remove_reader(inotify.fd)
+                inotify.close()
+            self.save()
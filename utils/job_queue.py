@@ -0,0 +1,149 @@
+"""
+Job Queue
+Durable upload job queue in SQLite (WAL), shared by `upload --enqueue` producers and `watch` workers
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from conf import BASE_DIR
+from utils.config_manager import get_config
+from utils.sqlite_db import connect
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    diagnostics TEXT,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, platform, account, available_at);
+"""
+
+
+class JobQueue(object):
+    """
+    Jobs move pending -> running -> done/failed/skipped. A failed job goes back to pending with a backoff
+    until queue.max_attempts is reached; running jobs of a watcher that died are recovered on its restart.
+    """
+
+    def __init__(self, db_file=None):
+        config = get_config()
+        self.db_file = Path(db_file or BASE_DIR / config.get("queue.db_file", "data/records/job_queue.db"))
+        self.max_attempts = config.get("queue.max_attempts", 3)
+        self.retry_delay = config.get("queue.retry_delay", 300)
+        self._conn = connect(self.db_file, SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> Dict[str, Any]:
+        record = dict(row)
+        record["payload"] = json.loads(record["payload"])
+        record["diagnostics"] = json.loads(record["diagnostics"]) if record["diagnostics"] else []
+        return record
+
+    @staticmethod
+    def _scope(platform: Optional[str], account: Optional[str]):
+        return "(? IS NULL OR platform = ?) AND (? IS NULL OR account = ?)", (platform, platform, account, account)
+
+    def enqueue(self, platform: str, account: str, payload: Dict[str, Any], delay: float = 0) -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (platform, account, payload, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (platform, account, json.dumps(payload, ensure_ascii=False), now + delay, now, now))
+            return cursor.lastrowid
+
+    def claim(self, platform: Optional[str] = None, account: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Atomically take the oldest due pending job in scope and mark it running"""
+        scope, params = self._scope(platform, account)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    f"SELECT * FROM jobs WHERE status = ? AND available_at <= ? AND {scope} ORDER BY id LIMIT 1",
+                    (STATUS_PENDING, now) + params).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? "
+                                       "WHERE id = ?", (STATUS_RUNNING, now, row["id"]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        record = self._record(row)
+        record["status"] = STATUS_RUNNING
+        record["attempts"] += 1
+        return record
+
+    def finish(self, job_id: int, status: str, error: Optional[str] = None, diagnostics: Optional[List[str]] = None):
+        """Record the outcome of a running job; failures are retried until max_attempts"""
+        now = time.time()
+        with self._lock:
+            attempts = self._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            available_at = now
+            if status == STATUS_FAILED and attempts < self.max_attempts:
+                status = STATUS_PENDING
+                available_at = now + self.retry_delay * attempts
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, diagnostics = ?, available_at = ?, updated_at = ? WHERE id = ?",
+                (status, error, json.dumps(diagnostics or [], ensure_ascii=False), available_at, now, job_id))
+        return status
+
+    def release(self, job_id: int):
+        """Put an interrupted job back to pending without counting the attempt"""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0), updated_at = ? "
+                               "WHERE id = ? AND status = ?", (STATUS_PENDING, time.time(), job_id, STATUS_RUNNING))
+
+    def defer(self, job_id: int, delay: float):
+        """Put a claimed job back to pending until `delay` seconds from now without counting the attempt"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0), available_at = ?, "
+                               "updated_at = ? WHERE id = ? AND status = ?",
+                               (STATUS_PENDING, now + delay, now, job_id, STATUS_RUNNING))
+
+    def recover(self, platform: Optional[str] = None, account: Optional[str] = None) -> int:
+        """Return jobs left running by a stopped watcher of this scope to pending"""
+        scope, params = self._scope(platform, account)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0), updated_at = ? "
+                f"WHERE status = ? AND {scope}", (STATUS_PENDING, time.time(), STATUS_RUNNING) + params)
+            return cursor.rowcount
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def stats(self, platform: Optional[str] = None, account: Optional[str] = None) -> Dict[str, int]:
+        scope, params = self._scope(platform, account)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT status, COUNT(*) FROM jobs WHERE {scope} GROUP BY status",
+                                      params).fetchall()
+        return {status: count for status, count in rows}
@@ -0,0 +1,93 @@
+"""
+Metrics
+In-process counters and gauges with labels, plus a JSON snapshot for dashboards and scrapers
+"""
+
+import asyncio
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Awaitable, Dict, Optional, Tuple
+
+from conf import BASE_DIR
+from utils.config_manager import get_config
+
+METRICS_FILE = Path(BASE_DIR / "logs" / "metrics.json")
+
+
+def _label_key(labels: Dict[str, Any]) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    """Thread-safe metric registry; uploader threads and the event loop both report into it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Tuple, float]] = {}
+        self._gauges: Dict[str, Dict[Tuple, float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def get(self, name: str, **labels) -> float:
+        key = _label_key(labels)
+        with self._lock:
+            for store in (self._counters, self._gauges):
+                if key in store.get(name, {}):
+                    return store[name][key]
+        return 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        def export(store):
+            return {name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in store.items()}
+
+        with self._lock:
+            return {"counters": export(self._counters), "gauges": export(self._gauges)}
+
+    def dump(self, path: Path = METRICS_FILE):
+        """Write the snapshot atomically so readers never see a partial file"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, path)
+
+    @staticmethod
+    def load(path: Path = METRICS_FILE) -> Dict[str, Any]:
+        """Snapshot written by dump(), e.g. by another process; empty when there is none yet"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"counters": {}, "gauges": {}}
+
+    async def export_while(self, awaitable: Awaitable, interval: Optional[float] = None):
+        """Await `awaitable`, dumping every `interval` seconds (metrics.dump_interval) meanwhile and once at the end"""
+        interval = interval or get_config().get("metrics.dump_interval", 30)
+
+        async def dump_periodically():
+            while True:
+                await asyncio.sleep(interval)
+                self.dump()
+
+        dumper = asyncio.ensure_future(dump_periodically())
+        try:
+            return await awaitable
+        finally:
+            dumper.cancel()
+            await asyncio.gather(dumper, return_exceptions=True)
+            self.dump()
+
+
+metrics = Metrics()
@@ -0,0 +1,32 @@
+"""
+Page Events
+Wait on page events (DOM state changes, network responses) instead of polling the page from Python
+"""
+
+import asyncio
+from typing import Awaitable, Dict
+
+
+async def wait_for_first(waiters: Dict[str, Awaitable]) -> str:
+    """
+    Await several page events concurrently and return the name of the first one that fires.
+    A waiter that fails is ignored while others are still pending; the rest are cancelled on return.
+    """
+    tasks = {asyncio.ensure_future(waiter): name for name, waiter in waiters.items()}
+    pending = set(tasks)
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception() is None:
+                    return tasks[task]
+                error = task.exception()
+        raise error or asyncio.CancelledError()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
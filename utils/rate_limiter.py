@@ -0,0 +1,159 @@
+"""
+Rate Limiter
+Token buckets per account and per platform pacing uploads (upload.upload_interval, upload.max_uploads_per_day),
+awaited so one account's wait overlaps with the uploads of other accounts and platforms. The bucket state is
+kept in the record store, so the daily caps hold across runs and across processes sharing the database
+"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+
+from utils.config_manager import get_config
+from utils.metrics import metrics
+from utils.record_store import RecordStore, get_record_store
+
+DAY = 24 * 3600
+
+
+class TokenBucket(object):
+    """`capacity` tokens refilled evenly over `period` seconds; starts full. Times are wall clock, as stored"""
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.time()
+
+    def restore(self, tokens: float, updated: float):
+        # A lowered capacity applies at once
+        self.tokens = min(self.capacity, tokens)
+        self.updated = updated
+
+    def state(self) -> Tuple[float, float]:
+        return self.tokens, self.updated
+
+    def _refill(self, now: float):
+        # The clock going back refills nothing
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+def _buckets_for(limits: Dict, interval_key: str, daily_key: str, scope: str) -> Dict[str, TokenBucket]:
+    buckets = {}
+    interval = limits.get(interval_key)
+    if interval:
+        buckets[f"{scope}:interval"] = TokenBucket(1, interval)
+    per_day = limits.get(daily_key)
+    if per_day:
+        buckets[f"{scope}:daily"] = TokenBucket(per_day, DAY)
+    return buckets
+
+
+class RateLimiter(object):
+    """
+    Each account has an interval bucket (one upload per upload.upload_interval seconds) and a daily bucket
+    (upload.max_uploads_per_day); upload.rate_limits.<platform> overrides both for a platform and may add
+    platform_interval / platform_max_per_day buckets shared by all accounts of the platform.
+    An upload takes a token from every bucket of its account and platform at once.
+    """
+
+    def __init__(self, interval: Optional[float] = None, max_per_day: Optional[int] = None,
+                 platform_limits: Optional[Dict[str, Dict]] = None, records: Optional[RecordStore] = None):
+        config = get_config()
+        self.interval = config.get("upload.upload_interval", 30) if interval is None else interval
+        self.max_per_day = config.get("upload.max_uploads_per_day", 5) if max_per_day is None else max_per_day
+        self.platform_limits = platform_limits if platform_limits is not None else \
+            config.get("upload.rate_limits", {}) or {}
+        self.records = records or get_record_store()
+        self._lock = threading.Lock()
+        self._accounts: Dict[Tuple[str, str], Dict[str, TokenBucket]] = {}
+        self._platforms: Dict[str, Dict[str, TokenBucket]] = {}
+
+    def _buckets(self, platform: str, account: str) -> Dict[str, TokenBucket]:
+        limits = self.platform_limits.get(platform, {}) or {}
+        if platform not in self._platforms:
+            self._platforms[platform] = _buckets_for(limits, "platform_interval", "platform_max_per_day", platform)
+        if (platform, account) not in self._accounts:
+            self._accounts[(platform, account)] = _buckets_for(
+                {"upload_interval": self.interval, "max_uploads_per_day": self.max_per_day, **limits},
+                "upload_interval", "max_uploads_per_day", f"{platform}/{account}")
+        return {**self._platforms[platform], **self._accounts[(platform, account)]}
+
+    def _update(self, platform: str, account: str, consume: bool) -> float:
+        """Seconds to wait, taking the tokens when there is none to wait and `consume` is set"""
+        buckets = self._buckets(platform, account)
+
+        def update(stored: Dict[str, Tuple[float, float]]):
+            now = time.time()
+            for key, bucket in buckets.items():
+                if key in stored:
+                    bucket.restore(*stored[key])
+            wait = max([bucket.wait_time(now) for bucket in buckets.values()] + [0])
+            if consume and wait <= 0:
+                for bucket in buckets.values():
+                    bucket.consume(now)
+            return {key: bucket.state() for key, bucket in buckets.items()}, wait
+
+        with self._lock:
+            return self.records.update_rate_buckets(buckets, update)
+
+    async def _update_async(self, platform: str, account: str, consume: bool) -> float:
+        # The update is a write transaction that waits out a locked database, never on the event loop
+        return await asyncio.get_event_loop().run_in_executor(None, self._update, platform, account, consume)
+
+    async def delay(self, platform: str, account: str = "") -> float:
+        """Seconds until an upload of this account would be allowed"""
+        return await self._update_async(platform, account, consume=False)
+
+    def try_acquire(self, platform: str, account: str = "") -> float:
+        """Take the tokens if all buckets have one and return 0, otherwise the seconds to wait"""
+        return self._update(platform, account, consume=True)
+
+    def _log_wait(self, platform: str, account: str, wait: float):
+        logger.info(f"[rate] {platform}/{account or '-'} rate limited, next upload in {wait:.0f}s")
+        metrics.inc("upload_rate_limited_total", platform=platform)
+
+    async def acquire(self, platform: str, account: str = "") -> float:
+        """Wait without blocking the event loop until an upload is allowed; returns the seconds waited"""
+        started = time.monotonic()
+        wait = await self._update_async(platform, account, consume=True)
+        if wait > 0:
+            self._log_wait(platform, account, wait)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = await self._update_async(platform, account, consume=True)
+        return time.monotonic() - started
+
+    def acquire_blocking(self, platform: str, account: str = "") -> float:
+        """acquire() for synchronous scripts, sleeping only the time actually left"""
+        started = time.monotonic()
+        wait = self.try_acquire(platform, account)
+        if wait > 0:
+            self._log_wait(platform, account, wait)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire(platform, account)
+        return time.monotonic() - started
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Process-wide limiter, so every uploader in the process shares the same buckets"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter()
+    return _rate_limiter
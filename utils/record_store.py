@@ -0,0 +1,275 @@
+"""
+Record Store
+Upload and processing records in one indexed SQLite (WAL) database, shared by the upload tools,
+the job runner and the video processing scripts in place of the per-tool JSON/txt record files
+"""
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from conf import BASE_DIR
+from utils.config_manager import get_config
+from utils.fingerprint import Fingerprinter
+from utils.sqlite_db import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    content_key TEXT NOT NULL,
+    path TEXT,
+    uploaded_at REAL NOT NULL,
+    PRIMARY KEY (platform, account, content_key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS processed (
+    kind TEXT NOT NULL,
+    content_key TEXT NOT NULL,
+    path TEXT,
+    processed_at REAL NOT NULL,
+    PRIMARY KEY (kind, content_key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS schedules (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    publish_at REAL NOT NULL,
+    content_key TEXT,
+    path TEXT,
+    PRIMARY KEY (platform, account, publish_at)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS checkpoints (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    content_key TEXT NOT NULL,
+    step TEXT NOT NULL,
+    reached_at REAL NOT NULL,
+    PRIMARY KEY (platform, account, content_key, step)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    bucket TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS migrations (
+    source TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    imported INTEGER NOT NULL,
+    migrated_at REAL NOT NULL
+);
+"""
+
+# Parameters per IN (...) lookup, well below SQLite's bound-variable limit
+LOOKUP_CHUNK = 500
+
+
+def path_key(file) -> str:
+    """Key of records written before content fingerprints: the absolute path (not resolved, mapped drives stay)"""
+    return os.path.abspath(str(file))
+
+
+def read_legacy_records(source: Path) -> list:
+    """Entries of a legacy record file: a JSON list, or one entry per line ('#' lines are comments)"""
+    with open(source, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if source.suffix.lower() == ".json":
+        return [str(entry) for entry in (json.loads(text) if text.strip() else [])]
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.startswith('#')]
+
+
+class RecordStore(object):
+    """
+    Lookups go through the primary key index, so checking a folder of n videos costs n index probes
+    instead of n parses of the whole record file. Uploads are keyed by (platform, account, content key),
+    processing records by (kind, content key); writes are single upserts safe across threads and processes.
+    The *_files methods key existing files by content fingerprint, so a renamed or moved video keeps its
+    records, and still match the path or name keys of records imported from the old files.
+    """
+
+    def __init__(self, db_file=None):
+        self.db_file = Path(db_file or BASE_DIR / get_config().get("records.db_file", "data/records/records.db"))
+        self._conn = connect(self.db_file, SCHEMA)
+        self._lock = threading.Lock()
+        self.fingerprints = Fingerprinter(self.db_file)
+
+    def close(self):
+        self._conn.close()
+        self.fingerprints.close()
+
+    def file_key(self, file) -> str:
+        """Content fingerprint of an existing file, its path for a file that is gone"""
+        return self.fingerprints.content_key(file) if os.path.isfile(file) else path_key(file)
+
+    def _matching_files(self, files, legacy_key: Optional[Callable], lookup: Callable[[List[str]], Set[str]]):
+        files = list(files)
+        keys = [[self.file_key(file)] + ([legacy_key(file)] if legacy_key else []) for file in files]
+        found = lookup([key for file_keys in keys for key in file_keys])
+        return [file for file, file_keys in zip(files, keys) if found.intersection(file_keys)]
+
+    def _existing(self, table: str, scope: str, params: tuple, keys: Iterable[str]) -> Set[str]:
+        keys = list(keys)
+        found = set()
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[start:start + LOOKUP_CHUNK]
+                rows = self._conn.execute(
+                    f"SELECT content_key FROM {table} WHERE {scope} "
+                    f"AND content_key IN ({', '.join('?' * len(chunk))})", params + tuple(chunk)).fetchall()
+                found.update(row[0] for row in rows)
+        return found
+
+    def is_uploaded(self, platform: str, key: str, account: str = "") -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM uploads WHERE platform = ? AND account = ? AND content_key = ?",
+                                     (platform, account, key)).fetchone()
+        return row is not None
+
+    def uploaded_keys(self, platform: str, keys: Iterable[str], account: str = "") -> Set[str]:
+        """The subset of `keys` already uploaded, in a few batched queries"""
+        return self._existing("uploads", "platform = ? AND account = ?", (platform, account), keys)
+
+    def uploaded_files(self, platform: str, files, account: str = "", legacy_key: Optional[Callable] = path_key):
+        """The files already uploaded, by content or by the `legacy_key` of old records"""
+        return self._matching_files(files, legacy_key, lambda keys: self.uploaded_keys(platform, keys, account))
+
+    def mark_file_uploaded(self, platform: str, file, account: str = ""):
+        self.mark_uploaded(platform, self.file_key(file), account, str(file))
+
+    def mark_uploaded(self, platform: str, key: str, account: str = "", path: Optional[str] = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO uploads (platform, account, content_key, path, uploaded_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (platform, account, content_key) DO UPDATE SET path = excluded.path, "
+                "uploaded_at = excluded.uploaded_at", (platform, account, key, path, time.time()))
+
+    def scheduled_slots(self, platform: str, account: str = "", since: Optional[float] = None) -> List[float]:
+        """Publish timestamps already booked for this account, from `since` on"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT publish_at FROM schedules WHERE platform = ? AND account = ? AND publish_at >= ? "
+                "ORDER BY publish_at", (platform, account, since or 0)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_scheduled(self, platform: str, publish_at: float, account: str = "", file=None):
+        """Book a publish time once a scheduled upload went through"""
+        key = self.file_key(file) if file is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO schedules (platform, account, publish_at, content_key, path) "
+                "VALUES (?, ?, ?, ?, ?)", (platform, account, publish_at, key, str(file) if file else None))
+
+    def checkpoint_steps(self, platform: str, account: str, key: str) -> Set[str]:
+        """Upload steps an uploader recorded as reached for this video"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT step FROM checkpoints WHERE platform = ? AND account = ? AND content_key = ?",
+                (platform, account, key)).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_checkpoint(self, platform: str, account: str, key: str, step: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO checkpoints (platform, account, content_key, step, reached_at) "
+                               "VALUES (?, ?, ?, ?, ?)", (platform, account, key, step, time.time()))
+
+    def update_rate_buckets(self, buckets: Iterable[str],
+                            update: Callable[[Dict[str, Tuple[float, float]]],
+                                             Tuple[Dict[str, Tuple[float, float]], Any]]) -> Any:
+        """
+        Call `update` with the stored (tokens, updated_at) of the rate limiter `buckets` and store the states it
+        returns along with its result, in one write transaction, so every process takes from the same buckets
+        """
+        buckets = list(buckets)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    f"SELECT bucket, tokens, updated_at FROM rate_buckets WHERE bucket IN "
+                    f"({', '.join('?' * len(buckets))})", buckets).fetchall() if buckets else []
+                states, result = update({row[0]: (row[1], row[2]) for row in rows})
+                self._conn.executemany("INSERT OR REPLACE INTO rate_buckets (bucket, tokens, updated_at) "
+                                       "VALUES (?, ?, ?)", [(bucket, *state) for bucket, state in states.items()])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def is_processed(self, kind: str, key: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM processed WHERE kind = ? AND content_key = ?",
+                                     (kind, key)).fetchone()
+        return row is not None
+
+    def processed_keys(self, kind: str, keys: Iterable[str]) -> Set[str]:
+        """The subset of `keys` already processed, in a few batched queries"""
+        return self._existing("processed", "kind = ?", (kind,), keys)
+
+    def processed_files(self, kind: str, files, legacy_key: Optional[Callable] = path_key):
+        """The files already processed, by content or by the `legacy_key` of old records"""
+        return self._matching_files(files, legacy_key, lambda keys: self.processed_keys(kind, keys))
+
+    def mark_file_processed(self, kind: str, file):
+        self.mark_processed(kind, self.file_key(file), str(file))
+
+    def mark_processed(self, kind: str, key: str, path: Optional[str] = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO processed (kind, content_key, path, processed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (kind, content_key) DO UPDATE SET path = excluded.path, "
+                "processed_at = excluded.processed_at", (kind, key, path, time.time()))
+
+    def migrate(self, source, platform: Optional[str] = None, account: str = "", kind: Optional[str] = None) -> int:
+        """
+        Import a legacy record file as uploads of `platform`/`account` or as processing records of `kind`.
+        Entries are imported as they were written (paths or file names), plus the content fingerprint of
+        entries that are paths of existing files. The file is left in place and only read again when it
+        changed since the last import, so calling this on every run is cheap.
+        """
+        source = Path(source)
+        if not source.exists():
+            return 0
+        mtime = source.stat().st_mtime
+        with self._lock:
+            row = self._conn.execute("SELECT mtime FROM migrations WHERE source = ?", (str(source),)).fetchone()
+        if row is not None and row[0] == mtime:
+            return 0
+
+        entries = read_legacy_records(source)
+        rows = [(entry, entry) for entry in entries]
+        rows += [(self.fingerprints.content_key(entry), entry) for entry in entries
+                 if os.path.isabs(entry) and os.path.isfile(entry)]
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if kind is not None:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO processed (kind, content_key, path, processed_at) VALUES (?, ?, ?, ?)",
+                        [(kind, key, entry, now) for key, entry in rows])
+                else:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO uploads (platform, account, content_key, path, uploaded_at) "
+                        "VALUES (?, ?, ?, ?, ?)", [(platform, account, key, entry, now) for key, entry in rows])
+                self._conn.execute("INSERT OR REPLACE INTO migrations (source, mtime, imported, migrated_at) "
+                                   "VALUES (?, ?, ?, ?)", (str(source), mtime, len(entries), now))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info(f"[records] imported {len(entries)} record(s) from {source}")
+        return len(entries)
+
+
+_record_store: Optional[RecordStore] = None
+
+
+def get_record_store() -> RecordStore:
+    """Process-wide store, so uploaders and the job runner share one connection and fingerprint cache"""
+    global _record_store
+    if _record_store is None:
+        _record_store = RecordStore()
+    return _record_store
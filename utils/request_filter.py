@@ -0,0 +1,152 @@
+"""
+Request Filter
+Per-platform interception profile that aborts heavy assets, analytics and ad beacons on the creator portals
+while always letting upload and publish traffic through
+"""
+
+import re
+import weakref
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from loguru import logger
+from playwright.async_api import BrowserContext, Request, Route
+
+from utils.base_social_media import SOCIAL_MEDIA_DOUYIN, SOCIAL_MEDIA_TENCENT, SOCIAL_MEDIA_TIKTOK, \
+    SOCIAL_MEDIA_KUAISHOU
+from utils.config_manager import get_config
+from utils.metrics import metrics
+
+DEFAULT_BLOCK_TYPES = ["image", "font", "media"]
+
+COMMON_BLOCK_URLS = [
+    r"//[\w.-]*google-analytics\.com/",
+    r"//[\w.-]*googletagmanager\.com/",
+    r"//[\w.-]*doubleclick\.net/",
+    r"//hm\.baidu\.com/",
+    r"//[\w.-]*sentry\.io/",
+]
+
+# Upload chunks, transcode polling and publish calls must never be touched. Anchored to the hosts and paths
+# of each portal's upload API, so a beacon that merely mentions "upload" or "publish" is still blocked
+PROFILES: Dict[str, Dict[str, List[str]]] = {
+    SOCIAL_MEDIA_DOUYIN: {
+        "block_urls": [r"//mcs\.zijieapi\.com/", r"//mon\.zijieapi\.com/", r"/monitor_browser/collect/"],
+        "allow_urls": [r"^https://vod\.bytedanceapi\.com/", r"^https://[\w-]+\.snssdk\.com/upload/",
+                       r"^https://creator\.douyin\.com/(web/api/media|aweme/v\d+)/"],
+    },
+    SOCIAL_MEDIA_KUAISHOU: {
+        "block_urls": [r"//log-sdk\.ksapisrv\.com/", r"/rest/wd/common/log/collect"],
+        "allow_urls": [r"^https://cp\.kuaishou\.com/rest/cp/works/", r"^https://[\w.-]+\.kuaishou\.com/api/upload",
+                       r"^https://upload\.kuaishouzt\.com/"],
+    },
+    SOCIAL_MEDIA_TENCENT: {
+        "block_urls": [r"//aegis\.qq\.com/", r"//badjs\.[\w.]+/", r"/helper/helper_report"],
+        "allow_urls": [r"^https://channels\.weixin\.qq\.com/(cgi-bin/)?mmfinderassistant-bin/",
+                       r"^https://finder[\w-]*\.video\.qq\.com/"],
+    },
+    SOCIAL_MEDIA_TIKTOK: {
+        "block_urls": [r"//mcs[\w-]*\.tiktokw?\.com/", r"//mon[\w-]*\.tiktokv?\.com/",
+                       r"//analytics\.tiktok\.com/"],
+        "allow_urls": [r"^https://www\.tiktok\.com/(tiktokstudio/api|api/v1/video)/",
+                       r"^https://[\w.-]*tiktokcdn[\w-]*\.com/[\w/-]*upload"],
+    },
+}
+
+# Filters applied in block mode, per context, for images_allowed()
+_filters = weakref.WeakKeyDictionary()
+
+
+class RequestFilter(object):
+    """
+    mode "block" aborts matching requests and counts them per resource type.
+    mode "observe" lets everything load and measures what would have been blocked, including bytes,
+    since aborted requests never transfer a body that could be measured.
+    """
+
+    def __init__(self, platform: str, mode: Optional[str] = None):
+        config = get_config()
+        profile = PROFILES.get(platform, {})
+        self.platform = platform
+        self.mode = mode or config.get("request_filter.mode", "block")
+        self.block_types = set(config.get("request_filter.block_types", DEFAULT_BLOCK_TYPES))
+        self.block_urls = [re.compile(p) for p in COMMON_BLOCK_URLS + profile.get("block_urls", [])]
+        self.allow_urls = [re.compile(p) for p in profile.get("allow_urls", [])]
+        self.image_holds = 0
+
+    def should_block(self, request: Request) -> bool:
+        url = request.url
+        if request.resource_type == "document" or any(p.search(url) for p in self.allow_urls):
+            return False
+        if request.resource_type == "image" and self.image_holds:
+            return any(p.search(url) for p in self.block_urls)
+        return request.resource_type in self.block_types or any(p.search(url) for p in self.block_urls)
+
+    def _count(self, request: Request):
+        metrics.inc("request_filter_blocked_requests", platform=self.platform, type=request.resource_type)
+
+    async def _route(self, route: Route, request: Request):
+        if self.should_block(request):
+            self._count(request)
+            await route.abort("blockedbyclient")
+        else:
+            await route.continue_()
+
+    async def _observe(self, request: Request):
+        if not self.should_block(request):
+            return
+        self._count(request)
+        try:
+            sizes = await request.sizes()
+            metrics.inc("request_filter_blocked_bytes", sizes.get("responseBodySize", 0), platform=self.platform)
+        except Exception:
+            pass
+
+    async def apply(self, context: BrowserContext):
+        if self.mode == "observe":
+            context.on("requestfinished", self._observe)
+        else:
+            await context.route("**/*", self._route)
+            _filters[context] = self
+
+
+async def apply_request_filter(context: BrowserContext, platform: str, mode: Optional[str] = None):
+    """`mode` overrides request_filter.mode, e.g. "observe" for contexts that must keep the HTTP cache"""
+    if not get_config().get("request_filter.enabled", True) or platform not in PROFILES:
+        return
+    await RequestFilter(platform, mode).apply(context)
+    logger.debug(f"[request-filter] {platform} profile applied")
+
+
+@contextmanager
+def images_allowed(context: BrowserContext) -> Iterator[None]:
+    """
+    Let images load on `context` while the block is open, e.g. while a cover is cropped: the cover editors
+    render the uploaded cover and the video frames as images
+    """
+    request_filter = _filters.get(context)
+    if request_filter is None:
+        yield
+        return
+    request_filter.image_holds += 1
+    try:
+        yield
+    finally:
+        request_filter.image_holds -= 1
+
+
+def get_request_filter_stats(snapshot: Optional[Dict[str, Any]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Blocked request counts per platform and resource type, and blocked bytes measured in observe mode,
+    from this process or from a snapshot written by metrics.dump()
+    """
+    stats: Dict[str, Dict[str, Any]] = {}
+    snapshot = (snapshot or metrics.snapshot())["counters"]
+    for sample in snapshot.get("request_filter_blocked_requests", []):
+        platform_stats = stats.setdefault(sample["labels"]["platform"], {"requests": 0, "bytes": 0, "by_type": {}})
+        platform_stats["requests"] += sample["value"]
+        platform_stats["by_type"][sample["labels"]["type"]] = sample["value"]
+    for sample in snapshot.get("request_filter_blocked_bytes", []):
+        platform_stats = stats.setdefault(sample["labels"]["platform"], {"requests": 0, "bytes": 0, "by_type": {}})
+        platform_stats["bytes"] += sample["value"]
+    return stats
@@ -0,0 +1,141 @@
+"""
+Schedule Planner
+Assigns publish times to many videos across platforms and accounts in one pass: daily time slots,
+a per-day cap per account, each platform's minimum lead time, horizon and minute granularity,
+and the slots already booked in the record store
+"""
+
+import math
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from utils.config_manager import get_config
+from utils.record_store import RecordStore
+
+# How far ahead each platform accepts a scheduled post and how the time picker rounds minutes
+PLATFORM_SCHEDULE_RULES = {
+    "douyin": {"lead_minutes": 120, "horizon_days": 14, "granularity_minutes": 1},
+    "tencent": {"lead_minutes": 60, "horizon_days": 30, "granularity_minutes": 1},
+    "tiktok": {"lead_minutes": 15, "horizon_days": 10, "granularity_minutes": 5},
+    "kuaishou": {"lead_minutes": 60, "horizon_days": 14, "granularity_minutes": 1},
+    "bilibili": {"lead_minutes": 120, "horizon_days": 15, "granularity_minutes": 1},
+    "xhs": {"lead_minutes": 60, "horizon_days": 14, "granularity_minutes": 1},
+}
+DEFAULT_RULE = {"lead_minutes": 60, "horizon_days": 14, "granularity_minutes": 1}
+
+
+def parse_daily_times(daily_times) -> List[int]:
+    """Minutes after midnight of each daily slot; accepts hours (16, 16.5) or 'HH:MM' strings"""
+    minutes = set()
+    for value in daily_times:
+        if isinstance(value, str):
+            hour, _, minute = value.partition(":")
+            if not 0 <= int(minute or 0) < 60:
+                raise ValueError(f"invalid daily_times: {daily_times}")
+            minutes.add(int(hour) * 60 + int(minute or 0))
+        else:
+            minutes.add(int(round(float(value) * 60)))
+    if not minutes or min(minutes) < 0 or max(minutes) >= 24 * 60:
+        raise ValueError(f"invalid daily_times: {daily_times}")
+    return sorted(minutes)
+
+
+def _ceil_to(value: datetime, granularity: int) -> datetime:
+    step = timedelta(minutes=granularity)
+    midnight = datetime(value.year, value.month, value.day)
+    return midnight + math.ceil((value - midnight) / step) * step
+
+
+class SchedulePlanner(object):
+    """
+    A plan is conflict-free per account: no two posts of an account share a slot, no day exceeds the cap
+    (counting posts already booked), and every time is within the platform's lead time and horizon.
+    Rules come from PLATFORM_SCHEDULE_RULES, overridden by schedule.rules.<platform> in config.yaml.
+    """
+
+    def __init__(self, daily_times=None, per_day: Optional[int] = None, start_days: Optional[int] = None,
+                 records: Optional[RecordStore] = None, now: Optional[datetime] = None):
+        config = get_config()
+        self.daily_minutes = parse_daily_times(
+            daily_times or config.get("schedule.daily_times") or config.get("upload.default_daily_times",
+                                                                           [6, 11, 14, 16, 22]))
+        self.per_day = per_day or config.get("schedule.per_day") or config.get("upload.max_uploads_per_day", 5)
+        self.start_days = config.get("schedule.start_days", 1) if start_days is None else start_days
+        self.rule_overrides: Dict[str, Dict] = config.get("schedule.rules", {}) or {}
+        self.records = records
+        self.now = now or datetime.now()
+
+    def rule(self, platform: str) -> Dict[str, int]:
+        return {**PLATFORM_SCHEDULE_RULES.get(platform, DEFAULT_RULE), **self.rule_overrides.get(platform, {})}
+
+    def slots(self, platform: str, account: str, count: int, taken: Iterable[datetime] = ()) -> List[datetime]:
+        """The next `count` free slots of one account"""
+        if count <= 0:
+            return []
+        rule = self.rule(platform)
+        granularity = rule["granularity_minutes"]
+        earliest = _ceil_to(self.now + timedelta(minutes=rule["lead_minutes"]), granularity)
+        latest = self.now + timedelta(days=rule["horizon_days"])
+
+        taken = set(taken)
+        if self.records is not None:
+            booked = self.records.scheduled_slots(platform, account, since=self.now.timestamp())
+            taken.update(datetime.fromtimestamp(timestamp) for timestamp in booked)
+        taken = {moment.replace(second=0, microsecond=0) for moment in taken}
+        per_day = defaultdict(int)
+        for moment in taken:
+            per_day[moment.date()] += 1
+
+        # Each day's slots rounded down to the platform's granularity, which keeps a slot like 23:58 on its day;
+        # duplicates after rounding dropped
+        day_offsets = sorted({minutes // granularity * granularity for minutes in self.daily_minutes})
+
+        planned = []
+        day = max(self.now.date() + timedelta(days=self.start_days), earliest.date())
+        while len(planned) < count:
+            midnight = datetime(day.year, day.month, day.day)
+            if midnight > latest:
+                raise ValueError(f"{platform}/{account}: only {len(planned)} of {count} videos fit in the "
+                                 f"{rule['horizon_days']}-day scheduling horizon")
+            for minutes in day_offsets:
+                if per_day[day] >= self.per_day or len(planned) == count:
+                    break
+                slot = midnight + timedelta(minutes=minutes)
+                if slot < earliest or slot > latest or slot in taken:
+                    continue
+                planned.append(slot)
+                taken.add(slot)
+                per_day[day] += 1
+            day += timedelta(days=1)
+        return planned
+
+    def plan(self, items: Iterable[Tuple[str, str, object]]) -> List[Tuple[Tuple[str, str, object], datetime]]:
+        """
+        Plan (platform, account, video) items, keeping their order within each account.
+        Returns (item, publish time) pairs in the input order.
+        """
+        items = list(items)
+        groups: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+        for index, (platform, account, _) in enumerate(items):
+            groups[(platform, account)].append(index)
+        times: List[Optional[datetime]] = [None] * len(items)
+        for (platform, account), indexes in groups.items():
+            for index, slot in zip(indexes, self.slots(platform, account, len(indexes))):
+                times[index] = slot
+        return list(zip(items, times))
+
+    def plan_jobs(self, jobs) -> list:
+        """Fill in the schedule of upload jobs that have none; jobs with a schedule keep it and block its slot"""
+        fixed = defaultdict(list)
+        for job in jobs:
+            if job.schedule:
+                fixed[(job.platform, job.account)].append(job.publish_date)
+        pending = [job for job in jobs if not job.schedule]
+        groups = defaultdict(list)
+        for job in pending:
+            groups[(job.platform, job.account)].append(job)
+        for (platform, account), group in groups.items():
+            for job, slot in zip(group, self.slots(platform, account, len(group), fixed[(platform, account)])):
+                job.schedule = slot.strftime('%Y-%m-%d %H:%M')
+        return jobs
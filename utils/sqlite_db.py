@@ -0,0 +1,21 @@
+"""
+SQLite
+Connection setup shared by the on-disk stores: WAL journal so readers never block the writer,
+and a busy timeout so concurrent workers and processes wait for the write lock instead of failing
+"""
+
+import sqlite3
+from pathlib import Path
+
+
+def connect(db_file, schema: str = "") -> sqlite3.Connection:
+    db_file = Path(db_file)
+    db_file.parent.mkdir(parents=True, exist_ok=True)
+    # autocommit mode, transactions are opened explicitly where several statements must be atomic
+    conn = sqlite3.connect(str(db_file), timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if schema:
+        conn.executescript(schema)
+    return conn
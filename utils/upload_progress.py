@@ -0,0 +1,174 @@
+"""
+Upload Progress
+Byte progress, throughput and ETA of a video upload, measured from the chunk requests the page sends
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Deque, Optional, Tuple
+
+from loguru import logger
+from playwright.async_api import Page, Request
+
+from utils.config_manager import get_config
+from utils.metrics import metrics
+
+UPLOAD_METHODS = ("POST", "PUT", "PATCH")
+# Sliding window used for the instantaneous throughput
+WINDOW_SECONDS = 5
+
+
+class UploadProgress(object):
+    """Snapshot passed to progress callbacks"""
+
+    def __init__(self, file_name: str, total_bytes: int, sent_bytes: int, chunks: int, elapsed: float,
+                 current_bps: float, average_bps: float, stalled: bool = False):
+        self.file_name = file_name
+        self.total_bytes = total_bytes
+        self.sent_bytes = sent_bytes
+        self.chunks = chunks
+        self.elapsed = elapsed
+        self.current_bps = current_bps
+        self.average_bps = average_bps
+        self.stalled = stalled
+
+    @property
+    def percent(self) -> float:
+        if not self.total_bytes:
+            return 0.0
+        return min(100.0, self.sent_bytes * 100.0 / self.total_bytes)
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left at the average throughput, None until the first chunk completed"""
+        if not self.average_bps:
+            return None
+        return max(0.0, self.total_bytes - self.sent_bytes) / self.average_bps
+
+    def __str__(self):
+        eta = f"{self.eta:.0f}s" if self.eta is not None else "-"
+        return (f"{self.file_name}: {self.sent_bytes / 1048576:.1f}/{self.total_bytes / 1048576:.1f} MB "
+                f"({self.percent:.0f}%), {self.current_bps / 1048576:.2f} MB/s now, "
+                f"{self.average_bps / 1048576:.2f} MB/s avg, eta {eta}")
+
+
+ProgressCallback = Callable[[UploadProgress], None]
+
+
+class UploadProgressTracker(object):
+    """
+    Listens to requestfinished/requestfailed on the upload page and counts the request bodies of
+    upload-sized POST/PUT requests as sent bytes. Progress is reported to `callback`, to the log every
+    `upload.progress.log_interval` seconds and to metrics; no finished chunk for
+    `upload.progress.stall_timeout` seconds marks the upload as stalled.
+    """
+
+    def __init__(self, page: Page, file_path, platform: str, callback: Optional[ProgressCallback] = None,
+                 log=logger):
+        config = get_config()
+        self.page = page
+        self.platform = platform
+        self.file_name = Path(file_path).name
+        self.total_bytes = os.path.getsize(file_path)
+        self.callback = callback
+        self.log = log
+        self.min_chunk_bytes = config.get("upload.progress.min_chunk_kb", 64) * 1024
+        self.log_interval = config.get("upload.progress.log_interval", 10)
+        self.stall_timeout = config.get("upload.progress.stall_timeout", 60)
+        self.sent_bytes = 0
+        self.chunks = 0
+        self.started_at = 0.0
+        self.last_chunk_at = 0.0
+        self.stalled = False
+        self._window: Deque[Tuple[float, int]] = deque()
+        self._reporter: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start listening, call this before the file is handed to the page"""
+        self.started_at = self.last_chunk_at = time.monotonic()
+        self.page.on("requestfinished", self._on_finished)
+        self.page.on("requestfailed", self._on_failed)
+        self._reporter = asyncio.ensure_future(self._report_loop())
+        return self
+
+    async def stop(self) -> UploadProgress:
+        """Stop listening and record the final numbers; a failed upload just closes its page instead"""
+        self.page.remove_listener("requestfinished", self._on_finished)
+        self.page.remove_listener("requestfailed", self._on_failed)
+        if self._reporter is not None:
+            self._reporter.cancel()
+            await asyncio.gather(self._reporter, return_exceptions=True)
+            self._reporter = None
+        progress = self.progress()
+        self._publish(progress)
+        metrics.inc("upload_files_total", platform=self.platform)
+        self.log.info(f"  [-] upload transferred {progress}")
+        return progress
+
+    def progress(self) -> UploadProgress:
+        now = time.monotonic()
+        while self._window and now - self._window[0][0] > WINDOW_SECONDS:
+            self._window.popleft()
+        elapsed = now - self.started_at
+        window = min(WINDOW_SECONDS, elapsed)
+        current = sum(size for _, size in self._window) / window if window > 0 else 0.0
+        average = self.sent_bytes / elapsed if elapsed > 0 else 0.0
+        return UploadProgress(self.file_name, self.total_bytes, self.sent_bytes, self.chunks, elapsed,
+                              current, average, self.stalled)
+
+    def _is_chunk(self, request: Request) -> bool:
+        return request.method in UPLOAD_METHODS and request.resource_type in ("xhr", "fetch", "other")
+
+    async def _on_finished(self, request: Request):
+        if not self._is_chunk(request):
+            return
+        try:
+            size = (await request.sizes())["requestBodySize"]
+        except Exception:
+            return
+        if size < self.min_chunk_bytes:
+            return
+        now = time.monotonic()
+        self.sent_bytes += size
+        self.chunks += 1
+        self.last_chunk_at = now
+        self._window.append((now, size))
+        metrics.inc("upload_bytes_total", size, platform=self.platform)
+        if self.stalled:
+            self.stalled = False
+            self.log.info(f"  [-] upload of {self.file_name} resumed")
+        self._publish(self.progress())
+
+    def _on_failed(self, request: Request):
+        if self._is_chunk(request):
+            metrics.inc("upload_chunk_failures", platform=self.platform)
+
+    def _publish(self, progress: UploadProgress):
+        metrics.set("upload_sent_bytes", progress.sent_bytes, platform=self.platform, file=self.file_name)
+        metrics.set("upload_throughput_bps", progress.current_bps, platform=self.platform, file=self.file_name)
+        if progress.eta is not None:
+            metrics.set("upload_eta_seconds", progress.eta, platform=self.platform, file=self.file_name)
+        if self.callback is not None:
+            try:
+                self.callback(progress)
+            except Exception as e:
+                self.log.warning(f"  [-] upload progress callback failed: {e}")
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.log_interval)
+            # the page is closed when the upload failed before stop() was reached
+            if self.page.is_closed():
+                return
+            # once every byte is sent the platform is only processing, which is not a stall
+            if not self.stalled and self.sent_bytes < self.total_bytes \
+                    and time.monotonic() - self.last_chunk_at > self.stall_timeout:
+                self.stalled = True
+                metrics.inc("upload_stalls", platform=self.platform)
+                self.log.warning(f"  [-] upload of {self.file_name} stalled: "
+                                 f"no chunk finished for {self.stall_timeout}s")
+                self._publish(self.progress())
+            self.log.info(f"  [-] uploading {self.progress()}")
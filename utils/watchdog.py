@@ -0,0 +1,140 @@
+"""
+Watchdog
+Per-job and per-step deadlines for uploads. The uploader reports the step it is in, a monitor task cancels
+the job once the job or its current step overruns its deadline, and the time workers spent stuck is exported
+"""
+
+import asyncio
+import contextvars
+import time
+from typing import Awaitable, Dict, Optional, Set
+
+from loguru import logger
+
+from utils.config_manager import get_config
+from utils.metrics import metrics
+
+STEP_OPEN = "open"  # from the job start until the upload form is filled: cookie check, page load, file chooser
+
+_current: contextvars.ContextVar = contextvars.ContextVar("watched_job", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Raised by Watchdog.run() for a job cancelled because it overran a deadline"""
+
+
+class WatchedJob(object):
+    def __init__(self, name: str, platform: str, deadline: float, step_deadlines: Dict[str, float]):
+        self.name = name
+        self.platform = platform
+        self.started = time.monotonic()
+        self.deadline = deadline
+        self.step_deadlines = step_deadlines
+        self.step = STEP_OPEN
+        self.step_started = self.started
+        self.task: Optional[asyncio.Future] = None
+        self.expired: Optional[str] = None
+
+    def enter(self, step: str):
+        self.step = step
+        self.step_started = time.monotonic()
+
+    def overrun(self, now: float) -> Optional[str]:
+        """Why the job is past a deadline, None while it is within both"""
+        if self.deadline and now - self.started > self.deadline:
+            return f"job exceeded its {self.deadline}s deadline in step {self.step}"
+        step_deadline = self.step_deadlines.get(self.step)
+        if step_deadline and now - self.step_started > step_deadline:
+            return f"step {self.step} exceeded its {step_deadline}s deadline"
+        return None
+
+
+def heartbeat(step: str):
+    """Report that the upload running in this task entered `step`; a no-op outside Watchdog.run()"""
+    watched = _current.get()
+    if watched is not None:
+        watched.enter(step)
+
+
+def current_step() -> Optional[str]:
+    watched = _current.get()
+    return watched.step if watched is not None else None
+
+
+class Watchdog(object):
+    """
+    Runs uploads as watched tasks. On expiry the task is cancelled, so the uploader's capture_on_failure saves
+    diagnostics and its lease goes back to the pool; the caller gets DeadlineExceeded and reschedules the job.
+    Deadlines come from deadlines.job and deadlines.steps.<step> in config.yaml (0 or missing = none).
+    """
+
+    def __init__(self, job_deadline: Optional[float] = None, step_deadlines: Optional[Dict[str, float]] = None,
+                 check_interval: Optional[float] = None):
+        config = get_config()
+        self.job_deadline = config.get("deadlines.job", 7200) if job_deadline is None else job_deadline
+        self.step_deadlines = (config.get("deadlines.steps", {}) or {}) if step_deadlines is None else step_deadlines
+        self.check_interval = check_interval or config.get("deadlines.check_interval", 5)
+        self._jobs: Set[WatchedJob] = set()
+        self._monitor: Optional[asyncio.Future] = None
+        self._platforms: Set[str] = set()
+
+    async def run(self, awaitable: Awaitable, name: str, platform: str):
+        watched = WatchedJob(name, platform, self.job_deadline, self.step_deadlines)
+        # The task copies the current context, so heartbeat() calls inside it find this job
+        token = _current.set(watched)
+        try:
+            watched.task = asyncio.ensure_future(awaitable)
+        finally:
+            _current.reset(token)
+        self._jobs.add(watched)
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.ensure_future(self._watch())
+        try:
+            return await watched.task
+        except asyncio.CancelledError:
+            if watched.expired:
+                raise DeadlineExceeded(watched.expired) from None
+            raise
+        finally:
+            self._jobs.discard(watched)
+
+    async def _watch(self):
+        while self._jobs:
+            await asyncio.sleep(self.check_interval)
+            now = time.monotonic()
+            oldest: Dict[str, float] = {}
+            for watched in list(self._jobs):
+                step_age = now - watched.step_started
+                oldest[watched.platform] = max(oldest.get(watched.platform, 0), step_age)
+                reason = watched.overrun(now)
+                if reason is None or watched.expired:
+                    continue
+                watched.expired = reason
+                logger.error(f"[watchdog] {watched.name}: {reason}, cancelling")
+                metrics.inc("upload_deadline_exceeded_total", platform=watched.platform, step=watched.step)
+                # Time the worker was pinned in the step that never finished
+                metrics.inc("upload_stuck_seconds_total", step_age, platform=watched.platform)
+                watched.task.cancel()
+            self._report(oldest)
+        self._report({})
+
+    def _report(self, oldest: Dict[str, float]):
+        self._platforms.update(oldest)
+        for platform in self._platforms:
+            metrics.set("upload_oldest_step_seconds", round(oldest.get(platform, 0), 1), platform=platform)
+        # Exported on every check, so a stuck worker shows up in logs/metrics.json while it is stuck
+        try:
+            metrics.dump()
+        except OSError as e:
+            logger.warning(f"[watchdog] could not write metrics: {e}")
+
+
+_watchdog: Optional[Watchdog] = None
+
+
+def get_watchdog() -> Watchdog:
+    """Process-wide watchdog, one monitor task for every running upload"""
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = Watchdog()
+    return _watchdog